@@ -0,0 +1,364 @@
+import asyncio
+import os
+import tty
+import time
+import argparse
+import numpy as np
+
+from cobs import cobs_encode, cobs_encode_bulk, CobsStreamDecoder
+from measurement_packets import GY271_PACKET_DTYPE, MPU6050_PACKET_DTYPE
+from convert_readings import MeasurementConverter
+from async_gy271 import GY271
+
+# emulate the arduino server over a pseudo terminal so the client can be run without a board
+# this speaks the same protocol as arduino_server.ino
+# - commands: start (0x01), stop (0x02), i2c read (0x03), i2c write (0x04)
+# - replies: start/stop acks (0x04/0x05), unknown packet (0x06), i2c read/write acks (0x07/0x08), alive (0xFF)
+# - measurements: gy271 (0x01) and mpu6050 (0x03) packets
+# unlike the board the sample rates are set directly and can go far beyond what the serial link supports
+
+# packet headers, see arduino_server.ino
+RX_MEASUREMENT_START_HEADER = 0x01
+RX_MEASUREMENT_STOP_HEADER = 0x02
+RX_I2C_READ_HEADER = 0x03
+RX_I2C_WRITE_HEADER = 0x04
+
+TX_GY271_DATA_HEADER = 0x01
+TX_MPU6050_DATA_HEADER = 0x03
+TX_MEASUREMENT_START_ACK_HEADER = 0x04
+TX_MEASUREMENT_STOP_ACK_HEADER = 0x05
+TX_UNKNOWN_RX_PACKET_HEADER = 0x06
+TX_I2C_READ_INFO_HEADER = 0x07
+TX_I2C_WRITE_INFO_HEADER = 0x08
+TX_ALIVE_HEADER = 0xFF
+
+MAX_I2C_RW = 32
+COBS_BUFFER_LEN = 64
+
+MPU6050_ADDR = 0x68
+GY271_ADDR = 0x1E
+
+# same as the mappings in async_mpu6050.py
+MPU6050_GYRO_SENSITIVITY = [131, 65.5, 32.8, 16.4]
+MPU6050_ACCEL_SENSITIVITY = [16384, 8192, 4096, 2048]
+
+# measurement packets with their header byte so a batch can be encoded straight from the array
+GY271_FRAME_DTYPE = np.dtype([('header', 'u1')] + GY271_PACKET_DTYPE.descr)
+MPU6050_FRAME_DTYPE = np.dtype([('header', 'u1')] + MPU6050_PACKET_DTYPE.descr)
+
+# register contents after mpu6050_begin() has run on the board
+def create_mpu6050_registers():
+    registers = bytearray(256)
+    registers[0x6B] = 0x00  # awake, internal clock
+    registers[0x1B] = 0x00  # +-250 deg/s
+    registers[0x1C] = 0x00  # +-2g
+    registers[0x3A] = 0x01  # data ready
+    registers[0x75] = 0x68  # who am i
+    return registers
+
+# register contents of the gy271 at power on
+def create_gy271_registers():
+    registers = bytearray(256)
+    registers[0x00] = 0x10  # 1 average, 15Hz, normal measurement
+    registers[0x01] = 0x20  # gain of 1090
+    registers[0x02] = 0x01  # single measurement
+    registers[0x09] = 0x01  # ready
+    registers[0x0A:0x0D] = b"H43"
+    return registers
+
+# synthetic motion of the board which is rotating about the vertical axis at a constant rate
+# returns the readings in the same SI units and axes as MeasurementConverter's output
+class SyntheticMotion:
+    def __init__(self, yaw_rate=0.5, noise=0.0, seed=0):
+        self.yaw_rate = yaw_rate
+        self.noise = noise
+        self.rng = np.random.default_rng(seed)
+        self.g = np.array([0, 0, 9.81])
+        self.m = np.array([0.2, 0, 0.4])
+
+    def add_noise(self, x, scale):
+        if self.noise > 0:
+            x = x + self.rng.normal(0, self.noise*scale, x.shape)
+        return x
+
+    # t.shape: (N,), returns (a_xyz, pqr) with shape (3,N)
+    def gyro(self, t):
+        N = len(t)
+        a_xyz = np.repeat(self.g.reshape((3,1)), N, axis=1)
+        pqr = np.zeros((3,N))
+        pqr[2] = self.yaw_rate
+        return self.add_noise(a_xyz, 9.81), self.add_noise(pqr, 1)
+
+    # t.shape: (N,), returns m_xyz with shape (3,N)
+    def compass(self, t):
+        yaw = self.yaw_rate * t
+        c, s = np.cos(yaw), np.sin(yaw)
+        m_xyz = np.stack([
+            c*self.m[0] + s*self.m[1],
+            -s*self.m[0] + c*self.m[1],
+            np.full(len(t), self.m[2])])
+        return self.add_noise(m_xyz, 1)
+
+# the arduino server's state machine without any io
+# handle_packet() and get_samples() return encoded bytes to send to the client
+class VirtualArduino:
+    def __init__(self, gyro_rate=100, compass_rate=100, motion=None):
+        self.gyro_rate = gyro_rate
+        self.compass_rate = compass_rate
+        self.motion = motion if motion is not None else SyntheticMotion()
+        self.devices = {
+            MPU6050_ADDR: create_mpu6050_registers(),
+            GY271_ADDR: create_gy271_registers(),
+        }
+        self.converter = MeasurementConverter()
+        self.measurements_running = False
+
+        # micros() counts from when the emulator was created
+        self.t0 = time.monotonic()
+        self.t_start = 0.0
+        self.t_stop = 0.0
+        self.total_gyro_samples = 0
+        self.total_compass_samples = 0
+
+        self.total_commands = 0
+        self.total_unknown_commands = 0
+
+    def micros(self, t):
+        return (np.asarray(t)*1e6).astype(np.int64) & 0xFFFFFFFF
+
+    def handle_packet(self, packet):
+        self.total_commands += 1
+        n = len(packet)
+        header = packet[0]
+
+        if header == RX_MEASUREMENT_START_HEADER and n == 2:
+            self.measurements_running = True
+            self.t_start = time.monotonic() - self.t0
+            self.total_gyro_samples = 0
+            self.total_compass_samples = 0
+            return self.encode([TX_MEASUREMENT_START_ACK_HEADER, packet[1]])
+        elif header == RX_MEASUREMENT_STOP_HEADER and n == 2:
+            self.measurements_running = False
+            self.t_stop = time.monotonic() - self.t0
+            return self.encode([TX_MEASUREMENT_STOP_ACK_HEADER, packet[1]])
+        elif header == RX_I2C_READ_HEADER and n == 4:
+            _, addr, reg, read_len = packet
+            registers = self.devices.get(addr)
+            # NOTE: the board checks the command length instead of read_len here and can overrun its buffer
+            if registers is None or read_len > MAX_I2C_RW or reg+read_len > len(registers):
+                return self.encode([TX_I2C_READ_INFO_HEADER, addr, reg, 0x00])
+            return self.encode([TX_I2C_READ_INFO_HEADER, addr, reg, read_len, *registers[reg:reg+read_len]])
+        elif header == RX_I2C_WRITE_HEADER and n >= 5:
+            _, addr, reg, write_len = packet[:4]
+            registers = self.devices.get(addr)
+            if write_len > MAX_I2C_RW or write_len != n-4 or registers is None or reg+write_len > len(registers):
+                return self.encode([TX_I2C_WRITE_INFO_HEADER, addr, reg, 0x00])
+            registers[reg:reg+write_len] = packet[4:]
+            self.update_gains()
+            return self.encode([TX_I2C_WRITE_INFO_HEADER, addr, reg, write_len])
+
+        # the board echoes the raw bytes it received which are the packet's cobs frame
+        self.total_unknown_commands += 1
+        rx_buf = cobs_encode(packet)[:COBS_BUFFER_LEN-2]
+        return self.encode([TX_UNKNOWN_RX_PACKET_HEADER, len(rx_buf), *rx_buf])
+
+    def encode(self, packet):
+        return bytes(cobs_encode(packet))
+
+    def alive(self, rx_available=0):
+        return self.encode([TX_ALIVE_HEADER, rx_available & 0xFF])
+
+    # quantise with the gains that the client configured, the inverse of MeasurementConverter
+    def update_gains(self):
+        mpu6050 = self.devices[MPU6050_ADDR]
+        gy271 = self.devices[GY271_ADDR]
+        self.converter.gain_accelerometer = MPU6050_ACCEL_SENSITIVITY[(mpu6050[0x1C] >> 3) & 0b11]
+        self.converter.gain_gyroscope = MPU6050_GYRO_SENSITIVITY[(mpu6050[0x1B] >> 3) & 0b11]
+        self.converter.gain_magnetometer = GY271.MEASUREMENT_GAIN[gy271[0x01] >> 5]
+
+    def to_raw(self, sensor, y):
+        if self.converter.affine is None:
+            self.update_gains()
+            self.converter.compile()
+        A, b = self.converter.affine[sensor]
+        x = np.linalg.solve(A, y - b)
+        return np.clip(np.round(x), -0x8000, 0x7FFF).astype(np.int16)
+
+    # sample k of a sensor is taken at t_start + k/rate
+    # returns the timestamps of the samples which are due by time t
+    def due_samples(self, t, rate, total_sent):
+        total_due = int((t - self.t_start) * rate) + 1
+        k = np.arange(total_sent, max(total_sent, total_due))
+        return self.t_start + k/rate
+
+    # returns the encoded frames of every sample due by now
+    # like the board the compass sample of each period is sent before the gyro sample
+    def get_samples(self):
+        if not self.measurements_running:
+            return b''
+
+        t = time.monotonic() - self.t0
+        chunks = []
+
+        # the board only sends gyro samples if the mpu6050 is awake
+        mpu6050 = self.devices[MPU6050_ADDR]
+        is_mpu6050_awake = (mpu6050[0x6B] & (1 << 6)) == 0
+
+        if self.compass_rate > 0:
+            ts = self.due_samples(t, self.compass_rate, self.total_compass_samples)
+            if len(ts) > 0:
+                frames = np.zeros(len(ts), dtype=GY271_FRAME_DTYPE)
+                frames['header'] = TX_GY271_DATA_HEADER
+                frames['uS'] = self.micros(ts)
+                frames['m_xyz'] = self.to_raw("magnetometer", self.motion.compass(ts)).T
+                self.devices[GY271_ADDR][0x03:0x09] = frames[-1].tobytes()[5:]
+                self.total_compass_samples += len(ts)
+                chunks.append(frames)
+
+        if self.gyro_rate > 0 and is_mpu6050_awake:
+            ts = self.due_samples(t, self.gyro_rate, self.total_gyro_samples)
+            if len(ts) > 0:
+                a_xyz, pqr = self.motion.gyro(ts)
+                frames = np.zeros(len(ts), dtype=MPU6050_FRAME_DTYPE)
+                frames['header'] = TX_MPU6050_DATA_HEADER
+                frames['uS'] = self.micros(ts)
+                frames['a_xyz'] = self.to_raw("accelerometer", a_xyz).T
+                frames['pqr'] = self.to_raw("gyroscope", pqr).T
+                mpu6050[0x3B:0x49] = frames[-1].tobytes()[5:]
+                self.total_gyro_samples += len(ts)
+                chunks.append(frames)
+
+        encoded = []
+        for frames in chunks:
+            n = frames.dtype.itemsize
+            offsets = np.arange(len(frames)+1) * n
+            payload = np.frombuffer(frames.tobytes(), dtype=np.uint8)
+            encoded.append(cobs_encode_bulk(offsets, payload).tobytes())
+        return b''.join(encoded)
+
+# serve a VirtualArduino on the master side of a pseudo terminal
+# the client opens the slave side (port_name) as if it were the board's serial port
+class PtyArduinoServer:
+    # seconds between streaming measurements, each tick sends every sample that is due as one write
+    tick = 0.001
+    # seconds between alive packets
+    alive_period = 1.0
+    # bytes waiting to be written before new samples are dropped
+    # this stands in for the board's transmit buffer filling up when the client can't keep up
+    max_tx_backlog = 1 << 16
+
+    def __init__(self, arduino):
+        self.arduino = arduino
+        self.master_fd, self.slave_fd = os.openpty()
+        # no echo or newline translation so the slave behaves like a serial port
+        tty.setraw(self.slave_fd)
+        os.set_blocking(self.master_fd, False)
+        self.port_name = os.ttyname(self.slave_fd)
+
+        self.rx_decoder = CobsStreamDecoder()
+        self.tx_buffer = bytearray()
+        self.is_writing = False
+        self.loop = None
+        self.stop_event = None
+
+        self.total_tx_bytes = 0
+        self.total_dropped_bytes = 0
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        self.loop.add_reader(self.master_fd, self.on_readable)
+        try:
+            await asyncio.gather(self.stream_samples(), self.send_alive())
+        finally:
+            self.loop.remove_reader(self.master_fd)
+            if self.is_writing:
+                self.loop.remove_writer(self.master_fd)
+
+    def stop(self):
+        if self.stop_event is not None:
+            self.stop_event.set()
+
+    def close(self):
+        os.close(self.master_fd)
+        os.close(self.slave_fd)
+
+    async def stream_samples(self):
+        while not self.stop_event.is_set():
+            data = self.arduino.get_samples()
+            if len(data) > 0:
+                if len(self.tx_buffer) > self.max_tx_backlog:
+                    self.total_dropped_bytes += len(data)
+                else:
+                    self.send(data)
+            await asyncio.sleep(self.tick)
+
+    async def send_alive(self):
+        while not self.stop_event.is_set():
+            self.send(self.arduino.alive())
+            try:
+                await asyncio.wait_for(self.stop_event.wait(), self.alive_period)
+            except asyncio.TimeoutError:
+                pass
+
+    def on_readable(self):
+        try:
+            data = os.read(self.master_fd, 4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            # EIO once the client closes the slave side on some platforms
+            return
+        for packet in self.rx_decoder.feed(data):
+            self.send(self.arduino.handle_packet(packet))
+
+    def send(self, data):
+        self.tx_buffer += data
+        self.flush()
+
+    def flush(self):
+        try:
+            n = os.write(self.master_fd, self.tx_buffer)
+        except (BlockingIOError, InterruptedError):
+            n = 0
+        self.total_tx_bytes += n
+        del self.tx_buffer[:n]
+
+        # wait for the client to read before writing the rest
+        if len(self.tx_buffer) > 0 and not self.is_writing:
+            self.loop.add_writer(self.master_fd, self.flush)
+            self.is_writing = True
+        elif len(self.tx_buffer) == 0 and self.is_writing:
+            self.loop.remove_writer(self.master_fd)
+            self.is_writing = False
+
+    def print_stats(self):
+        arduino = self.arduino
+        print(f"Emulator sent: gyro={arduino.total_gyro_samples} compass={arduino.total_compass_samples} "+\
+              f"bytes={self.total_tx_bytes} dropped_bytes={self.total_dropped_bytes} "+\
+              f"commands={arduino.total_commands} unknown={arduino.total_unknown_commands}")
+
+async def main(args):
+    motion = SyntheticMotion(yaw_rate=args.yaw_rate, noise=args.noise)
+    arduino = VirtualArduino(gyro_rate=args.gyro_rate, compass_rate=args.compass_rate, motion=motion)
+    server = PtyArduinoServer(arduino)
+    print(f"Emulating arduino on {server.port_name}")
+    print(f"Run the client with --port {server.port_name}")
+    try:
+        await server.run()
+    finally:
+        server.print_stats()
+        server.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--gyro-rate", default=100, type=float, help="MPU6050 samples per second")
+    parser.add_argument("--compass-rate", default=100, type=float, help="GY271 samples per second")
+    parser.add_argument("--yaw-rate", default=0.5, type=float, help="Rotation of the emulated board (rads-1)")
+    parser.add_argument("--noise", default=0.01, type=float, help="Standard deviation of the sensor noise relative to its signal")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        pass
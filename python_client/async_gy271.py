@@ -1,9 +1,11 @@
 import asyncio
 from collections import namedtuple
+from register_shadow import RegisterShadow
 
 GY271_Config_A = namedtuple('GY271_Config_A', ["averages", "data_rate", "measure_bias"])
 GY271_Config_B = namedtuple('GY271_Config_B', ["gain", "range"])
 GY271_Status = namedtuple("GY271_Status", ["locked", "ready"])
+GY271_Registers = namedtuple("GY271_Registers", ["config_A", "config_B", "mode", "status", "identity"])
 
 # asynchronously control the GY271 compass
 class GY271:
@@ -22,6 +24,9 @@ class GY271:
     def __init__(self, i2c):
         self.i2c = i2c
         self.addr = 0x1E
+
+        # config A, config B and mode
+        self.registers = RegisterShadow(i2c, self.addr, [0x00, 0x01, 0x02])
     
     # index of option to select
     async def set_config_A(self, average_count, data_output_rate, measurement_bias):
@@ -29,15 +34,16 @@ class GY271:
         DO = data_output_rate & 0b111
         MS = measurement_bias & 0b11
         bits = 0x00 | (MA << 5) | (DO << 2) | (MS << 0)
-        return await self.i2c.write(self.addr, 0x00, [bits]) == 1
+        return await self.registers.write(0x00, bits) == 1
     
     # get config description
     async def get_config_A(self):
-        bits = await self.i2c.read(self.addr, 0x00, 1)
-        if not bits:
+        bits = await self.registers.read(0x00)
+        if bits is None:
             return None
-        
-        bits = bits[0]
+        return self.decode_config_A(bits)
+
+    def decode_config_A(self, bits):
         MA = (bits & (0b11 << 5)) >> 5
         DO = (bits & (0b111 << 2)) >> 2
         MS = bits & 0b11
@@ -49,14 +55,15 @@ class GY271:
     async def set_config_B(self, gain):
         GN = gain & 0b111
         bits = 0x00 | (GN << 5)
-        return await self.i2c.write(self.addr, 0x01, [bits]) == 1
+        return await self.registers.write(0x01, bits) == 1
     
     async def get_config_B(self):
-        bits = await self.i2c.read(self.addr, 0x01, 1)
-        if not bits:
+        bits = await self.registers.read(0x01)
+        if bits is None:
             return None
-        
-        bits = bits[0]
+        return self.decode_config_B(bits)
+
+    def decode_config_B(self, bits):
         GN = (bits & (0b111 << 5)) >> 5
 
         return GY271_Config_B(
@@ -67,14 +74,15 @@ class GY271:
         # 0=continuous, 1=single, 2=idle, 3=idle
         MD = mode & 0b11
         bits = 0x00 | (MD << 0)
-        return await self.i2c.write(self.addr, 0x02, [bits]) == 1
+        return await self.registers.write(0x02, bits) == 1
     
     async def get_mode(self):
-        bits = await self.i2c.read(self.addr, 0x02, 1)
-        if not bits:
+        bits = await self.registers.read(0x02)
+        if bits is None:
             return None
-        
-        bits = bits[0]
+        return self.decode_mode(bits)
+
+    def decode_mode(self, bits):
         MD = bits & 0b11
 
         return self.MODE_SELECT[MD]
@@ -84,8 +92,9 @@ class GY271:
         bits = await self.i2c.read(self.addr, 0x09, 1)
         if bits is None: 
             return None
-        
-        bits = bits[0]
+        return self.decode_status(bits[0])
+
+    def decode_status(self, bits):
         sr_lock = bool(bits & (1 << 1))
         sr_ready = bool(bits & (1 << 0))
 
@@ -96,4 +105,14 @@ class GY271:
         identity_reg = await self.i2c.read(self.addr, 0x0A, 3)
         if identity_reg is None:
             return None
-        return ''.join(map(chr, identity_reg))
\ No newline at end of file
+        return ''.join(map(chr, identity_reg))
+
+    # read every register from config A (0x00) to the identity (0x0C) in one request
+    # the config registers in the shadow are refreshed as well
+    async def get_registers(self):
+        data = await self.registers.read_block(0x00, 13)
+        if data is None:
+            return None
+        return GY271_Registers(
+            self.decode_config_A(data[0x00]), self.decode_config_B(data[0x01]), self.decode_mode(data[0x02]),
+            self.decode_status(data[0x09]), ''.join(map(chr, data[0x0A:0x0D])))
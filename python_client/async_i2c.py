@@ -1,81 +1,175 @@
 import asyncio
+from collections import deque
+from timeit import default_timer
+
+# round trip time of i2c transactions in seconds
+class LatencyStats:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+
+    def add(self, dt):
+        self.count += 1
+        self.total += dt
+        self.min = min(self.min, dt)
+        self.max = max(self.max, dt)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count > 0 else 0.0
+
+    def __str__(self):
+        if self.count == 0:
+            return "n=0"
+        return f"n={self.count} mean={self.mean*1e3:.2f}ms min={self.min*1e3:.2f}ms max={self.max*1e3:.2f}ms"
+
+# a command waiting for its acknowledge packet
+class I2CRequest:
+    def __init__(self, future):
+        self.future = future
+        self.t_sent = 0.0
+        # times the command was sent, every copy that reaches the arduino gets its own ack
+        self.sends = []
 
 # asynchronously send commands over the arduino's i2c bus using the serial port
 # this is async because it can take a few milliseconds to complete an i2c operation
+# Several commands can be in flight at once to keep the serial link busy
+# The arduino executes commands in order, so acks are matched to the oldest pending request
+# with the same (ack header, addr, reg)
+# A command that was resent after a timeout can be acked more than once, the extra acks are
+# dropped so they can't complete a newer request for the same key before it has run
 class AsyncI2C:
-    def __init__(self, serial_client):
+    READ_ACK = 0x07
+    WRITE_ACK = 0x08
+
+    # window = max number of commands in flight, the arduino only has a 64 byte serial receive buffer
+    # timeout = seconds to wait for an ack before resending the command
+    # retries = number of times a command is resent before giving up
+    # max_ack_age = seconds after which an ack still owed by a resent command is assumed lost
+    #               (None = the time a request waits before giving up)
+    def __init__(self, serial_client, window=6, timeout=0.25, retries=2, max_ack_age=None):
         self.serial_client = serial_client
+        self.window = asyncio.Semaphore(window)
+        self.timeout = timeout
+        self.retries = retries
+        self.max_ack_age = max_ack_age if max_ack_age is not None else timeout*(retries+1)
 
-        self.read_pending_set = {}
-        self.read_pending = {}
-        self.write_pending_set = {}
-        self.write_pending = {}
+        # (ack header, addr, reg) -> deque of I2CRequest
+        self.pending = {}
+        # (ack header, addr, reg) -> deque of send times of the copies whose acks are still owed
+        self.owed_acks = {}
 
         self.unknown_read_acks = []
         self.unknown_write_acks = []
 
+        self.total_retries = 0
+        self.total_timeouts = 0
+        self.total_stale_acks = 0
+        # ("read"|"write", addr, reg) -> LatencyStats
+        self.latency = {}
+
     # read data
+    # returns None if the read failed
     async def read(self, addr, reg, n):
         d = [0x03, addr, reg, n]
         d = [0xFF&x for x in d]
-
-        self.send_command(d)
-        key = (addr, reg)
-
-        sem = self.read_pending_set.setdefault(key, asyncio.Semaphore(0))
-        await sem.acquire()
-
-        data = self.read_pending[key].pop()
-        return data
+        return await self.transact("read", self.READ_ACK, d, None)
 
     # write data
+    # returns the number of bytes written
     async def write(self, addr, reg, data):
         n = len(data)
         d = [0x04, addr, reg, n, *data]
         d = [0xFF&x for x in d]
-
-        self.send_command(d)
-        key = (addr, reg)
-
-        sem = self.write_pending_set.setdefault(key, asyncio.Semaphore(0))
-        await sem.acquire()
-
-        data = self.write_pending[key].pop()
-        return data
-
-    # we place i2c read acknowledge packets here 
+        return await self.transact("write", self.WRITE_ACK, d, 0)
+
+    # send a command and wait for its ack, resending it if the ack is lost
+    # failed = value returned if no ack arrives
+    async def transact(self, name, ack_header, command, failed):
+        _, addr, reg = command[:3]
+        key = (ack_header, addr, reg)
+
+        async with self.window:
+            request = I2CRequest(asyncio.get_running_loop().create_future())
+            self.pending.setdefault(key, deque()).append(request)
+
+            for attempt in range(self.retries+1):
+                # the ack can arrive after the wait timed out but before this task runs again,
+                # a copy sent after it would be acked without resolve() knowing the ack is owed
+                if request.future.done():
+                    break
+                if attempt > 0:
+                    self.total_retries += 1
+                # recorded before it is written so resolve() always counts this copy's ack as owed
+                # nothing is awaited between the check above and the write, so resolve() can't run in between
+                request.t_sent = default_timer()
+                request.sends.append(request.t_sent)
+                self.send_command(command)
+                try:
+                    # shield so a timeout doesn't cancel the future that a late ack can still complete
+                    await asyncio.wait_for(asyncio.shield(request.future), self.timeout)
+                except asyncio.TimeoutError:
+                    continue
+                break
+
+            if request.future.done():
+                dt = default_timer() - request.t_sent
+                self.latency.setdefault((name, addr, reg), LatencyStats()).add(dt)
+                return request.future.result()
+
+            # every copy of the command can still be acked late
+            self.pending[key].remove(request)
+            self.owed_acks.setdefault(key, deque()).extend(request.sends)
+            self.total_timeouts += 1
+            return failed
+
+    # complete the oldest request waiting on this ack
+    # acks still owed by resent commands come before the ack of any newer request, so they are dropped first
+    # returns False if no request is waiting on it
+    def resolve(self, key, result):
+        owed = self.owed_acks.get(key)
+        if owed:
+            # the ack of a lost copy never arrives, so forget it rather than drop acks forever
+            t_expired = default_timer() - self.max_ack_age
+            while owed and owed[0] < t_expired:
+                owed.popleft()
+            if owed:
+                owed.popleft()
+                self.total_stale_acks += 1
+                return True
+
+        requests = self.pending.get(key)
+        if not requests:
+            return False
+        request = requests.popleft()
+        request.future.set_result(result)
+        # the request took the ack of its first copy, the copies sent after it are acked later
+        if len(request.sends) > 1:
+            self.owed_acks.setdefault(key, deque()).extend(request.sends[1:])
+        return True
+
+    # we place i2c read acknowledge packets here
     # contains (addr, register, total_bytes_read, data[total_bytes_read])
     def on_read_ack(self, packet):
         addr, reg, n = packet[:3]
-        key = (addr, reg)
-        if key not in self.read_pending_set:
-            self.unknown_read_acks.append(packet)
-            return
-
-        datas = self.read_pending.setdefault(key, [])
-
-        if n == 0:
-            datas.append(None)
-        else:
-            data = packet[3:3+n]
-            datas.append(data)
-
-        sem = self.read_pending_set[key]
-        sem.release()
+        data = None if n == 0 else bytes(packet[3:3+n])
+        if not self.resolve((self.READ_ACK, addr, reg), data):
+            self.unknown_read_acks.append(bytes(packet))
 
     # we place i2c write information packets here
     # contains (addr, register, total_bytes_written)
     def on_write_ack(self, packet):
         addr, reg, n = packet[:3]
-        key = (addr, reg)
-        if key not in self.write_pending_set:
-            self.unknown_write_acks.append(packet)
-            return
+        if not self.resolve((self.WRITE_ACK, addr, reg), n):
+            self.unknown_write_acks.append(bytes(packet))
 
-        datas = self.write_pending.setdefault(key, [])
-        datas.append(n)
-        sem = self.write_pending_set[key]
-        sem.release()
+    def print_stats(self):
+        print(f"I2C retries={self.total_retries} timeouts={self.total_timeouts} stale acks={self.total_stale_acks} "+\
+              f"unknown acks: read={len(self.unknown_read_acks)} write={len(self.unknown_write_acks)}")
+        for (name, addr, reg), stats in sorted(self.latency.items()):
+            print(f"    {name:5s} addr={addr:02X} reg={reg:02X} {stats}")
 
     def send_command(self, command):
-        self.serial_client.send_command(command)
\ No newline at end of file
+        self.serial_client.send_command(command)
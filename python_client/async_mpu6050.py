@@ -1,4 +1,5 @@
 import asyncio
+from register_shadow import RegisterShadow
 
 # asynchronously control the mpu6050 combined accelerometer and gyroscope
 # over the arduino's i2c bus
@@ -9,15 +10,12 @@ class MPU6050:
     
         self.gyro_sensitivity = [131, 65.5, 32.8, 16.4]
         self.accel_sensitivity = [16384, 8192, 4096, 2048]
+
+        # power management, gyro config and accel config
+        self.registers = RegisterShadow(i2c, self.addr, [0x6B, 0x1B, 0x1C])
         
     async def set_clock_source(self, source):
-        data = await self.i2c.read(self.addr, 0x6B, 1)
-        if data is None:
-            return False
-        data = data[0]
-        data = (data & 0xf8) | (source & 0x07)
-        n = await self.i2c.write(self.addr, 0x6B, [data])
-        return n == 1
+        return await self.registers.modify(0x6B, 0x07, source)
     
     # page 14
     async def set_gyro_fullscale_range(self, mode):
@@ -26,13 +24,7 @@ class MPU6050:
         # 2 = 1000
         # 3 = 2000
         mode = mode & 0x03
-        data = await self.i2c.read(self.addr, 0x1b, 1)
-        if data is None:
-            return False
-        data = data[0]
-        data = (data & int("11100111", 2)) | (mode << 3)
-        n  = await self.i2c.write(self.addr, 0x1b, [data])
-        return n == 1
+        return await self.registers.modify(0x1b, int("00011000", 2), mode << 3)
         
     # page 14
     async def set_accel_fullscale_range(self, mode):
@@ -41,38 +33,22 @@ class MPU6050:
         # 2 = 8g
         # 3 = 16g
         mode = mode & 0x03
-        data = await self.i2c.read(self.addr, 0x1c, 1)
-        if data is None:
-            return False
-        data = data[0]
-        data = (data & int("11100111", 2)) | (mode << 3)
-        n  = await self.i2c.write(self.addr, 0x1c, [data])
-        return n == 1
+        return await self.registers.modify(0x1c, int("00011000", 2), mode << 3)
             
     async def set_sleep(self, is_sleep):
-        data = await self.i2c.read(self.addr, 0x6B, 1)
-        if data is None:
-            return False
-        data = data[0]
-        if not is_sleep:
-            n = await self.i2c.write(self.addr, 0x6B, [data & ~(1 << 6)])
-        else:
-            n = await self.i2c.write(self.addr, 0x6B, [data | (1 << 6)])
-        return n == 1
+        return await self.registers.modify(0x6B, 1 << 6, (1 << 6) if is_sleep else 0)
 
     async def get_gyro_sensitivity(self):
-        data = await self.i2c.read(self.addr, 0x1b, 1)
+        data = await self.registers.read(0x1b)
         if data is None:
             return None
-        data = data[0]
         mode = (data & ~int("11100111", 2)) >> 3
         return self.gyro_sensitivity[mode]
     
     async def get_accel_sensitivity(self):
-        data = await self.i2c.read(self.addr, 0x1c, 1)
+        data = await self.registers.read(0x1c)
         if data is None:
             return None
-        data = data[0]
         mode = (data & ~int("11100111", 2)) >> 3
         return self.accel_sensitivity[mode]
     
@@ -83,3 +59,13 @@ class MPU6050:
         data = data[0]
         is_ready = (data & 0x01) != 0x00
         return is_ready
+
+    # read the gyro and accel config registers (0x1B, 0x1C) in one request
+    # returns (accel sensitivity, gyro sensitivity)
+    async def get_sensitivities(self):
+        data = await self.registers.read_block(0x1b, 2)
+        if data is None:
+            return None
+        gyro_mode = (data[0] & ~int("11100111", 2)) >> 3
+        accel_mode = (data[1] & ~int("11100111", 2)) >> 3
+        return (self.accel_sensitivity[accel_mode], self.gyro_sensitivity[gyro_mode])
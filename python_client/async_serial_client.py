@@ -1,32 +1,67 @@
-from cobs import cobs_encode, cobs_decode
+from cobs import cobs_encode, CobsStreamDecoder
+from serial_transport import SERIAL_TRANSPORTS
 import asyncio
 
 class AsyncSerialClient:
-    def __init__(self, ser):
+    # transport = name of the reader in SERIAL_TRANSPORTS or a transport class
+    # capture = RawCaptureWriter that every received chunk of bytes is appended to (optional)
+    def __init__(self, ser, transport="thread", capture=None):
         self.ser = ser
-        self.rx_encoded = []
+        self.transport_type = SERIAL_TRANSPORTS[transport] if isinstance(transport, str) else transport
+        self.capture = capture
+        self.rx_decoder = CobsStreamDecoder()
         self.listeners = {}
+        self.batch_listeners = {}
         self.fallback_listeners = set([])
         self.is_running = True
 
+        # callbacks for each header byte, rebuilt when a listener is added
+        # headers without any listeners use the fallback listeners
+        self.dispatch_table = [() for _ in range(256)]
+        self.batch_dispatch_table = [() for _ in range(256)]
+
+        self.loop = None
+        self.stop_event = None
+
     async def open(self):
         print("Attempting to connect")
         self.ser.open()
         print("Successfully connected")
 
-    # run this asynchronously in our event loop    
+    # run this asynchronously in our event loop
+    # received packets are dispatched by the transport as they arrive until stop() is called
     async def run(self):
-        while self.ser.is_open and self.is_running:
-            await asyncio.sleep(0.0005)
-
-            x = self.ser.read_all()
-            if x is None or len(x) == 0:
-                continue
-                
-            x = list(x)
-            self.consume_rx_packets()
-            self.rx_encoded.extend(list(x))
-    
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        if not self.is_running:
+            return
+
+        on_data = self.consume_rx_packets if self.capture is None else self.capture_rx_packets
+        transport = self.transport_type(self.ser, on_data, self.on_transport_error)
+        transport.start(self.loop)
+        try:
+            await self.stop_event.wait()
+        finally:
+            transport.stop()
+
+    # stop run(), this can be called from any thread
+    def stop(self):
+        self.is_running = False
+        if self.loop is None:
+            return
+        try:
+            self.loop.call_soon_threadsafe(self.stop_event.set)
+        except RuntimeError:
+            # the event loop is already closed
+            pass
+
+    def on_transport_error(self, ex):
+        if isinstance(ex, EOFError):
+            print(f"Reached end of serial stream: {str(ex)}")
+        else:
+            print(f"Encountered error when reading serial: {str(ex)}")
+        self.stop()
+
     def close(self):
         try:
             if self.ser.is_open:
@@ -35,43 +70,72 @@ class AsyncSerialClient:
         except Exception as ex:
             print(f"Encountered error when closing serial: {str(ex)}")
     
-    def extract_packets(self, encoded):
-        packets = []
-        while True:
-            try:
-                i = encoded.index(0x00)
-                decoded = cobs_decode(encoded[:i+1])
-                encoded = encoded[i+1:]
-                packet = decoded[:-1]
-                packets.append(packet)
-            except ValueError:
-                break
-        
-        return (encoded, packets)
-    
     def listen_header(self, header, callback):
         observers = self.listeners.setdefault(header, set([]))
         observers.add(callback)
+        self.update_dispatch_table()
     
+    # the callback is given a list of consecutive packets with this header instead of one packet at a time
+    # packets are still delivered in the order they were received relative to other headers
+    def listen_header_batch(self, header, callback):
+        observers = self.batch_listeners.setdefault(header, set([]))
+        observers.add(callback)
+        self.update_dispatch_table()
+
     def listen_header_fallback(self, callback):
         self.fallback_listeners.add(callback)
+        self.update_dispatch_table()
 
-    def consume_rx_packets(self):
-        encoded, packets = self.extract_packets(self.rx_encoded)
-        self.rx_encoded = encoded
+    def update_dispatch_table(self):
+        fallback = tuple(self.fallback_listeners)
+        for header in range(256):
+            callbacks = tuple(self.listeners.get(header, ()))
+            batch_callbacks = tuple(self.batch_listeners.get(header, ()))
+            if len(callbacks) == 0 and len(batch_callbacks) == 0:
+                callbacks = fallback
+            self.dispatch_table[header] = callbacks
+            self.batch_dispatch_table[header] = batch_callbacks
 
+    # keep the raw bytes before they are decoded so the session can be replayed
+    def capture_rx_packets(self, rx_encoded):
+        self.capture.write(rx_encoded)
+        self.consume_rx_packets(rx_encoded)
+
+    # decode the received bytes and pass every complete packet to its listeners
+    # listeners are given a memoryview of the packet after its header
+    # NOTE: use bytes(content) if the whole packet needs to be kept or printed
+    def consume_rx_packets(self, rx_encoded):
+        packets = self.rx_decoder.feed(rx_encoded)
+        dispatch_table = self.dispatch_table
+        batch_dispatch_table = self.batch_dispatch_table
+
+        # the table lookups only need to be done when the header changes
+        # which also ends the current batch
+        last_header = None
+        callbacks = ()
+        batch_callbacks = ()
+        batch = []
         for packet in packets:
             header = packet[0]
-            content = packet[1:]
-
-            if header in self.listeners:
-                callbacks = self.listeners[header]
-            else:
-                callbacks = self.fallback_listeners
+            if header != last_header:
+                if batch:
+                    for callback in batch_callbacks:
+                        callback(batch)
+                    batch = []
+                last_header = header
+                callbacks = dispatch_table[header]
+                batch_callbacks = batch_dispatch_table[header]
 
+            content = memoryview(packet)[1:]
+            if batch_callbacks:
+                batch.append(content)
             for callback in callbacks:
                 callback(content)
 
+        if batch:
+            for callback in batch_callbacks:
+                callback(batch)
+
     def start_measurements(self):
         self.send_command([0x01, 0xA4])
     
@@ -0,0 +1,98 @@
+import numpy as np
+import argparse
+from timeit import default_timer
+
+from ekf_client import EKFClient, FILTER_BACKENDS
+from ekf import MultiRateExtendedKalmanFilter
+from quaternion import quat_multiply, quat_from_body_rates, quat_to_body
+
+# benchmark the filter backends on a synthetic recording
+# reports the throughput of EKFClient (samples/sec) and the orientation error of each backend
+
+# create a recording of a sensor suite which slowly tumbles
+def create_recording(duration, gyro_rate, compass_rate, gyro_bias, seed=0):
+    rng = np.random.default_rng(seed)
+
+    a_xyz_0 = np.array([0, 0, 9.81])
+    m_xyz_0 = np.array([0.3, 0, -0.4])
+    m_xyz_0 /= np.linalg.norm(m_xyz_0)
+
+    N = int(duration*gyro_rate)
+    dt = np.arange(N) / gyro_rate
+    pqr = np.stack([np.sin(0.5*dt), np.cos(0.3*dt), 0.5*np.sin(0.2*dt)], axis=1)
+
+    E = (1.0, 0.0, 0.0, 0.0)
+    quats = np.zeros((N,4))
+    for i in range(N):
+        if i > 0:
+            E = quat_multiply(E, quat_from_body_rates(*pqr[i], dt[i]-dt[i-1]))
+        quats[i] = E
+
+    a_xyz = np.array([quat_to_body(E, a_xyz_0) for E in quats])
+    m_xyz = np.array([quat_to_body(E, m_xyz_0) for E in quats])
+    a_xyz += 0.05*rng.standard_normal(a_xyz.shape)
+    m_xyz += 0.01*rng.standard_normal(m_xyz.shape)
+    pqr_measured = pqr + gyro_bias + 0.01*rng.standard_normal(pqr.shape)
+
+    # compass is sampled at a lower rate
+    compass_step = max(1, int(round(gyro_rate/compass_rate)))
+    is_compass = (np.arange(N) % compass_step) == 0
+
+    return dt, a_xyz, pqr_measured, m_xyz, is_compass, quats, a_xyz_0, m_xyz_0
+
+def run_backend(backend, recording, preintegrate):
+    dt, a_xyz, pqr, m_xyz, is_compass, quats, a_xyz_0, m_xyz_0 = recording
+
+    client = EKFClient(backend=backend)
+    if isinstance(client.ekf, MultiRateExtendedKalmanFilter):
+        client.ekf.Q = 1e-3*np.eye(4)
+    client.is_calibrating = False
+    client.a_xyz_0 = a_xyz_0.reshape((3,1))
+    client.m_xyz_0 = m_xyz_0.reshape((3,1))
+    client.preintegrate_samples = preintegrate
+
+    N = dt.shape[0]
+    a_xyz = a_xyz.reshape((N,3,1))
+    pqr = pqr.reshape((N,3,1))
+    m_xyz = m_xyz.reshape((N,3,1))
+    estimates = np.zeros((N,4))
+
+    t0 = default_timer()
+    for i in range(N):
+        client.on_gyro(dt[i], a_xyz[i], pqr[i])
+        if is_compass[i]:
+            client.on_compass(dt[i], m_xyz[i])
+        estimates[i] = client.ekf.E.ravel()
+    t1 = default_timer()
+
+    total_samples = N + np.count_nonzero(is_compass)
+    samples_per_sec = total_samples / (t1-t0)
+
+    # angle between the true and estimated orientations over the second half
+    dot = np.abs(np.sum(estimates*quats, axis=1))
+    angle = 2*np.arccos(np.clip(dot, 0, 1))
+    error_deg = np.degrees(np.mean(angle[N//2:]))
+
+    return samples_per_sec, error_deg
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--filters", nargs="+", default=list(FILTER_BACKENDS.keys()), choices=list(FILTER_BACKENDS.keys()))
+    parser.add_argument("--duration", default=30, type=float, help="Length of recording in seconds")
+    parser.add_argument("--gyro-rate", default=100, type=float, help="Gyro sample rate in Hz")
+    parser.add_argument("--compass-rate", default=15, type=float, help="Compass sample rate in Hz")
+    parser.add_argument("--gyro-bias", default=0.01, type=float, help="Gyro bias in rad/s on each axis")
+    parser.add_argument("--preintegrate", default=1, type=int, help="Number of gyro samples per predict and measure step")
+
+    args = parser.parse_args()
+
+    recording = create_recording(args.duration, args.gyro_rate, args.compass_rate, args.gyro_bias)
+
+    print(f"{'filter':<10} {'samples/sec':>12} {'error (deg)':>12}")
+    for backend in args.filters:
+        try:
+            samples_per_sec, error_deg = run_backend(backend, recording, args.preintegrate)
+        except ValueError as ex:
+            print(f"{backend:<10} {str(ex)}")
+            continue
+        print(f"{backend:<10} {samples_per_sec:>12.0f} {error_deg:>12.3f}")
@@ -1,3 +1,5 @@
+import numpy as np
+
 # Source: https://en.wikipedia.org/wiki/Consistent_Overhead_Byte_Stuffing
 # COBS: consistent overhead byte stuffing
 
@@ -68,8 +70,179 @@ def cobs_encode(data):
 
     return encode
 
+# decode a single COBS frame without its delimiter
+# each code byte is followed by a run of (code-1) data bytes which are copied in one go
+# every run except the last and those of length 254 (code 0xFF) is followed by a zero byte
+def cobs_decode_frame(frame):
+    N = len(frame)
+    decode = bytearray()
+    i = 0
+    while i < N:
+        code = frame[i]
+        if code == 0x00:
+            break
+        j = i + code
+        decode += frame[i+1:j]
+        if code != 0xFF and j < N:
+            decode.append(0x00)
+        i = j
+    return bytes(decode)
+
+# incrementally extract and decode frames from a stream of COBS encoded bytes
+# feed() can be called with any sized chunk of the stream, partial frames are kept until their delimiter arrives
+class CobsStreamDecoder:
+    def __init__(self):
+        self.buffer = bytearray()
+        # everything before this offset has already been searched for a delimiter
+        self.scan_offset = 0
+        self.total_empty_frames = 0
+
+    def clear(self):
+        self.buffer.clear()
+        self.scan_offset = 0
+
+    # add bytes from the stream and return the list of decoded packets
+    def feed(self, data):
+        buffer = self.buffer
+        buffer += data
+
+        packets = []
+        view = memoryview(buffer)
+        start = 0
+        i = buffer.find(0x00, self.scan_offset)
+        while i >= 0:
+            # padding zero bytes give empty frames
+            if i == start:
+                self.total_empty_frames += 1
+            else:
+                packets.append(cobs_decode_frame(view[start:i]))
+            start = i+1
+            i = buffer.find(0x00, start)
+        view.release()
+
+        # drop the consumed frames in one go so a backlog of frames is linear in the number of bytes
+        if start > 0:
+            del buffer[:start]
+        self.scan_offset = len(buffer)
+        return packets
+
+# decode every frame in a buffer of COBS encoded bytes at once, e.g. a memory mapped raw capture
+# frames are decoded together with numpy so the cost is a few passes over the buffer
+# returns (offsets, payload) where frame k is payload[offsets[k]:offsets[k+1]]
+# empty frames from zero padding are skipped, and bytes after the last delimiter are an incomplete frame which is ignored
+def cobs_decode_bulk(encoded):
+    encoded = np.frombuffer(encoded, dtype=np.uint8) if not isinstance(encoded, np.ndarray) else encoded
+    delims = np.flatnonzero(encoded == 0x00)
+    if len(delims) == 0:
+        return np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.uint8)
+    encoded = encoded[:delims[-1]+1]
+
+    starts = np.concatenate([[0], delims[:-1]+1])
+    ends = delims
+    is_frame = ends > starts
+    starts = starts[is_frame]
+    ends = ends[is_frame]
+
+    # follow the chain of code bytes in every frame at the same time
+    # the number of steps is the most code bytes in a single frame, which is small for our packets
+    is_code = np.zeros(len(encoded), dtype=bool)
+    # the first code byte and code bytes which follow a 0xFF code don't represent a zero byte
+    is_skipped = np.zeros(len(encoded), dtype=bool)
+    is_skipped[starts] = True
+    pos = starts
+    end = ends
+    while len(pos) > 0:
+        is_code[pos] = True
+        code = encoded[pos]
+        next_pos = pos + code
+        is_active = next_pos < end
+        pos = next_pos[is_active]
+        end = end[is_active]
+        is_skipped[pos] = code[is_active] == 0xFF
+
+    # every other code byte becomes a zero byte, the delimiters are dropped
+    is_kept = encoded != 0x00
+    is_kept &= ~is_skipped
+    payload = encoded[is_kept]
+    payload[is_code[is_kept]] = 0x00
+
+    # count the kept bytes of each frame, the empty frames and delimiters between frames have none
+    counts = np.add.reduceat(is_kept, starts, dtype=np.int64)
+    offsets = np.zeros(len(starts)+1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets, payload
+
+# decode a large capture in pieces of about chunk_size bytes so the temporary arrays stay small
+# each piece is cut just after a delimiter so no frame is split, yields (offsets, payload) for each piece
+def cobs_decode_bulk_chunks(encoded, chunk_size=1 << 24):
+    encoded = np.frombuffer(encoded, dtype=np.uint8) if not isinstance(encoded, np.ndarray) else encoded
+    N = len(encoded)
+    start = 0
+    while start < N:
+        end = min(start + chunk_size, N)
+        if end < N:
+            # extend the chunk to the next delimiter
+            delims = np.flatnonzero(encoded[end:] == 0x00)
+            end = end + delims[0] + 1 if len(delims) > 0 else N
+        yield cobs_decode_bulk(encoded[start:end])
+        start = end
+
+# encode a batch of packets into one buffer of delimited COBS frames
+# packet k is payload[offsets[k]:offsets[k+1]], this produces the same frames as cobs_encode
+def cobs_encode_bulk(offsets, payload):
+    offsets = np.asarray(offsets, dtype=np.int64)
+    payload = np.asarray(payload, dtype=np.uint8)
+    M = len(offsets)-1
+
+    # split every packet at its zero bytes into segments of non-zero bytes
+    # on ties a segment that ends a packet comes before one that starts the next packet
+    zeros = np.flatnonzero(payload == 0x00)
+    seg_starts = np.concatenate([zeros+1, offsets[:-1]])
+    seg_ends = np.concatenate([offsets[1:], zeros])
+    is_last = np.concatenate([np.ones(M, dtype=bool), np.zeros(len(zeros), dtype=bool)])
+    start_order = np.lexsort((np.concatenate([np.zeros(len(zeros)), np.ones(M)]), seg_starts))
+    end_order = np.lexsort((~is_last, seg_ends))
+    seg_starts = seg_starts[start_order]
+    seg_ends = seg_ends[end_order]
+    is_last = is_last[end_order]
+    seg_packet = np.cumsum(np.concatenate([[0], is_last[:-1]]))
+
+    # segments longer than 254 bytes are split into 0xFF blocks
+    # the final block of length zero is dropped if it is at the end of a packet
+    L = seg_ends - seg_starts
+    total_full = L // 254
+    remainder = L % 254
+    has_remainder = ~(is_last & (remainder == 0) & (total_full > 0))
+    total_blocks = total_full + has_remainder
+
+    block_seg = np.repeat(np.arange(len(L)), total_blocks)
+    seg_first_block = np.concatenate([[0], np.cumsum(total_blocks)[:-1]])
+    block_index = np.arange(len(block_seg)) - seg_first_block[block_seg]
+    block_len = np.where(block_index < total_full[block_seg], 254, remainder[block_seg])
+
+    # every block is a code byte and its data, every packet ends with a delimiter
+    block_out = np.concatenate([[0], np.cumsum(block_len+1)[:-1]]) + seg_packet[block_seg]
+    total_out = int(np.sum(block_len+1)) + M
+    encoded = np.zeros(total_out, dtype=np.uint8)
+
+    # copy the bytes into their blocks
+    # a byte moves along by the number of code bytes and delimiters written before it
+    # every packet adds a code byte and a delimiter, and a 0xFF block adds a code byte for the block after it
+    # a zero byte lands on the code byte of the next segment which is written afterwards
+    block_start = seg_starts[block_seg] + 254*block_index
+    is_split = block_index > 0
+    dst = np.bincount(
+        np.concatenate([offsets[:-1], offsets[1:-1], block_start[is_split]]),
+        minlength=len(payload)+1)[:len(payload)]
+    np.cumsum(dst, out=dst)
+    dst += np.arange(len(payload))
+    encoded[dst] = payload
+    encoded[block_out] = block_len+1
+    return encoded
+
 if __name__ == '__main__':
     print(cobs_decode([0x00]))
+    print(CobsStreamDecoder().feed(bytes([0x00, 0x03, 0x11, 0x22, 0x02, 0x33, 0x00])))
 
     # def print_test(input):
     #     output = cobs_encode(input)
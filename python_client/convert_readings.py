@@ -3,8 +3,11 @@ import numpy as np
 # convert our raw sensor measurements into their actual SI values and units
 # All our incoming sensor values are stored as quantized integers
 # We need to remove their gain and convert to floating point
+# The gain, axis remapping, sign flips and bias of each sensor are compiled into one affine transform
+# y = A@x + b, which is recompiled when a gain or the bias is assigned
 class MeasurementConverter:
     def __init__(self):
+        self.affine = None
         self.gain_magnetometer = 1090
         self.gain_accelerometer = 16384
         self.gain_gyroscope = 131
@@ -12,25 +15,81 @@ class MeasurementConverter:
         self.bias_magnetometer = np.array([0,0,0]).reshape((3,1))
         self.normalise_magnetometer = False
 
-    # m_xyz.shape: (3,N)
+    @property
+    def gain_magnetometer(self):
+        return self._gain_magnetometer
+
+    @gain_magnetometer.setter
+    def gain_magnetometer(self, gain):
+        self._gain_magnetometer = gain
+        self.affine = None
+
+    @property
+    def gain_accelerometer(self):
+        return self._gain_accelerometer
+
+    @gain_accelerometer.setter
+    def gain_accelerometer(self, gain):
+        self._gain_accelerometer = gain
+        self.affine = None
+
+    @property
+    def gain_gyroscope(self):
+        return self._gain_gyroscope
+
+    @gain_gyroscope.setter
+    def gain_gyroscope(self, gain):
+        self._gain_gyroscope = gain
+        self.affine = None
+
+    # NOTE: assign a new array instead of modifying it in place so the transform is recompiled
+    @property
+    def bias_magnetometer(self):
+        return self._bias_magnetometer
+
+    @bias_magnetometer.setter
+    def bias_magnetometer(self, bias):
+        self._bias_magnetometer = bias
+        self.affine = None
+
+    # find the (A,b) of each sensor
+    def compile(self):
+        I = np.eye(3)
+
+        # sensor axes (x,z,y) then remove the bias
+        A_m = I[[0,2,1]] / self.gain_magnetometer
+        b_m = -np.asarray(self.bias_magnetometer, dtype=float).reshape((3,1))
+
+        # sensor axes (-y,z,x)
+        A_a = I[[1,2,0]] * (9.81 / self.gain_accelerometer)
+        A_a[0] *= -1
+        b_a = np.zeros((3,1))
+
+        # sensor axes (y,-z,-x)
+        A_g = I[[1,2,0]] * ((np.pi/180) / self.gain_gyroscope)
+        A_g[[1,2]] *= -1
+        b_g = np.zeros((3,1))
+
+        self.affine = {
+            "magnetometer": (A_m, b_m),
+            "accelerometer": (A_a, b_a),
+            "gyroscope": (A_g, b_g),
+        }
+
+    def convert(self, sensor, x):
+        if self.affine is None:
+            self.compile()
+        A, b = self.affine[sensor]
+        return A @ x + b
+
+    # m_xyz.shape: (3,N), can be the raw int16 readings
     def convert_magnetometer(self, m_xyz):
-        m_xyz /= self.gain_magnetometer
-        m_xyz = m_xyz[[0,2,1]]
-        m_xyz -= self.bias_magnetometer
-        return m_xyz
+        return self.convert("magnetometer", m_xyz)
 
-    # a_xyz.shape: (3,N) 
+    # a_xyz.shape: (3,N)
     def convert_accelerometer(self, a_xyz):
-        a_xyz /= self.gain_accelerometer
-        a_xyz *= 9.81
-        a_xyz = a_xyz[[1,2,0]]
-        a_xyz[0] *= -1
-        return a_xyz
-    
-    # pqr.shape: (3,N) 
+        return self.convert("accelerometer", a_xyz)
+
+    # pqr.shape: (3,N)
     def convert_gyroscope(self, pqr):
-        pqr /= self.gain_gyroscope
-        pqr *= np.pi/180
-        pqr = pqr[[1,2,0]]
-        pqr[[1,2]] *= -1
-        return pqr
\ No newline at end of file
+        return self.convert("gyroscope", pqr)
@@ -1,13 +1,25 @@
 import numpy as np
+from quaternion import quat_right_matrix, find_observation_matrices, find_observation_jacobians
 
 # Extended kalman filter
 # We can sample measurements at different rates
 # We dynamically construct the required observation Jacobians 
 class MultiRateExtendedKalmanFilter:
     def __init__(self):
+        self.reset()
+        self.Q = 1e-2*np.eye(4)
+
+    # set the orientation back to [1,0,0,0]
+    def reset(self):
         self.E = np.array([1,0,0,0]).reshape((4,1))
         self.Pk = 1e-6*np.eye(4)
-        self.Q = 1e-2*np.eye(4)
+
+    # copy of the filter state so it can be rewound with restore_state
+    def save_state(self):
+        return (self.E.copy(), self.Pk.copy())
+
+    def restore_state(self, state):
+        self.E, self.Pk = state
 
     # Project Ek and Pk ahead using pqr measurements
     def predict(self, pqr, Ek, Pk, Ts):
@@ -27,17 +39,36 @@ class MultiRateExtendedKalmanFilter:
         Ek /= np.linalg.norm(Ek)
 
         return Ek, Pk
+
+    # Project Ek and Pk ahead using an already integrated rotation
+    # dq = delta quaternion from GyroPreintegrator, Ek*dq is the new orientation
+    # Ts = time used for the process noise, see GyroPreintegrator.noise_Ts
+    def predict_delta(self, dq, Ek, Pk, Ts):
+        e0,e1,e2,e3 = Ek.flatten()
+
+        Wk = 0.5*Ts*np.array([[-e1,-e2,-e3],[e0,-e3,e2],[e3,e0,-e1],[-e2,e1,e0]])
+        Qk = self.Q @ (Wk@Wk.T)
+
+        Fk = quat_right_matrix(dq)
+
+        Ek = Fk@Ek
+        Pk = Fk@Pk@Fk.T + Qk
+
+        Ek /= np.linalg.norm(Ek)
+
+        return Ek, Pk
     
     # update Ek and Pk based on measurements of body and external vectors
     # Vb = body vectors
     # Ve = external vectors
     # R = covariance matrix noise of measurements
     def measure(self, Vb, Ve, Ek, Pk, R):
-        hk = self.find_observation_matrix(Ek).squeeze()
-        zk_pred = np.vstack([hk@ve for ve in Ve])
+        hk = self.find_observation_matrix(Ek)
+        V = np.hstack([np.asarray(ve, dtype=float).reshape((3,1)) for ve in Ve])
+        zk_pred = (hk@V).reshape((-1,1), order='F')
 
-        Hks = [self.find_observation_jacobian(Ek, ve).squeeze() for ve in Ve]
-        Hk = np.vstack(Hks)
+        # jacobians for every external vector in one call, (k,3,4) -> (3k,4)
+        Hk = find_observation_jacobians(Ek, V.T).reshape((-1,4))
         zk = np.vstack([vb for vb in Vb])
 
         Sk = Hk@Pk@Hk.T + R
@@ -50,40 +81,57 @@ class MultiRateExtendedKalmanFilter:
 
         return Ek, Pk
 
+    # update Ek and Pk one measured axis at a time
+    # only the diagonal of R is used, so this is equivalent to measure() when R is diagonal
+    # each axis is a scalar update so no matrix inversion is needed
+    # gate = optional threshold on the normalised innovation squared (y^2/s) of each axis
+    #        axes above it are rejected as outliers, e.g. gate=9 rejects errors larger than 3 sigma
+    def measure_sequential(self, Vb, Ve, Ek, Pk, R, gate=None):
+        hk = self.find_observation_matrix(Ek)
+        V = np.hstack([np.asarray(ve, dtype=float).reshape((3,1)) for ve in Ve])
+        zk_pred = (hk@V).ravel(order='F')
+
+        Hk = find_observation_jacobians(Ek, V.T).reshape((-1,4))
+        zk = np.vstack([vb for vb in Vb]).ravel()
+        r = np.diag(R)
+
+        E0 = np.asarray(Ek, dtype=float).ravel()
+        E = E0.copy()
+        Pk = np.array(Pk, dtype=float)
+        dE = np.zeros(4)
+
+        for i in range(len(zk)):
+            h = Hk[i]
+            Ph = Pk@h
+            s = h@Ph + r[i]
+            # linearisation point stays at E0 so we correct for the updates of the previous axes
+            y = zk[i] - zk_pred[i] - h@dE
+            if gate is not None and y*y > gate*s:
+                continue
+
+            k = Ph/s
+            dE += k*y
+            Pk -= np.outer(k, Ph)
+
+        E += dE
+        E /= np.linalg.norm(E)
+
+        return E.reshape((4,1)), Pk
+
     # calculate the non-linear observation matrix for body relative (x,y,z) vector
     # C is our direction cosine matrix which we can calculate using x (our state)
     # z = h(x,e) = C(x)*e
+    # see find_observation_matrices for a whole batch of quaternions
     def find_observation_matrix(self, e):
-        e0 = e[0]
-        e1 = e[1]
-        e2 = e[2]
-        e3 = e[3]
-
-        return np.array([
-            [(e0**2+e1**2-e2**2-e3**2), 2*(e1*e2+e0*e3), 2*(e1*e3-e0*e2)],
-            [2*(e1*e2-e0*e3), (e0**2-e1**2+e2**2-e3**2), 2*(e2*e3+e0*e1)],
-            [2*(e1*e3+e0*e2), 2*(e2*e3-e0*e1), (e0**2-e1**2-e2**2+e3**2)],
-        ])
+        return find_observation_matrices(e)[0]
 
     # calculate the Jacobian of the non-linear observation function
     # where h is non-linear observation function, and H is Jacobian
     # z = h(x,v), dz/dx = H(x,v)
     # z is our body vector, v is our external vector, x is our current quaternion orientation
+    # see find_observation_jacobians for a whole batch of quaternions
     def find_observation_jacobian(self, e, v):
-        e1 = e[0]
-        e2 = e[1]
-        e3 = e[2]
-        e4 = e[3]
-
-        v1 = v[0]
-        v2 = v[0]
-        v3 = v[0]
-
-        return np.array([
-            [2*e1*v1 - 2*e3*v3 + 2*e4*v2, 2*e2*v1 + 2*e3*v2 + 2*e4*v3, 2*e2*v2 - 2*e1*v3 - 2*e3*v1, 2*e1*v2 + 2*e2*v3 - 2*e4*v1],
-            [2*e1*v2 + 2*e2*v3 - 2*e4*v1, 2*e1*v3 - 2*e2*v2 + 2*e3*v1, 2*e2*v1 + 2*e3*v2 + 2*e4*v3, 2*e3*v3 - 2*e1*v1 - 2*e4*v2],
-            [2*e1*v3 - 2*e2*v2 + 2*e3*v1, 2*e4*v1 - 2*e2*v3 - 2*e1*v2, 2*e1*v1 - 2*e3*v3 + 2*e4*v2, 2*e2*v1 + 2*e3*v2 + 2*e4*v3], 
-        ])
+        return find_observation_jacobians(e, v)[0]
 
 # Specific single rate extended kalman filter
 class ExtendedKalmanFilter(MultiRateExtendedKalmanFilter):
@@ -127,3 +175,163 @@ class LoggedExtendedKalmanFilter(ExtendedKalmanFilter):
 
         self.quats.append(Ek)
         self.Pks.append(Pk)
+
+# Same filter as MultiRateExtendedKalmanFilter without the per call allocations
+# All intermediate matrices are written into preallocated workspaces with out= arguments
+# The innovation is solved in closed form for a single (3x3) measurement instead of np.linalg.inv
+# NOTE: predict and measure return the filter's own (4,1) and (4,4) buffers, copy them if they need to be kept
+class FastMultiRateExtendedKalmanFilter(MultiRateExtendedKalmanFilter):
+    def __init__(self):
+        super().__init__()
+        self.E_buf = np.zeros((4,1))
+        self.Pk_buf = np.zeros((4,4))
+
+        # predict workspaces
+        self.Fk = np.eye(4)
+        self.Fk_flat = self.Fk.reshape(-1)
+        self.FP = np.zeros((4,4))
+        self.QE = np.zeros((4,1))
+        self.Qk = np.zeros((4,4))
+        self.Sk_inv = np.zeros((3,3))
+        self.Sk_inv_flat = self.Sk_inv.reshape(-1)
+
+        # measure workspaces for each measurement size
+        self.measure_bufs = {}
+
+    # Project Ek and Pk ahead using pqr measurements
+    def predict(self, pqr, Ek, Pk, Ts):
+        e0,e1,e2,e3 = Ek.ravel().tolist()
+        p,q,r = pqr.ravel().tolist()
+
+        # Fk = I + Ak*Ts
+        hp,hq,hr = 0.5*Ts*p, 0.5*Ts*q, 0.5*Ts*r
+        self.Fk_flat[:] = (
+            1.0, -hp, -hq, -hr,
+            hp,  1.0,  hr, -hq,
+            hq,  -hr, 1.0,  hp,
+            hr,   hq, -hp, 1.0)
+
+        # Qk = Q @ (Wk@Wk.T)
+        # The columns of Wk are orthogonal to Ek so Wk@Wk.T = (Ts/2)^2 (|Ek|^2 I - Ek Ek^T)
+        e_norm2 = e0*e0 + e1*e1 + e2*e2 + e3*e3
+        np.matmul(self.Q, Ek, out=self.QE)
+        np.multiply(self.QE, Ek.T, out=self.Qk)
+        np.multiply(self.Q, e_norm2, out=self.FP)
+        np.subtract(self.FP, self.Qk, out=self.Qk)
+        self.Qk *= 0.25*Ts*Ts
+
+        # Pk = Fk@Pk@Fk.T + Qk
+        np.matmul(self.Fk, Pk, out=self.FP)
+        np.matmul(self.FP, self.Fk.T, out=self.Pk_buf)
+        self.Pk_buf += self.Qk
+
+        # Ek = Fk@Ek
+        n0 = e0 - hp*e1 - hq*e2 - hr*e3
+        n1 = hp*e0 + e1 + hr*e2 - hq*e3
+        n2 = hq*e0 - hr*e1 + e2 + hp*e3
+        n3 = hr*e0 + hq*e1 - hp*e2 + e3
+        self.set_normalised(n0, n1, n2, n3)
+
+        return self.E_buf, self.Pk_buf
+
+    # update Ek and Pk based on measurements of body and external vectors
+    # Vb = body vectors
+    # Ve = external vectors
+    # R = covariance matrix noise of measurements
+    def measure(self, Vb, Ve, Ek, Pk, R):
+        e0,e1,e2,e3 = Ek.ravel().tolist()
+
+        # direction cosine matrix, see find_observation_matrix
+        c00 = e0*e0 + e1*e1 - e2*e2 - e3*e3
+        c01 = 2*(e1*e2 + e0*e3)
+        c02 = 2*(e1*e3 - e0*e2)
+        c10 = 2*(e1*e2 - e0*e3)
+        c11 = e0*e0 - e1*e1 + e2*e2 - e3*e3
+        c12 = 2*(e2*e3 + e0*e1)
+        c20 = 2*(e1*e3 + e0*e2)
+        c21 = 2*(e2*e3 - e0*e1)
+        c22 = e0*e0 - e1*e1 - e2*e2 + e3*e3
+
+        # innovation and observation jacobian, see find_observation_jacobian
+        yk = []
+        hk = []
+        for vb, ve in zip(Vb, Ve):
+            v1,v2,v3 = ve.ravel().tolist()
+            z1,z2,z3 = vb.ravel().tolist()
+
+            yk.append(z1 - (c00*v1 + c01*v2 + c02*v3))
+            yk.append(z2 - (c10*v1 + c11*v2 + c12*v3))
+            yk.append(z3 - (c20*v1 + c21*v2 + c22*v3))
+
+            a1,a2,a3 = 2*e0*v1, 2*e0*v2, 2*e0*v3
+            b1,b2,b3 = 2*e1*v1, 2*e1*v2, 2*e1*v3
+            c1,c2,c3 = 2*e2*v1, 2*e2*v2, 2*e2*v3
+            d1,d2,d3 = 2*e3*v1, 2*e3*v2, 2*e3*v3
+            hk.extend((
+                a1 - c3 + d2, b1 + c2 + d3, b2 - a3 - c1, a2 + b3 - d1,
+                a2 + b3 - d1, a3 - b2 + c1, b1 + c2 + d3, c3 - a1 - d2,
+                a3 - b2 + c1, d1 - b3 - a2, a1 - c3 + d2, b1 + c2 + d3,
+            ))
+
+        m = len(yk)
+        bufs = self.measure_bufs.get(m)
+        if bufs is None:
+            bufs = self.create_measure_bufs(m)
+        Hk, Hk_flat, y, PHt, Sk, Kf, KHP, dE = bufs
+
+        Hk_flat[:] = hk
+        y[:,0] = yk
+
+        # Sk = Hk@Pk@Hk.T + R
+        np.matmul(Pk, Hk.T, out=PHt)
+        np.matmul(Hk, PHt, out=Sk)
+        Sk += R
+
+        # Kf = (Pk@Hk.T)@inv(Sk)
+        if m == 3:
+            np.matmul(PHt, self.inverse_symmetric_3x3(Sk), out=Kf)
+        else:
+            Kf[:] = np.linalg.solve(Sk, PHt.T).T
+
+        # Pk = (I - Kf@Hk)@Pk = Pk - Kf@(Pk@Hk.T).T
+        np.matmul(Kf, PHt.T, out=KHP)
+        np.subtract(Pk, KHP, out=self.Pk_buf)
+
+        # Ek = Ek + Kf@(zk - zk_pred)
+        np.matmul(Kf, y, out=dE)
+        d0,d1,d2,d3 = dE.ravel().tolist()
+        self.set_normalised(e0+d0, e1+d1, e2+d2, e3+d3)
+
+        return self.E_buf, self.Pk_buf
+
+    def create_measure_bufs(self, m):
+        Hk = np.zeros((m,4))
+        bufs = (
+            Hk, Hk.reshape(-1),
+            np.zeros((m,1)),    # y
+            np.zeros((4,m)),    # Pk@Hk.T
+            np.zeros((m,m)),    # Sk
+            np.zeros((4,m)),    # Kf
+            np.zeros((4,4)),    # Kf@Hk@Pk
+            np.zeros((4,1)),    # Kf@y
+        )
+        self.measure_bufs[m] = bufs
+        return bufs
+
+    # closed form inverse of the symmetric innovation covariance
+    def inverse_symmetric_3x3(self, S):
+        (a,b,c),(_,d,e),(_,_,f) = S.tolist()
+        A = d*f - e*e
+        B = c*e - b*f
+        C = b*e - c*d
+        det = a*A + b*B + c*C
+        D = a*f - c*c
+        E = b*c - a*e
+        F = a*d - b*b
+        self.Sk_inv_flat[:] = (A,B,C, B,D,E, C,E,F)
+        self.Sk_inv /= det
+        return self.Sk_inv
+
+    def set_normalised(self, e0, e1, e2, e3):
+        n = (e0*e0 + e1*e1 + e2*e2 + e3*e3) ** 0.5
+        self.E_buf[:,0] = (e0/n, e1/n, e2/n, e3/n)
@@ -0,0 +1,114 @@
+import numpy as np
+from quaternion import find_observation_matrices, find_observation_jacobians
+
+# Batched multi rate extended kalman filter
+# Runs the same filter as MultiRateExtendedKalmanFilter for N devices at once
+# States are stacked so that E.shape = (N,4) and Pk.shape = (N,4,4)
+# Every predict/measure call takes an optional mask (N,) to skip devices without a new sample
+class BatchedMultiRateExtendedKalmanFilter:
+    def __init__(self, N):
+        self.N = N
+        self.E = np.zeros((N,4))
+        self.E[:,0] = 1
+        self.Pk = np.broadcast_to(1e-6*np.eye(4), (N,4,4)).copy()
+        self.Q = 1e-2*np.eye(4)
+
+    # Project Ek and Pk ahead using pqr measurements
+    # pqr.shape = (N,3)
+    # Ts is a scalar or Ts.shape = (N,)
+    def predict(self, pqr, Ek, Pk, Ts, mask=None):
+        idx = self.find_active(mask)
+        if idx is not None and len(idx) == 0:
+            return Ek, Pk
+
+        E, P, pqr, Ts = self.gather(idx, Ek, Pk, pqr, Ts)
+        Ts = np.asarray(Ts, dtype=float).reshape((-1,1,1))
+
+        e0,e1,e2,e3 = E.T
+        p,q,r = pqr.T
+        z = np.zeros_like(p)
+
+        Wk = 0.5*Ts*np.stack([
+            np.stack([-e1,-e2,-e3], axis=-1),
+            np.stack([ e0,-e3, e2], axis=-1),
+            np.stack([ e3, e0,-e1], axis=-1),
+            np.stack([-e2, e1, e0], axis=-1),
+        ], axis=1)
+        Ak = 0.5*np.stack([
+            np.stack([z,-p,-q,-r], axis=-1),
+            np.stack([p, z, r,-q], axis=-1),
+            np.stack([q,-r, z, p], axis=-1),
+            np.stack([r, q,-p, z], axis=-1),
+        ], axis=1)
+
+        Qk = self.Q @ (Wk @ Wk.transpose(0,2,1))
+
+        Fk = Ak*Ts
+        Fk += np.eye(4)
+
+        E = (Fk @ E[...,None])[...,0]
+        P = Fk @ P @ Fk.transpose(0,2,1) + Qk
+
+        E /= np.linalg.norm(E, axis=1, keepdims=True)
+
+        return self.scatter(idx, Ek, Pk, E, P)
+
+    # update Ek and Pk based on measurements of body and external vectors
+    # Vb = body vectors, each with shape (N,3)
+    # Ve = external vectors, each with shape (N,3) or (3,) if shared by all devices
+    # R = covariance matrix noise of measurements, shape (3k,3k) or (N,3k,3k)
+    def measure(self, Vb, Ve, Ek, Pk, R, mask=None):
+        idx = self.find_active(mask)
+        if idx is not None and len(idx) == 0:
+            return Ek, Pk
+
+        E, P = Ek, Pk
+        if idx is not None:
+            E, P = Ek[idx], Pk[idx]
+            Vb = [np.asarray(vb)[idx] for vb in Vb]
+            Ve = [np.asarray(ve) if np.ndim(ve) == 1 else np.asarray(ve)[idx] for ve in Ve]
+            if np.ndim(R) == 3:
+                R = R[idx]
+
+        hk = find_observation_matrices(E)
+        zk_pred = np.concatenate([(hk @ np.asarray(ve)[...,None])[...,0] for ve in Ve], axis=1)
+
+        Hk = np.concatenate([find_observation_jacobians(E, ve) for ve in Ve], axis=1)
+        zk = np.concatenate([np.asarray(vb) for vb in Vb], axis=1)
+
+        HkT = Hk.transpose(0,2,1)
+        PHkT = P @ HkT
+        Sk = Hk @ PHkT + R
+        # Kf = Pk Hk^T Sk^-1, Sk and Pk are symmetric so solve for Kf^T instead
+        Kf = np.linalg.solve(Sk, PHkT.transpose(0,2,1)).transpose(0,2,1)
+
+        E = E + (Kf @ (zk - zk_pred)[...,None])[...,0]
+        P = P - Kf @ Hk @ P
+
+        E /= np.linalg.norm(E, axis=1, keepdims=True)
+
+        return self.scatter(idx, Ek, Pk, E, P)
+
+    # indices of devices to update, or None if all of them are active
+    def find_active(self, mask):
+        if mask is None:
+            return None
+        return np.flatnonzero(mask)
+
+    def gather(self, idx, Ek, Pk, pqr, Ts):
+        pqr = np.asarray(pqr)
+        if idx is None:
+            return Ek, Pk, pqr, Ts
+        if np.ndim(Ts) > 0:
+            Ts = np.asarray(Ts)[idx]
+        return Ek[idx], Pk[idx], pqr[idx], Ts
+
+    # write back the updated devices without touching the skipped ones
+    def scatter(self, idx, Ek, Pk, E, P):
+        if idx is None:
+            return E, P
+        Ek = Ek.copy()
+        Pk = Pk.copy()
+        Ek[idx] = E
+        Pk[idx] = P
+        return Ek, Pk
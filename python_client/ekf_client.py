@@ -1,10 +1,27 @@
-from ekf import MultiRateExtendedKalmanFilter
+from ekf import MultiRateExtendedKalmanFilter, FastMultiRateExtendedKalmanFilter
+from mekf import MultiplicativeExtendedKalmanFilter
+from mahony import MahonyFilter
+from gyro_preintegration import GyroPreintegrator
+from filter_history import FilterHistory
 import numpy as np
 
+# filters which can be run by the client
+# a backend holds its orientation quaternion in E (4,1) and its covariance in Pk (or None)
+# and provides reset(), find_observation_matrix(E),
+# predict(pqr, Ek, Pk, Ts) -> (Ek, Pk) and measure(Vb, Ve, Ek, Pk, R) -> (Ek, Pk)
+# save_state() and restore_state(state) are needed to reorder late measurements
+# measure_sequential() and predict_delta() are optional, enabling a mode that needs one raises a ValueError
+FILTER_BACKENDS = {
+    "ekf": MultiRateExtendedKalmanFilter,
+    "fast-ekf": FastMultiRateExtendedKalmanFilter,
+    "mekf": MultiplicativeExtendedKalmanFilter,
+    "mahony": MahonyFilter,
+}
+
 # add calibration support for multirate extended kalman filter
 class EKFClient:
-    def __init__(self, use_paired_measurements=False):
-        self.ekf = MultiRateExtendedKalmanFilter()
+    def __init__(self, use_paired_measurements=False, ekf=None, backend="ekf"):
+        self.ekf = ekf if ekf is not None else FILTER_BACKENDS[backend]()
         self.last_gyro_dt = None
         self.last_dt = 0
 
@@ -25,6 +42,21 @@ class EKFClient:
         self.Ra = 0.1*np.eye(3)
         self.Rm = 0.01*np.eye(3)
 
+        # process each measured axis as a scalar update, this only uses the diagonals of Ra and Rm
+        # the gate rejects individual axes whose normalised innovation squared is above it
+        self.use_sequential_measurements = False
+        self.measurement_gate = None
+
+        # collapse this many gyro samples into one predict and measure step
+        # 1 runs a predict and measure for every gyro sample
+        self.gyro_integrator = GyroPreintegrator(1)
+
+        # compass and gyro packets can arrive out of order
+        # if we keep a history of the last few filter states, a late measurement is applied
+        # at its own timestamp and the newer measurements are replayed on top of it
+        # history_length = 0 applies measurements in the order they arrive
+        self.history = None
+
         # our magnetometer has some bias
         # this means as we rotate the sensor the magnitude of the magnetometer may change
         # we can normalise this so that our ekf doesn't break when it changes
@@ -60,13 +92,93 @@ class EKFClient:
         self.calib_a_xyz_buf = []
         self.calib_pqr_buf = []
 
-        self.ekf.E  = np.array([1,0,0,0]).reshape((4,1))
-        self.ekf.Pk = 1e-6*np.eye(4)
+        self.ekf.reset()
+        self.gyro_integrator.reset()
+        if self.history is not None:
+            self.history.clear()
 
         # ignore the first gyro reading after calibration
         # since we might not have an accurate Ts
         self.last_gyro_dt = None
     
+    # update the filter with body and external vector pairs
+    def measure(self, Vb, Ve, Ek, Pk, R):
+        if self.use_sequential_measurements:
+            return self.ekf.measure_sequential(Vb, Ve, Ek, Pk, R, gate=self.measurement_gate)
+        return self.ekf.measure(Vb, Ve, Ek, Pk, R)
+
+    @property
+    def use_sequential_measurements(self):
+        return self._use_sequential_measurements
+
+    @use_sequential_measurements.setter
+    def use_sequential_measurements(self, is_sequential):
+        if is_sequential and not hasattr(self.ekf, "measure_sequential"):
+            raise ValueError(f"{type(self.ekf).__name__} does not support sequential measurements")
+        self._use_sequential_measurements = is_sequential
+
+    @property
+    def preintegrate_samples(self):
+        return self.gyro_integrator.total_samples
+
+    @preintegrate_samples.setter
+    def preintegrate_samples(self, total_samples):
+        if total_samples > 1 and not hasattr(self.ekf, "predict_delta"):
+            raise ValueError(f"{type(self.ekf).__name__} does not support gyro preintegration")
+        self.flush_gyro()
+        self.gyro_integrator.total_samples = total_samples
+
+    @property
+    def history_length(self):
+        return 0 if self.history is None else self.history.length
+
+    @history_length.setter
+    def history_length(self, length):
+        self.history = FilterHistory(length) if length > 0 else None
+
+    def save_state(self):
+        return (self.ekf.save_state(), self.gyro_integrator.save_state(),
+                self.last_gyro_dt, self.a_xyz_stored, self.m_xyz_stored)
+
+    def restore_state(self, state):
+        ekf_state, integrator_state, self.last_gyro_dt, self.a_xyz_stored, self.m_xyz_stored = state
+        self.ekf.restore_state(ekf_state)
+        self.gyro_integrator.restore_state(integrator_state)
+
+    def apply(self, kind, dt, data):
+        if kind == FilterHistory.GYRO:
+            self.update_gyro(dt, np.array(data[:3]).reshape((3,1)), np.array(data[3:6]).reshape((3,1)))
+        else:
+            self.update_compass(np.array(data[:3]).reshape((3,1)))
+
+    # rewind to the state before a late measurement, apply it, then replay the newer measurements
+    def insert_late(self, kind, dt, data):
+        history = self.history
+        i = history.find_insert_position(dt)
+        # too old to rewind to, so apply it to the current state
+        if i is None:
+            history.total_too_late += 1
+            self.apply(kind, dt, data)
+            return
+
+        history.total_reordered += 1
+        self.restore_state(history.get(i-1)[3])
+        self.apply(kind, dt, data)
+        i = history.insert(i, kind, dt, data, self.save_state())
+
+        for k in range(i+1, history.count):
+            kind_k, dt_k, data_k, _ = history.get(k)
+            self.apply(kind_k, dt_k, data_k)
+            history.states[history.index(k)] = self.save_state()
+
+    # apply any gyro samples that are still accumulated in the preintegrator
+    def flush_gyro(self):
+        integrator = self.gyro_integrator
+        if integrator.is_empty:
+            return
+        self.ekf.E, self.ekf.Pk = self.ekf.predict_delta(integrator.dq, self.ekf.E, self.ekf.Pk, integrator.noise_Ts)
+        integrator.reset()
+
     def on_compass(self, dt, m_xyz):
         m_xyz = np.array(m_xyz).reshape((3,1))
         if self.normalise_magnetometer:
@@ -77,16 +189,30 @@ class EKFClient:
             self.calib_m_xyz_buf.append(m_xyz)
             return
 
-        
+        if self.history is None:
+            self.update_compass(m_xyz)
+            return
+
+        data = m_xyz.ravel()
+        if self.history.is_late(dt):
+            self.insert_late(FilterHistory.COMPASS, dt, data)
+            return
+
+        self.update_compass(m_xyz)
+        self.history.push(FilterHistory.COMPASS, dt, data, self.save_state())
+
+    def update_compass(self, m_xyz):
         self.m_xyz_stored = m_xyz
+        # bring our orientation up to date before using the compass
+        self.flush_gyro()
 
         if self.use_paired_measurements and self.a_xyz_stored is not None:
             z = np.zeros((3,3))
             R = np.block([[self.Rm, z], [z, self.Ra]])
-            Ek, Pk = self.ekf.measure([m_xyz, self.a_xyz_stored], [self.m_xyz_0, self.a_xyz_0], self.ekf.E, self.ekf.Pk, R)
+            Ek, Pk = self.measure([m_xyz, self.a_xyz_stored], [self.m_xyz_0, self.a_xyz_0], self.ekf.E, self.ekf.Pk, R)
         else:
             R = self.Rm
-            Ek, Pk = self.ekf.measure([m_xyz], [self.m_xyz_0], self.ekf.E, self.ekf.Pk, R)
+            Ek, Pk = self.measure([m_xyz], [self.m_xyz_0], self.ekf.E, self.ekf.Pk, R)
 
         self.ekf.E = Ek
         self.ekf.Pk = Pk
@@ -105,28 +231,55 @@ class EKFClient:
             self.calib_pqr_buf.append(pqr)
             return 
 
+        if self.history is None:
+            self.update_gyro(dt, a_xyz, pqr)
+            return
+
+        data = np.concatenate([a_xyz.ravel(), pqr.ravel()])
+        if self.history.is_late(dt):
+            self.insert_late(FilterHistory.GYRO, dt, data)
+            return
+
+        self.update_gyro(dt, a_xyz, pqr)
+        self.history.push(FilterHistory.GYRO, dt, data, self.save_state())
+
+    # apply a block of measurements parsed from a single read, in order
+    # dt.shape = (N,), a_xyz.shape = pqr.shape = m_xyz.shape = (N,3)
+    def on_gyro_batch(self, dt, a_xyz, pqr):
+        a_xyz = np.asarray(a_xyz).reshape((-1,3,1))
+        pqr = np.asarray(pqr).reshape((-1,3,1))
+        for i, dt_i in enumerate(np.asarray(dt).tolist()):
+            self.on_gyro(dt_i, a_xyz[i], pqr[i])
+
+    def on_compass_batch(self, dt, m_xyz):
+        m_xyz = np.asarray(m_xyz).reshape((-1,3,1))
+        for i, dt_i in enumerate(np.asarray(dt).tolist()):
+            self.on_compass(dt_i, m_xyz[i])
+
+    def update_gyro(self, dt, a_xyz, pqr):
         Ts = dt-self.last_gyro_dt
         self.last_gyro_dt = dt
         
         pqr = pqr - self.pqr_0
 
-        Ek, Pk = self.ekf.predict(pqr, self.ekf.E, self.ekf.Pk, Ts)
-
         self.a_xyz_stored = a_xyz
 
+        integrator = self.gyro_integrator
+        if integrator.total_samples <= 1:
+            Ek, Pk = self.ekf.predict(pqr, self.ekf.E, self.ekf.Pk, Ts)
+        elif integrator.add(pqr, Ts):
+            self.flush_gyro()
+            Ek, Pk = self.ekf.E, self.ekf.Pk
+        else:
+            return
+
         if self.use_paired_measurements and self.m_xyz_stored is not None:
             z = np.zeros((3,3))
             R = np.block([[self.Ra, z], [z, self.Rm]])
-            Ek, Pk = self.ekf.measure([a_xyz, self.m_xyz_stored], [self.a_xyz_0, self.m_xyz_0], Ek, Pk, R)
+            Ek, Pk = self.measure([a_xyz, self.m_xyz_stored], [self.a_xyz_0, self.m_xyz_0], Ek, Pk, R)
         else:
             R = self.Ra
-            Ek, Pk = self.ekf.measure([a_xyz], [self.a_xyz_0], Ek, Pk, R)
+            Ek, Pk = self.measure([a_xyz], [self.a_xyz_0], Ek, Pk, R)
         
         self.ekf.E = Ek
         self.ekf.Pk = Pk
-
-        
-
-
-
-
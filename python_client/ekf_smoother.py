@@ -0,0 +1,99 @@
+import numpy as np
+from ekf import FastMultiRateExtendedKalmanFilter
+
+# Offline extended kalman filter and Rauch-Tung-Striebel smoother for a whole recording
+# The forward pass is the same filter as ExtendedKalmanFilter (combined accelerometer and compass update)
+# but it writes every step into preallocated (N,4) and (N,4,4) arrays instead of python lists
+# The backward pass then uses the whole recording to produce the smoothed (non-causal) quaternions
+class ExtendedKalmanSmoother:
+    def __init__(self):
+        self.ekf = FastMultiRateExtendedKalmanFilter()
+        self.a_xyz_0 = None
+        self.m_xyz_0 = None
+        self.R = np.diag([0.1,0.1,0.1,0.05,0.05,0.05])
+        self.E0 = np.array([1,0,0,0], dtype=float).reshape((4,1))
+        self.Pk0 = 1e-6*np.eye(4)
+
+    @property
+    def Q(self):
+        return self.ekf.Q
+
+    @Q.setter
+    def Q(self, Q):
+        self.ekf.Q = Q
+
+    # run the forward filter over the recording
+    # dt.shape = (N,), a_xyz.shape = pqr.shape = m_xyz.shape = (N,3)
+    # Ts0 = time step of the first sample, defaults to the mean time step
+    # measure_step = False only integrates the gyro
+    def filter(self, dt, a_xyz, pqr, m_xyz, Ts0=None, measure_step=True):
+        dt = np.asarray(dt, dtype=float)
+        N = dt.shape[0]
+
+        Ts = np.empty(N)
+        Ts[1:] = dt[1:]-dt[:-1]
+        Ts[0] = Ts0 if Ts0 is not None else np.mean(Ts[1:])
+
+        # the state transition only depends on the body rates so we can find all of them at once
+        # Fk = I + Ak*Ts
+        p,q,r = (0.5*Ts[:,None]*np.asarray(pqr, dtype=float)).T
+        z = np.zeros(N)
+        self.Fks = np.stack([
+            np.stack([z,-p,-q,-r], axis=-1),
+            np.stack([p, z, r,-q], axis=-1),
+            np.stack([q,-r, z, p], axis=-1),
+            np.stack([r, q,-p, z], axis=-1),
+        ], axis=1)
+        self.Fks += np.eye(4)
+
+        self.quats_pred = np.zeros((N,4))
+        self.Pks_pred = np.zeros((N,4,4))
+        self.quats = np.zeros((N,4))
+        self.Pks = np.zeros((N,4,4))
+
+        pqr = np.asarray(pqr, dtype=float).reshape((N,3,1))
+        if measure_step:
+            Vbs = np.concatenate([a_xyz, m_xyz], axis=1).astype(float).reshape((N,2,3,1))
+            Ve = [self.a_xyz_0, self.m_xyz_0]
+
+        ekf = self.ekf
+        Ek, Pk = self.E0, self.Pk0
+        for i in range(N):
+            Ek, Pk = ekf.predict(pqr[i], Ek, Pk, Ts[i])
+            self.quats_pred[i] = Ek[:,0]
+            self.Pks_pred[i] = Pk
+
+            if measure_step:
+                Ek, Pk = ekf.measure(Vbs[i], Ve, Ek, Pk, self.R)
+
+            self.quats[i] = Ek[:,0]
+            self.Pks[i] = Pk
+
+        return self.quats
+
+    # run the backward Rauch-Tung-Striebel pass over the output of filter()
+    # xs[k] = x[k] + G[k](xs[k+1] - x_pred[k+1])
+    # Ps[k] = P[k] + G[k](Ps[k+1] - P_pred[k+1])G[k]^T
+    # where G[k] = P[k] F[k+1]^T inv(P_pred[k+1])
+    def smooth(self, covariance=True):
+        N = self.quats.shape[0]
+
+        # all of the gains can be found in one batch
+        # P_pred is symmetric so we solve P_pred[k+1] G[k]^T = F[k+1] P[k]
+        FP = self.Fks[1:] @ self.Pks[:-1]
+        G = np.linalg.solve(self.Pks_pred[1:], FP).transpose(0,2,1)
+
+        self.quats_smooth = np.zeros((N,4))
+        self.quats_smooth[-1] = self.quats[-1]
+
+        if covariance:
+            self.Pks_smooth = np.zeros((N,4,4))
+            self.Pks_smooth[-1] = self.Pks[-1]
+
+        for k in range(N-2, -1, -1):
+            self.quats_smooth[k] = self.quats[k] + G[k] @ (self.quats_smooth[k+1] - self.quats_pred[k+1])
+            if covariance:
+                self.Pks_smooth[k] = self.Pks[k] + G[k] @ (self.Pks_smooth[k+1] - self.Pks_pred[k+1]) @ G[k].T
+
+        self.quats_smooth /= np.linalg.norm(self.quats_smooth, axis=1, keepdims=True)
+        return self.quats_smooth
@@ -0,0 +1,42 @@
+import numpy as np
+
+# merge any number of sensor streams into the order their measurements are applied to a filter
+# instead of a list of events holding the rows, the order is kept as (kind, index) pairs
+# where kind = position of the stream in the list given and index = row within that stream
+EVENT_DTYPE = np.dtype([
+    ('kind', 'u1'),
+    ('index', '<i8'),
+])
+
+# times = list of timestamp arrays (one per stream), each sorted in time
+# streams given first go first on equal timestamps
+# returns an array of EVENT_DTYPE ordered by time
+def create_event_order(times):
+    times = [np.asarray(t).ravel() for t in times]
+    if len(times) > 256:
+        raise ValueError(f"Too many streams ({len(times)}), at most 256 are supported")
+
+    counts = np.array([len(t) for t in times], dtype=np.int64)
+    offsets = np.cumsum(counts) - counts
+    # a stable sort keeps the rows of each stream in order and breaks ties by stream
+    order = np.argsort(np.concatenate(times), kind='stable')
+
+    events = np.empty(len(order), dtype=EVENT_DTYPE)
+    kinds = np.repeat(np.arange(len(times), dtype=np.uint8), counts)[order]
+    events['kind'] = kinds
+    events['index'] = order - offsets[kinds]
+    return events
+
+# yields (kind, start, end) for each run of consecutive events from the same stream
+# the events of a run are the rows start:end of that stream, so they can be given to a batched update at once
+def iter_event_runs(events):
+    if len(events) == 0:
+        return
+    kinds = events['kind']
+    bounds = np.flatnonzero(kinds[1:] != kinds[:-1]) + 1
+    starts = np.concatenate([[0], bounds])
+    ends = np.concatenate([bounds, [len(events)]])
+    run_kinds = kinds[starts].tolist()
+    run_starts = events['index'][starts].tolist()
+    run_ends = (events['index'][ends-1] + 1).tolist()
+    yield from zip(run_kinds, run_starts, run_ends)
@@ -0,0 +1,91 @@
+import numpy as np
+
+# Fixed size history of the last few measurements given to the filter
+# Each entry holds the device timestamp, the measurement and the filter state after it was applied
+# When a measurement arrives late we can rewind to the state just before its timestamp,
+# apply it, then replay the measurements that came after it
+class FilterHistory:
+    GYRO = 0
+    COMPASS = 1
+
+    # length = total number of measurements we can rewind over
+    def __init__(self, length):
+        self.length = length
+        self.dts = np.zeros(length)
+        self.kinds = np.zeros(length, dtype=np.uint8)
+        self.datas = np.zeros((length, 6))
+        self.states = [None for _ in range(length)]
+
+        # entries are stored in a ring buffer starting at self.start
+        self.start = 0
+        self.count = 0
+
+        # measurements that were older than the whole history
+        self.total_too_late = 0
+        self.total_reordered = 0
+
+    def clear(self):
+        self.start = 0
+        self.count = 0
+        self.states = [None for _ in range(self.length)]
+
+    def index(self, i):
+        return (self.start + i) % self.length
+
+    @property
+    def last_dt(self):
+        if self.count == 0:
+            return None
+        return self.dts[self.index(self.count-1)]
+
+    # a measurement is late if it is older than the newest one we have applied
+    def is_late(self, dt):
+        return self.count > 0 and dt < self.last_dt
+
+    # add the newest measurement
+    def push(self, kind, dt, data, state):
+        if self.count == self.length:
+            self.start = self.index(1)
+            self.count -= 1
+        self.set(self.count, kind, dt, data, state)
+        self.count += 1
+
+    def set(self, i, kind, dt, data, state):
+        j = self.index(i)
+        self.dts[j] = dt
+        self.kinds[j] = kind
+        self.datas[j,:len(data)] = data
+        self.states[j] = state
+
+    def get(self, i):
+        j = self.index(i)
+        return self.kinds[j], self.dts[j], self.datas[j], self.states[j]
+
+    # find where a late measurement belongs, which is after every entry at or before dt
+    # returns None if it is older than the oldest entry since we can't rewind that far
+    def find_insert_position(self, dt):
+        i = self.count
+        while i > 0 and self.dts[self.index(i-1)] > dt:
+            i -= 1
+        if i == 0:
+            return None
+        return i
+
+    # make room for an entry at position i by shifting the newer entries along
+    # the oldest entry is dropped if the history is full
+    # returns the position the entry ended up at
+    def insert(self, i, kind, dt, data, state):
+        if self.count == self.length:
+            self.start = self.index(1)
+            self.count -= 1
+            i -= 1
+        for k in range(self.count, i, -1):
+            src = self.index(k-1)
+            dst = self.index(k)
+            self.dts[dst] = self.dts[src]
+            self.kinds[dst] = self.kinds[src]
+            self.datas[dst] = self.datas[src]
+            self.states[dst] = self.states[src]
+        self.count += 1
+        self.set(i, kind, dt, data, state)
+        return i
@@ -0,0 +1,41 @@
+from quaternion import quat_multiply, quat_from_body_rates
+
+# accumulate several gyro samples into one delta quaternion
+# this lets us do a single ekf predict for K gyro samples
+# each sample is integrated with the exact exponential map instead of Fk = I + Ak*Ts
+class GyroPreintegrator:
+    def __init__(self, total_samples=1):
+        self.total_samples = total_samples
+        self.reset()
+
+    def reset(self):
+        self.dq = (1.0, 0.0, 0.0, 0.0)
+        self.count = 0
+        self.Ts = 0.0
+        self.Ts_sq = 0.0
+
+    def save_state(self):
+        return (self.dq, self.count, self.Ts, self.Ts_sq)
+
+    def restore_state(self, state):
+        self.dq, self.count, self.Ts, self.Ts_sq = state
+
+    # add the rotation for a pqr sample held over Ts
+    # returns True once enough samples are accumulated to run a predict
+    def add(self, pqr, Ts):
+        p,q,r = pqr.ravel().tolist()
+        self.dq = quat_multiply(self.dq, quat_from_body_rates(p, q, r, Ts))
+        self.count += 1
+        self.Ts += Ts
+        self.Ts_sq += Ts*Ts
+        return self.count >= self.total_samples
+
+    @property
+    def is_empty(self):
+        return self.count == 0
+
+    # our process noise scales with Ts^2 for every predict
+    # so K predicts of Ts_i are equivalent to a single predict with sqrt(sum(Ts_i^2))
+    @property
+    def noise_Ts(self):
+        return self.Ts_sq ** 0.5
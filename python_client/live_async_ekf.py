@@ -1,21 +1,25 @@
 import asyncio
 import os
 import numpy as np
-import pandas as pd
 import argparse
 import serial
 from pynput.keyboard import Key, Listener
 
-import struct
 import traceback
 from timeit import default_timer
 
 from async_serial_client import AsyncSerialClient
+from serial_transport import SERIAL_TRANSPORTS
 from async_i2c import AsyncI2C
+from measurement_packets import MeasurementPacketListener, GYRO_COLUMNS, COMPASS_COLUMNS
+from session_recorder import SessionRecorder, find_free_index, CHUNK_WRITERS
+from raw_capture import RawCaptureWriter
 from async_mpu6050 import MPU6050
 from async_gy271 import GY271
+from register_shadow import save_register_snapshots, load_register_snapshots
 
-from ekf_client import EKFClient
+from ekf import MultiRateExtendedKalmanFilter
+from ekf_client import EKFClient, FILTER_BACKENDS
 from cube_renderer import CubeRenderer
 from convert_readings import MeasurementConverter
 
@@ -34,7 +38,7 @@ class HookedListener:
             print("Stopping measurements")
             self.async_serial.stop_measurements()
         elif key == Key.f12:
-            self.async_serial.is_running = False
+            self.async_serial.stop()
             print("Force closing the serial task")
         elif key == Key.f6:
             if not self.ekf_client.is_calibrating:
@@ -47,45 +51,6 @@ class HookedListener:
                 self.ekf_client.set_calibrate(False)
                 print("End calibration")
 
-# attach measurement listeners
-class MeasurementPacketListener:
-    def __init__(self, ekf_client, ekf_converter):
-        self.ekf_converter = ekf_converter
-        self.ekf_client = ekf_client
-    
-        self.compass_data = []
-        self.gyro_data = []
-    
-    def on_compass_packet(self, packet):
-        if len(packet) != 10:
-            print(f"Unknown compass packet: {packet}")
-            return        
-        
-        dt_us = struct.unpack("<L", bytes(packet[0:4]))[0]
-        x,y,z = struct.unpack(">hhh", bytes(packet[4:10]))
-
-        dt = dt_us * 1e-6
-        m_xyz = np.array((x,y,z), dtype=np.float32).reshape((3,1))
-        m_xyz = self.ekf_converter.convert_magnetometer(m_xyz)
-        self.ekf_client.on_compass(dt, m_xyz)
-        self.compass_data.append((dt,*m_xyz.flatten()))
-
-    def on_gyro_packet(self, packet):
-        if len(packet) != 18:
-            print(f"Unknown gyro packet: {packet}")
-            return
-
-        dt_us = struct.unpack("<L", bytes(packet[0:4]))[0]
-        ax,ay,az,temp,p,q,r = struct.unpack(">hhhhhhh", bytes(packet[4:18]))
-
-        dt = dt_us * 1e-6
-        a_xyz = np.array((ax,ay,az), dtype=np.float32).reshape((3,1))
-        pqr = np.array((p,q,r), dtype=np.float32).reshape((3,1))
-        a_xyz = self.ekf_converter.convert_accelerometer(a_xyz)
-        pqr = self.ekf_converter.convert_gyroscope(pqr)
-        self.ekf_client.on_gyro(dt, a_xyz, pqr)
-        self.gyro_data.append((dt, *a_xyz.flatten(), *pqr.flatten()))
-
 # print out details of an invalid packet
 def on_invalid_packet(packet):
     n = packet[0]
@@ -95,42 +60,34 @@ def on_invalid_packet(packet):
     print(f"[!] Invalid packet (len={n:d}) {content_hex} ")
     print(f"    ASCII: {content_ascii} ")
 
-def export_data(compass_data, gyro_data, args):
-    print(f"Recorded entries: gyro={len(gyro_data)}, compass={len(compass_data)}")
-
-    if len(gyro_data) == 0 and len(compass_data) == 0:
-        exit(1)
-
-    if len(gyro_data) >= 2:
-        total_us = gyro_data[-1][0] - gyro_data[0][0]
-        Ts_ms = (total_us/len(gyro_data)) * 1e3
-        print(f"Gyro sampled at avg of Ts={Ts_ms:.2f}ms")
-
-    if len(compass_data) >= 2:
-        total_us = compass_data[-1][0] - compass_data[0][0]
-        Ts_ms = (total_us/len(compass_data)) * 1e3
-        print(f"Compass sampled at avg of Ts={Ts_ms:.2f}ms")
-
-    # find available filename
+# find available filename or use the overriden index
+def create_recorder(args):
+    sensors = {"gyro": GYRO_COLUMNS, "compass": COMPASS_COLUMNS}
     if args.override is None:
-        i = 0
-        while True:
-            gyro_out_filename    = args.output.format(sensor='gyro', i=i)
-            compass_out_filename = args.output.format(sensor='compass', i=i)
-            if not os.path.exists(gyro_out_filename) and not os.path.exists(compass_out_filename):
-                break
-            i += 1
-    # override filename
+        i = find_free_index(args.output, sensors)
     else:
-        gyro_out_filename    = args.output.format(sensor='gyro', i=args.override)
-        compass_out_filename = args.output.format(sensor='compass', i=args.override)
+        i = args.override
+
+    rotate_bytes = None if args.rotate_mb is None else int(args.rotate_mb * (1 << 20))
+    rotate_seconds = None if args.rotate_minutes is None else args.rotate_minutes*60
+    return SessionRecorder(
+        args.output, sensors, i=i, chunk_rows=args.chunk_rows,
+        rotate_bytes=rotate_bytes, rotate_seconds=rotate_seconds)
 
-    # save files
-    gyro_df = pd.DataFrame(gyro_data, columns=['dt (s)', 'Ax (ms-2)', 'Ay (ms-2)', 'Az (ms-2)', 'p (rads-1)', 'q (rads-1)', 'r (rads-1)'])
-    compass_df = pd.DataFrame(compass_data, columns=['dt (s)', 'Mx (Gauss)', 'My (Gauss)', 'Mz (Gauss)'])
+def print_recording_stats(recorder):
+    total_rows = recorder.total_rows
+    print(f"Recorded entries: gyro={total_rows['gyro']}, compass={total_rows['compass']}")
 
-    gyro_df.to_csv(gyro_out_filename, index=None)
-    compass_df.to_csv(compass_out_filename, index=None)
+    for sensor in recorder.sensors:
+        if recorder.total_dropped_rows[sensor] > 0:
+            print(f"Dropped {recorder.total_dropped_rows[sensor]} {sensor} entries because the disk couldn't keep up")
+        if total_rows[sensor] >= 2:
+            total_time = recorder.last_time[sensor] - recorder.first_time[sensor]
+            Ts_ms = (total_time/total_rows[sensor]) * 1e3
+            print(f"{sensor.capitalize()} sampled at avg of Ts={Ts_ms:.2f}ms")
+
+    for filename in recorder.filenames:
+        print(f"Saved {filename}")
 
 # on a separate async task, take readings from ekf and update cube render
 async def thread_data_bus(async_serial, cube_renderer, ekf_client):
@@ -139,7 +96,7 @@ async def thread_data_bus(async_serial, cube_renderer, ekf_client):
         Erot = E.copy()
         Erot[1:,:] *= -1
         # print("\r{0:3.2f} {1:3.2f} {2:3.2f} {3:3.2f}".format(*E.flatten()), end='')
-        rotm = ekf_client.ekf.find_observation_matrix(Erot).squeeze()
+        rotm = ekf_client.ekf.find_observation_matrix(Erot)
         cube_renderer.rotation_matrix = rotm
         await asyncio.sleep(0.01)
     cube_renderer.is_running = False
@@ -149,18 +106,23 @@ async def main(args):
     ser = serial.Serial()
     ser.baudrate = args.baudrate
     ser.port = args.port
-    async_serial = AsyncSerialClient(ser)
+    capture = RawCaptureWriter(args.capture) if args.capture is not None else None
+    async_serial = AsyncSerialClient(ser, transport=args.transport, capture=capture)
 
     # measurement and ekf
-    ekf_client = EKFClient()
-    ekf_client.ekf.Q = 1e-3*np.eye(4)
+    ekf_client = EKFClient(backend=args.filter)
+    if isinstance(ekf_client.ekf, MultiRateExtendedKalmanFilter):
+        ekf_client.ekf.Q = 1e-3*np.eye(4)
     ekf_client.Ra = 1e-1*np.eye(3)
     ekf_client.Rm = 1e-1*np.eye(3)
     ekf_client.use_paired_measurements = False
+    ekf_client.preintegrate_samples = args.preintegrate
+    ekf_client.history_length = args.history
     ekf_client.is_calibrating = False
     ekf_converter = MeasurementConverter()
     ekf_converter.bias_magnetometer = np.array([-0.1, 0.05, 0]).reshape((3,1))
-    measurement_packet_listener = MeasurementPacketListener(ekf_client, ekf_converter)
+    recorder = create_recorder(args)
+    measurement_packet_listener = MeasurementPacketListener(ekf_client, ekf_converter, recorder)
 
     # i2c bus for configuration
     async_i2c = AsyncI2C(async_serial)
@@ -170,8 +132,8 @@ async def main(args):
     # attach packet listeners
     # async_serial.listen_header(0xFF, lambda d: print(f"[*] Alive packet ({d[0]:02X})"))
     async_serial.listen_header(0x02, lambda d: print(f"[C] Device not ready ({d[0]:02X})"))
-    async_serial.listen_header(0x01, measurement_packet_listener.on_compass_packet)
-    async_serial.listen_header(0x03, measurement_packet_listener.on_gyro_packet)
+    async_serial.listen_header_batch(0x01, measurement_packet_listener.on_compass_packets)
+    async_serial.listen_header_batch(0x03, measurement_packet_listener.on_gyro_packets)
     async_serial.listen_header(0x04, lambda d: print(f"[*] Start ACK"))
     async_serial.listen_header(0x05, lambda d: print(f"[*] STOP ACK"))
     async_serial.listen_header(0x06, on_invalid_packet)
@@ -183,25 +145,41 @@ async def main(args):
 
     async def setup_imu():
         dt0 = default_timer()
-        # setup our gyro and accelerometer
-        async def send_fetch_config(send_coro, fetch_coro):
-            await send_coro
-            res = await fetch_coro
-            return res
-
-        tasks = []
-        tasks.append(mpu6050.set_clock_source(0))
-        tasks.append(send_fetch_config(mpu6050.set_accel_fullscale_range(3), mpu6050.get_accel_sensitivity()))
-        tasks.append(send_fetch_config(mpu6050.set_gyro_fullscale_range(3), mpu6050.get_gyro_sensitivity()))
-        tasks.append(send_fetch_config(gy271.set_config_A(3,6,0), gy271.get_config_A()))
-        tasks.append(send_fetch_config(gy271.set_config_B(7), gy271.get_config_B()))
-        tasks.append(gy271.get_identity())
-
-        comb_res = await asyncio.gather(*tasks)
-        res = comb_res[1:]
-
-        ekf_converter.gain_accelerometer, ekf_converter.gain_gyroscope = res[0:2]
-        gy271_config_a, gy271_config_b, gy271_identity = res[2:5]
+
+        # if the devices still match the last known good config we don't need to configure them again
+        is_restored = False
+        if args.config is not None and os.path.exists(args.config):
+            snapshots = load_register_snapshots(args.config)
+            if "mpu6050" in snapshots and "gy271" in snapshots:
+                res = await asyncio.gather(
+                    mpu6050.registers.restore(snapshots["mpu6050"]),
+                    gy271.registers.restore(snapshots["gy271"]))
+                is_restored = all(n is not None for n in res)
+                if is_restored:
+                    print(f"Restored config from {args.config} (rewrote {sum(res)} registers)")
+
+        if not is_restored:
+            # setup our gyro and accelerometer
+            await asyncio.gather(
+                mpu6050.set_clock_source(0),
+                mpu6050.set_accel_fullscale_range(3),
+                mpu6050.set_gyro_fullscale_range(3),
+                gy271.set_config_A(3,6,0),
+                gy271.set_config_B(7))
+
+            if args.config is not None:
+                snapshots = await asyncio.gather(mpu6050.registers.snapshot(), gy271.registers.snapshot())
+                if all(snapshot is not None for snapshot in snapshots):
+                    save_register_snapshots(args.config, {"mpu6050": snapshots[0], "gy271": snapshots[1]})
+
+        # read back the settings from the devices with one request each
+        sensitivities, gy271_registers = await asyncio.gather(
+            mpu6050.get_sensitivities(),
+            gy271.get_registers())
+
+        ekf_converter.gain_accelerometer, ekf_converter.gain_gyroscope = sensitivities
+        gy271_config_a, gy271_config_b, gy271_identity = \
+            gy271_registers.config_A, gy271_registers.config_B, gy271_registers.identity
 
         print(f"MPU6050 Gain: "+\
               f"accelerometer={ekf_converter.gain_accelerometer:.2e} ms-2 "+\
@@ -214,6 +192,7 @@ async def main(args):
 
         dt1 = default_timer()
         print(f"Setup took {dt1-dt0:.3f} seconds")
+        async_i2c.print_stats()
 
         # start measurmements
         print("Starting measurements automatically")
@@ -224,6 +203,7 @@ async def main(args):
     key_listener = Listener(on_press=hooked_listener.on_press, on_release=hooked_listener.on_release)
     key_listener.start()
 
+    recorder.start()
     try:
         # cube renderer is stopped by hooked listener
         render_tasks = asyncio.gather(
@@ -248,17 +228,28 @@ async def main(args):
             print(f"Exception in run")
             print(traceback.format_exc())
 
-    # print stats
-    gyro_data = measurement_packet_listener.gyro_data
-    compass_data = measurement_packet_listener.compass_data
-    export_data(compass_data, gyro_data, args)
+        recorder.close()
+        if capture is not None:
+            capture.close()
+            print(f"Captured {capture.total_bytes} bytes to {capture.filename}")
+
+    print_recording_stats(recorder)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--port", default="COM11")
     parser.add_argument("--baudrate",  default=38400)
+    parser.add_argument("--transport", default="thread", choices=list(SERIAL_TRANSPORTS.keys()), help="How serial data is read, fd is only supported on posix")
     parser.add_argument("--output", default="./data/data_{sensor}_{i}.csv")
-    parser.add_argument("--override", default=None)
+    parser.add_argument("--override", default=None, type=int)
+    parser.add_argument("--chunk-rows", default=4096, type=int, help="Rows of each sensor written to the output at a time")
+    parser.add_argument("--rotate-mb", default=None, type=float, help="Continue in the next output files when one reaches this size")
+    parser.add_argument("--rotate-minutes", default=None, type=float, help="Continue in the next output files after this many minutes")
+    parser.add_argument("--capture", default=None, help="Save the raw received bytes so the session can be replayed with replay_capture.py")
+    parser.add_argument("--config", default=None, help="Saves the device config after setup and restores it on the next connect")
+    parser.add_argument("--filter", default="fast-ekf", choices=list(FILTER_BACKENDS.keys()))
+    parser.add_argument("--history", default=0, type=int, help="Number of measurements kept to reorder late packets")
+    parser.add_argument("--preintegrate", default=1, type=int, help="Number of gyro samples per predict and measure step")
 
     args = parser.parse_args()
 
@@ -268,4 +259,8 @@ if __name__ == '__main__':
         print("Output file names must have formatting keys for 'sensor' and 'i'")
         exit(1)
 
+    if os.path.splitext(args.output)[1].lower() not in CHUNK_WRITERS:
+        print(f"Output file names must end with one of {', '.join(CHUNK_WRITERS.keys())}")
+        exit(1)
+
     asyncio.run(main(args))
@@ -0,0 +1,210 @@
+import asyncio
+import time
+import threading
+import argparse
+import multiprocessing
+import numpy as np
+import serial
+
+from async_serial_client import AsyncSerialClient
+from serial_transport import SERIAL_TRANSPORTS
+from async_i2c import AsyncI2C
+from async_mpu6050 import MPU6050
+from async_gy271 import GY271
+from measurement_packets import MeasurementPacketListener
+from arduino_emulator import VirtualArduino, PtyArduinoServer
+from ekf import MultiRateExtendedKalmanFilter
+from ekf_client import EKFClient, FILTER_BACKENDS
+from convert_readings import MeasurementConverter
+
+# measure the maximum packet rate and latency of the client against the emulated arduino
+# the emulator runs in its own process so it doesn't compete with the client for the GIL
+# both processes read the same monotonic clock, so the latency of a sample is
+# the time it was dispatched minus the time the emulator took it
+
+# run the emulator until the parent asks it to stop
+# conn is sent (port name, emulator t0) on startup and the emulator's counters on exit
+def run_emulator(conn, gyro_rate, compass_rate):
+    async def main():
+        arduino = VirtualArduino(gyro_rate=gyro_rate, compass_rate=compass_rate)
+        server = PtyArduinoServer(arduino)
+        loop = asyncio.get_running_loop()
+        loop.add_reader(conn.fileno(), server.stop)
+        conn.send((server.port_name, arduino.t0))
+        try:
+            await server.run()
+        finally:
+            loop.remove_reader(conn.fileno())
+            conn.recv()
+            conn.send({
+                "gyro": arduino.total_gyro_samples,
+                "compass": arduino.total_compass_samples,
+                "tx_bytes": server.total_tx_bytes,
+                "dropped_bytes": server.total_dropped_bytes,
+                "stream_time": arduino.t_stop - arduino.t_start,
+            })
+            server.close()
+
+    asyncio.run(main())
+
+# record when each batch of samples was dispatched along with the timestamps of its first and last sample
+class LatencyListener:
+    def __init__(self, t0):
+        self.t0 = t0
+        self.batches = []
+
+    def on_packets(self, packets):
+        t = time.monotonic()
+        uS_first = int.from_bytes(packets[0][:4], 'little')
+        uS_last = int.from_bytes(packets[-1][:4], 'little')
+        self.batches.append((t, uS_first, uS_last, len(packets)))
+
+    # returns the latency (seconds) of the oldest and newest sample of every batch
+    def get_latencies(self):
+        if len(self.batches) == 0:
+            return np.zeros(0), np.zeros(0)
+        batches = np.array(self.batches)
+        t = batches[:,0] - self.t0
+        return t - batches[:,1]*1e-6, t - batches[:,2]*1e-6
+
+# samples missing from a recording found from gaps in their timestamps
+def count_missing(dt, rate):
+    if len(dt) < 2:
+        return 0
+    gaps = np.round(np.diff(dt)*rate).astype(int)
+    return int(np.sum(np.maximum(gaps-1, 0)))
+
+async def run_client(port, t0, args):
+    ser = serial.Serial()
+    ser.port = port
+    ser.baudrate = 38400
+    async_serial = AsyncSerialClient(ser, transport=args.transport)
+
+    # same filter settings as live_async_ekf.py, calibration is skipped so every sample runs through the filter
+    ekf_client = EKFClient(backend=args.filter)
+    if isinstance(ekf_client.ekf, MultiRateExtendedKalmanFilter):
+        ekf_client.ekf.Q = 1e-3*np.eye(4)
+    ekf_client.Ra = 1e-1*np.eye(3)
+    ekf_client.Rm = 1e-1*np.eye(3)
+    ekf_client.use_paired_measurements = False
+    ekf_client.is_calibrating = False
+    ekf_converter = MeasurementConverter()
+    ekf_converter.bias_magnetometer = np.array([-0.1, 0.05, 0]).reshape((3,1))
+    measurement_packet_listener = MeasurementPacketListener(ekf_client, ekf_converter)
+    gyro_latency = LatencyListener(t0)
+    compass_latency = LatencyListener(t0)
+
+    async_i2c = AsyncI2C(async_serial)
+    mpu6050 = MPU6050(async_i2c)
+    gy271 = GY271(async_i2c)
+
+    async_serial.listen_header_batch(0x01, measurement_packet_listener.on_compass_packets)
+    async_serial.listen_header_batch(0x03, measurement_packet_listener.on_gyro_packets)
+    async_serial.listen_header_batch(0x01, compass_latency.on_packets)
+    async_serial.listen_header_batch(0x03, gyro_latency.on_packets)
+    async_serial.listen_header(0x07, async_i2c.on_read_ack)
+    async_serial.listen_header(0x08, async_i2c.on_write_ack)
+
+    stop_ack = asyncio.Event()
+    async_serial.listen_header(0x05, lambda d: stop_ack.set())
+
+    result = {}
+
+    async def run_test():
+        try:
+            # same configuration as live_async_ekf.py
+            await asyncio.gather(
+                mpu6050.set_clock_source(0),
+                mpu6050.set_accel_fullscale_range(3),
+                mpu6050.set_gyro_fullscale_range(3),
+                gy271.set_config_B(7))
+            sensitivities, gy271_registers = await asyncio.gather(
+                mpu6050.get_sensitivities(),
+                gy271.get_registers())
+            ekf_converter.gain_accelerometer, ekf_converter.gain_gyroscope = sensitivities
+            ekf_converter.gain_magnetometer = gy271_registers.config_B.gain
+            result["i2c_timeouts"] = async_i2c.total_timeouts
+
+            # the stop command is sent from another thread so it goes out on time even if the event loop is saturated
+            # the stop ack comes after every sample in the stream so all of them have been processed once it arrives
+            cpu0 = time.process_time()
+            wall0 = time.monotonic()
+            stop_timer = threading.Timer(args.duration, async_serial.stop_measurements)
+            async_serial.start_measurements()
+            stop_timer.start()
+            try:
+                await asyncio.wait_for(stop_ack.wait(), args.duration + args.timeout)
+            except asyncio.TimeoutError:
+                print(f"Stop ack didn't arrive within {args.timeout:.1f} seconds of stopping")
+            result["cpu"] = time.process_time() - cpu0
+            result["wall"] = time.monotonic() - wall0
+        finally:
+            async_serial.stop()
+
+    await async_serial.open()
+    try:
+        await asyncio.gather(async_serial.run(), run_test())
+    finally:
+        async_serial.close()
+
+    result["gyro_data"] = measurement_packet_listener.gyro_data
+    result["compass_data"] = measurement_packet_listener.compass_data
+    result["gyro_latency"] = gyro_latency.get_latencies()
+    result["compass_latency"] = compass_latency.get_latencies()
+    return result
+
+def run_rate(rate, args):
+    conn, child_conn = multiprocessing.Pipe()
+    emulator = multiprocessing.Process(target=run_emulator, args=(child_conn, rate, rate*args.compass_ratio), daemon=True)
+    emulator.start()
+    port, t0 = conn.recv()
+    try:
+        result = asyncio.run(run_client(port, t0, args))
+    finally:
+        conn.send("stop")
+        stats = conn.recv()
+        emulator.join()
+
+    return result, stats
+
+# returns True if the client kept up with the emulator at this rate
+def print_result(rate, result, stats, args):
+    total_sent = stats["gyro"] + stats["compass"]
+    total_received = len(result["gyro_data"]) + len(result["compass_data"])
+    missing = count_missing(result["gyro_data"][:,0], rate) + \
+              count_missing(result["compass_data"][:,0], rate*args.compass_ratio)
+    latency = np.concatenate(result["gyro_latency"] + result["compass_latency"])
+    if len(latency) == 0:
+        latency = np.zeros(1)
+    p99 = np.percentile(latency, 99)
+    stream_time = max(stats["stream_time"], 1e-9)
+
+    print(f"rate={rate:8.0f}Hz "+\
+          f"sent={total_sent/stream_time:9.0f}/s received={total_received/result['wall']:9.0f}/s "+\
+          f"lost={total_sent-total_received:6d} gaps={missing:6d} "+\
+          f"latency: mean={np.mean(latency)*1e3:8.2f}ms p99={p99*1e3:8.2f}ms max={np.max(latency)*1e3:8.2f}ms "+\
+          f"cpu={result['cpu']/result['wall']*100:5.1f}% "+\
+          f"emulator_dropped={stats['dropped_bytes']}B")
+    return total_sent == total_received and p99 <= args.max_latency
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rates", default=[100, 1000, 5000, 10000, 20000], type=float, nargs="+", help="MPU6050 samples per second to test")
+    parser.add_argument("--compass-ratio", default=1.0, type=float, help="GY271 sample rate relative to the MPU6050")
+    parser.add_argument("--duration", default=5.0, type=float, help="Seconds to stream at each rate")
+    parser.add_argument("--timeout", default=30.0, type=float, help="Seconds to wait for the client to catch up after stopping")
+    parser.add_argument("--max-latency", default=0.05, type=float, help="Highest p99 latency (seconds) of a sustainable rate")
+    parser.add_argument("--transport", default="thread", choices=list(SERIAL_TRANSPORTS.keys()))
+    parser.add_argument("--filter", default="fast-ekf", choices=list(FILTER_BACKENDS.keys()))
+    args = parser.parse_args()
+
+    max_rate = None
+    for rate in args.rates:
+        result, stats = run_rate(rate, args)
+        if print_result(rate, result, stats, args):
+            max_rate = rate
+
+    if max_rate is None:
+        print("No tested rate was sustainable")
+    else:
+        print(f"Highest sustainable rate: {max_rate:.0f}Hz gyro and {max_rate*args.compass_ratio:.0f}Hz compass")
@@ -0,0 +1,70 @@
+import numpy as np
+from quaternion import quat_multiply, quat_from_body_rates, quat_to_body, find_observation_matrices
+
+# Mahony complementary filter
+# Cheaper alternative to the extended kalman filters for hosts that only need a coarse orientation
+# There is no covariance, the body vectors steer the gyro integration through a PI controller
+# It has the same predict/measure interface as MultiRateExtendedKalmanFilter so it can be used by EKFClient
+# Pk is passed through untouched and R is ignored
+class MahonyFilter:
+    def __init__(self):
+        # proportional and integral gains of the correction
+        self.kp = 1.0
+        self.ki = 0.05
+        self.reset()
+
+    def reset(self):
+        self.E = np.array([1,0,0,0], dtype=float).reshape((4,1))
+        self.Pk = None
+        self.error = (0.0, 0.0, 0.0)
+        self.integral = (0.0, 0.0, 0.0)
+
+    # copy of the filter state so it can be rewound with restore_state
+    def save_state(self):
+        return (self.E.copy(), self.error, self.integral)
+
+    def restore_state(self, state):
+        self.E, self.error, self.integral = state
+
+    # integrate the pqr measurements with the correction from the last measure
+    def predict(self, pqr, Ek, Pk, Ts):
+        p,q,r = pqr.ravel().tolist()
+        ex,ey,ez = self.error
+        ix,iy,iz = self.integral
+
+        ix,iy,iz = ix + ex*Ts, iy + ey*Ts, iz + ez*Ts
+        self.integral = (ix,iy,iz)
+        self.error = (0.0, 0.0, 0.0)
+
+        kp,ki = self.kp, self.ki
+        p += kp*ex + ki*ix
+        q += kp*ey + ki*iy
+        r += kp*ez + ki*iz
+
+        e = quat_multiply(Ek.ravel().tolist(), quat_from_body_rates(p, q, r, Ts))
+        n = (e[0]*e[0] + e[1]*e[1] + e[2]*e[2] + e[3]*e[3]) ** 0.5
+        Ek = np.array(e).reshape((4,1)) / n
+        return Ek, Pk
+
+    # the correction is the rotation which takes the predicted body vectors onto the measured ones
+    # error = sum(measured x predicted) with both vectors normalised
+    def measure(self, Vb, Ve, Ek, Pk, R):
+        e = Ek.ravel().tolist()
+        ex,ey,ez = self.error
+        for vb, ve in zip(Vb, Ve):
+            b1,b2,b3 = vb.ravel().tolist()
+            p1,p2,p3 = quat_to_body(e, ve.ravel().tolist())
+            nb = (b1*b1 + b2*b2 + b3*b3) ** 0.5
+            nv = (p1*p1 + p2*p2 + p3*p3) ** 0.5
+            if nb == 0 or nv == 0:
+                continue
+            s = 1.0/(nb*nv)
+            ex += (b2*p3 - b3*p2)*s
+            ey += (b3*p1 - b1*p3)*s
+            ez += (b1*p2 - b2*p1)*s
+        self.error = (ex,ey,ez)
+        return Ek, Pk
+
+    # direction cosine matrix which takes external vectors into the body frame
+    def find_observation_matrix(self, e):
+        return find_observation_matrices(e)[0]
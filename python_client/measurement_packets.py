@@ -0,0 +1,105 @@
+import numpy as np
+
+# layout of the measurement packets sent by the arduino server after their header byte
+# the timestamp is the arduino's little endian uint32 micros()
+# the sensor readings are copied straight from the sensor registers which are big endian int16
+# see gy271_packet and mpu6050_packet in arduino_server.ino
+GY271_PACKET_DTYPE = np.dtype([
+    ('uS', '<u4'),
+    ('m_xyz', '>i2', (3,)),
+])
+
+MPU6050_PACKET_DTYPE = np.dtype([
+    ('uS', '<u4'),
+    ('a_xyz', '>i2', (3,)),
+    ('temperature', '>i2'),
+    ('pqr', '>i2', (3,)),
+])
+
+# parse a list of packets (without their header) into a structured array in a single np.frombuffer call
+# packets with the wrong length are skipped and returned separately so they can be reported
+def parse_packets(packets, dtype):
+    n = dtype.itemsize
+    invalid = [packet for packet in packets if len(packet) != n]
+    if len(invalid) > 0:
+        packets = [packet for packet in packets if len(packet) == n]
+    return np.frombuffer(b''.join(packets), dtype=dtype), invalid
+
+# undo the wrap around of the device's micros() counter every 71.6 minutes
+# timestamps are given in seconds and can be given a chunk at a time, the wrap count is carried between chunks
+# a late timestamp from before the last wrap is a jump forwards of almost a whole period, so it is wrapped back
+class MicrosUnwrapper:
+    period = float(1 << 32) * 1e-6
+
+    def __init__(self):
+        self.wraps = 0
+        self.last = None
+
+    def unwrap(self, t):
+        t = np.asarray(t, dtype=np.float64)
+        if len(t) == 0:
+            return t
+        prev = t[0] if self.last is None else self.last
+        diff = np.diff(t, prepend=prev)
+        wraps = self.wraps + np.cumsum((diff < -self.period/2).astype(np.int64) - (diff > self.period/2))
+        self.wraps = wraps[-1]
+        self.last = t[-1]
+        return t + wraps*self.period
+
+# columns of the converted measurements that are recorded for each sensor
+GYRO_COLUMNS = ['dt (s)', 'Ax (ms-2)', 'Ay (ms-2)', 'Az (ms-2)', 'p (rads-1)', 'q (rads-1)', 'r (rads-1)']
+COMPASS_COLUMNS = ['dt (s)', 'Mx (Gauss)', 'My (Gauss)', 'Mz (Gauss)']
+
+# attach measurement listeners
+# every run of measurement packets from a single read is parsed and converted as one block
+# blocks are given to the recorder if there is one (see session_recorder.py), otherwise they are kept in memory
+class MeasurementPacketListener:
+    def __init__(self, ekf_client, ekf_converter, recorder=None):
+        self.ekf_converter = ekf_converter
+        self.ekf_client = ekf_client
+        self.recorder = recorder
+        # both sensors are timestamped by the same micros() counter
+        # the filter is given unwrapped times so its gyro time steps and history stay in order across a wrap
+        self.unwrapper = MicrosUnwrapper()
+
+        self.compass_blocks = []
+        self.gyro_blocks = []
+
+    @property
+    def compass_data(self):
+        return np.concatenate(self.compass_blocks) if len(self.compass_blocks) > 0 else np.zeros((0,4))
+
+    @property
+    def gyro_data(self):
+        return np.concatenate(self.gyro_blocks) if len(self.gyro_blocks) > 0 else np.zeros((0,7))
+
+    def on_compass_packets(self, packets):
+        data, invalid = parse_packets(packets, GY271_PACKET_DTYPE)
+        for packet in invalid:
+            print(f"Unknown compass packet: {bytes(packet)}")
+        if len(data) == 0:
+            return
+
+        dt = self.unwrapper.unwrap(data['uS'] * 1e-6)
+        m_xyz = self.ekf_converter.convert_magnetometer(data['m_xyz'].T)
+        self.ekf_client.on_compass_batch(dt, m_xyz.T)
+        self.on_block("compass", self.compass_blocks, np.column_stack([dt, m_xyz.T]))
+
+    def on_gyro_packets(self, packets):
+        data, invalid = parse_packets(packets, MPU6050_PACKET_DTYPE)
+        for packet in invalid:
+            print(f"Unknown gyro packet: {bytes(packet)}")
+        if len(data) == 0:
+            return
+
+        dt = self.unwrapper.unwrap(data['uS'] * 1e-6)
+        a_xyz = self.ekf_converter.convert_accelerometer(data['a_xyz'].T)
+        pqr = self.ekf_converter.convert_gyroscope(data['pqr'].T)
+        self.ekf_client.on_gyro_batch(dt, a_xyz.T, pqr.T)
+        self.on_block("gyro", self.gyro_blocks, np.column_stack([dt, a_xyz.T, pqr.T]))
+
+    def on_block(self, sensor, blocks, rows):
+        if self.recorder is not None:
+            self.recorder.record(sensor, rows)
+        else:
+            blocks.append(rows)
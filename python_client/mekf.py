@@ -0,0 +1,92 @@
+import numpy as np
+from quaternion import quat_multiply, quat_from_body_rates, find_observation_matrices
+
+# cross product matrix so that skew(a)@b = a x b
+def skew(a):
+    a1,a2,a3 = a
+    return np.array([
+        [  0,-a3, a2],
+        [ a3,  0,-a1],
+        [-a2, a1,  0],
+    ])
+
+# Multiplicative (error state) extended kalman filter
+# The orientation quaternion is kept outside of the filter and corrected multiplicatively
+# The filter state is a 3 element attitude error (body frame) and a 3 element gyro bias error
+# so Pk is a 6x6 covariance instead of the 4x4 covariance of the quaternion
+# It has the same predict/measure interface as MultiRateExtendedKalmanFilter so it can be used by EKFClient
+# NOTE: the gyro bias estimate is part of the filter's state and is updated by measure
+class MultiplicativeExtendedKalmanFilter:
+    def __init__(self):
+        # continuous process noise of the gyro (rad/s)^2/Hz and the bias random walk (rad/s^2)^2/Hz
+        self.gyro_noise = 1e-3
+        self.bias_noise = 1e-8
+        # initial uncertainty of the gyro bias
+        self.bias_variance = 1e-4
+        self.reset()
+
+    def reset(self):
+        self.E = np.array([1,0,0,0], dtype=float).reshape((4,1))
+        self.Pk = np.diag([1e-6]*3 + [self.bias_variance]*3)
+        self.bias = np.zeros((3,1))
+
+    # copy of the filter state so it can be rewound with restore_state
+    def save_state(self):
+        return (self.E.copy(), self.Pk.copy(), self.bias.copy())
+
+    def restore_state(self, state):
+        self.E, self.Pk, self.bias = state
+
+    # Project Ek and Pk ahead using pqr measurements
+    def predict(self, pqr, Ek, Pk, Ts):
+        w = (np.asarray(pqr, dtype=float).reshape((3,1)) - self.bias).ravel()
+        Ek = np.array(quat_multiply(Ek.ravel(), quat_from_body_rates(*w, Ts))).reshape((4,1))
+
+        # d(attitude error)/dt = -w x (attitude error) - (bias error)
+        Fk = np.eye(6)
+        Fk[:3,:3] -= skew(w)*Ts
+        Fk[:3,3:] = -Ts*np.eye(3)
+
+        Qk = np.diag([self.gyro_noise*Ts]*3 + [self.bias_noise*Ts]*3)
+        Pk = Fk@Pk@Fk.T + Qk
+
+        return Ek, Pk
+
+    # update Ek and Pk based on measurements of body and external vectors
+    # Vb = body vectors
+    # Ve = external vectors
+    # R = covariance matrix noise of measurements
+    def measure(self, Vb, Ve, Ek, Pk, R):
+        C = self.find_observation_matrix(Ek)
+
+        # a small body frame rotation d changes the predicted body vector by (C@ve) x d
+        Hks = []
+        zk_pred = []
+        for ve in Ve:
+            vb_pred = C@np.asarray(ve, dtype=float).reshape((3,1))
+            Hk = np.zeros((3,6))
+            Hk[:,:3] = skew(vb_pred.ravel())
+            Hks.append(Hk)
+            zk_pred.append(vb_pred)
+        Hk = np.vstack(Hks)
+        zk_pred = np.vstack(zk_pred)
+        zk = np.vstack([vb for vb in Vb])
+
+        PHt = Pk@Hk.T
+        Sk = Hk@PHt + R
+        Kf = np.linalg.solve(Sk, PHt.T).T
+
+        dx = (Kf@(zk - zk_pred)).ravel()
+        Pk = Pk - Kf@PHt.T
+
+        # move the error into the quaternion and bias, which resets the error state back to zero
+        dq = (1.0, 0.5*dx[0], 0.5*dx[1], 0.5*dx[2])
+        Ek = np.array(quat_multiply(Ek.ravel(), dq)).reshape((4,1))
+        Ek /= np.linalg.norm(Ek)
+        self.bias = self.bias + dx[3:].reshape((3,1))
+
+        return Ek, Pk
+
+    # direction cosine matrix which takes external vectors into the body frame
+    def find_observation_matrix(self, e):
+        return find_observation_matrices(e)[0]
@@ -1,43 +1,106 @@
 import numpy as np
 import pandas as pd
 import argparse
-from convert_readings import MeasurementConverter
-
-parser = argparse.ArgumentParser()
-parser.add_argument("i")
-parser.add_argument("--input", default="./data/data_{sensor}_{i}.csv")
-parser.add_argument("--output", default="./data/data_combined_{i}.csv")
-
-args = parser.parse_args()
-
-# load the data
-data_file_fmt = args.input
-i = 0
-gyro_df = pd.read_csv(data_file_fmt.format(sensor='gyro', i=args.i))
-compass_df = pd.read_csv(data_file_fmt.format(sensor='compass', i=args.i))
-
-gyro_data = gyro_df.to_numpy(dtype=np.float32)
-compass_data = compass_df.to_numpy(dtype=np.float32)
-
-# synchonize data
-Ndata = min([gyro_data.shape[0], compass_data.shape[0]])
-gyro_data = gyro_data[:Ndata]
-compass_data = compass_data[:Ndata]
-
-dt = gyro_data[:,0]
-m_xyz = compass_data[:,[1,2,3]]
-a_xyz = gyro_data[:,[1,2,3]]
-pqr = gyro_data[:,[4,5,6]]
-
-# combine data
-converter = MeasurementConverter()
-converter.bias_magnetometer = np.zeros((3,1), dtype=np.float32)
-
-combined_data = np.zeros((Ndata, 1+3+3+3), dtype=np.float32)
-combined_data[:,0] = dt
-combined_data[:,1:4] = a_xyz
-combined_data[:,4:7] = pqr
-combined_data[:,7:10] = m_xyz
-
-combined_df = pd.DataFrame(combined_data, columns=None, index=None)
-combined_df.to_csv(args.output.format(i=args.i), header=None, index=None)
+from measurement_packets import GYRO_COLUMNS, COMPASS_COLUMNS
+from session_file import iter_sensor_rows, count_sensor_rows, create_session
+
+# merge the gyro and compass streams of a recording into one row per gyro sample
+# the slower compass stream is aligned onto the gyro timestamps, gyro samples before the first
+# or after the last compass sample use that compass sample
+# both streams are read in chunks so a recording of any length is merged in constant memory
+
+# index of the compass sample at or before each time, -1 if there is none
+def find_previous(tc, tg):
+    return np.searchsorted(tc, tg, side='right') - 1
+
+# tc.shape: (M,), mc.shape: (M,3), tg.shape: (N,)
+# returns the compass values at the gyro times with shape (N,3)
+def align_zoh(tc, mc, tg):
+    i = np.maximum(find_previous(tc, tg), 0)
+    return mc[i]
+
+def align_nearest(tc, mc, tg):
+    i0 = np.maximum(find_previous(tc, tg), 0)
+    i1 = np.minimum(i0+1, len(tc)-1)
+    is_next = np.abs(tc[i1]-tg) < np.abs(tg-tc[i0])
+    return mc[np.where(is_next, i1, i0)]
+
+def align_linear(tc, mc, tg):
+    i0 = np.maximum(find_previous(tc, tg), 0)
+    i1 = np.minimum(i0+1, len(tc)-1)
+    span = tc[i1] - tc[i0]
+    w = np.divide(tg - tc[i0], span, out=np.zeros_like(tg), where=span > 0)
+    w = np.clip(w, 0, 1).reshape((-1,1))
+    return (1-w)*mc[i0] + w*mc[i1]
+
+ALIGN_METHODS = {
+    "nearest": align_nearest,
+    "zoh": align_zoh,
+    "linear": align_linear,
+}
+
+# yields rows of (time, a_xyz, pqr, m_xyz) for each chunk of gyro rows
+def merge_chunks(gyro_chunks, compass_chunks, align):
+    compass_chunks = iter(compass_chunks)
+    compass = np.zeros((0,4))
+    is_compass_done = False
+
+    for gyro in gyro_chunks:
+        if len(gyro) == 0:
+            continue
+        tg = gyro[:,0]
+
+        # the window needs the first compass sample after the chunk for nearest and linear alignment
+        while not is_compass_done and (len(compass) == 0 or compass[-1,0] <= tg[-1]):
+            chunk = next(compass_chunks, None)
+            if chunk is None:
+                is_compass_done = True
+            else:
+                compass = np.concatenate([compass, chunk])
+
+        if len(compass) == 0:
+            raise ValueError("Recording has no compass samples")
+
+        merged = np.empty((len(gyro), 10))
+        merged[:,:7] = gyro
+        merged[:,7:] = align(compass[:,0], compass[:,1:], tg)
+        yield merged
+
+        # keep the last compass sample at or before the end of the chunk and everything after it
+        start = max(find_previous(compass[:,0], tg[-1]), 0)
+        compass = compass[start:]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("i")
+    parser.add_argument("--input", default="./data/session_{i}.imu")
+    parser.add_argument("--output", default="./data/session_combined_{i}.imu", help="Session file (.imu) or csv without a header")
+    parser.add_argument("--method", default="linear", choices=list(ALIGN_METHODS.keys()), help="How compass samples are aligned to the gyro timestamps")
+    parser.add_argument("--chunk-rows", default=1 << 16, type=int, help="Rows read from each stream at a time")
+
+    args = parser.parse_args()
+
+    align = ALIGN_METHODS[args.method]
+    gyro_chunks = iter_sensor_rows(args.input, 'gyro', args.i, chunk_rows=args.chunk_rows)
+    compass_chunks = iter_sensor_rows(args.input, 'compass', args.i, chunk_rows=args.chunk_rows)
+    merged_chunks = merge_chunks(gyro_chunks, compass_chunks, align)
+
+    output_filename = args.output.format(i=args.i)
+    if output_filename.lower().endswith(".imu"):
+        N = count_sensor_rows(args.input, 'gyro', args.i)
+        columns = GYRO_COLUMNS[1:] + COMPASS_COLUMNS[1:]
+        combined = create_session(output_filename, {"combined": (columns, N, np.float32)})["combined"]
+        start = 0
+        for merged in merged_chunks:
+            end = start + len(merged)
+            combined.uS[start:end] = np.round(merged[:,0] * 1e6).astype(np.int64) & 0xFFFFFFFF
+            combined.values[:,start:end] = merged[:,1:].T
+            start = end
+        combined.uS.flush()
+        combined.values.flush()
+    else:
+        with open(output_filename, "w", newline='') as fp:
+            for merged in merged_chunks:
+                pd.DataFrame(merged).to_csv(fp, header=None, index=None)
+
+    print(f"Saved {output_filename}")
@@ -1,16 +1,14 @@
 # %%
 import matplotlib.pyplot as  plt
 import numpy as np
-import pandas as pd
+from session_file import open_sensor
 
 # %%
-data_file_fmt = "./data/data_{sensor}_{i}.csv"
+data_file_fmt = "./data/session_{i}.imu"
 i = 20
-compass_df = pd.read_csv(data_file_fmt.format(sensor='compass', i=i))
-compass_data = compass_df.to_numpy(dtype=np.float32)
-dt = compass_data[:,0]
-dt -= dt[0]
-m_xyz = compass_data[:,1:]
+compass = open_sensor(data_file_fmt, 'compass', i)
+dt = compass.time - compass.time[0]
+m_xyz = compass.get_values(0, 3)
 
 # %% Plot xyz graphs
 fig, axs = plt.subplots(3, 3, figsize=(10,10))
@@ -1,29 +1,28 @@
 # %%
 import numpy as np
-import pandas as pd
 import matplotlib.pyplot as plt
 
-from ekf import LoggedExtendedKalmanFilter
+from quaternion import quats_to_body
+from ekf_smoother import ExtendedKalmanSmoother
+from session_file import open_sensor
 
 # %%
-filename_fmt = "./data/data_combined_{i}.csv"
+filename_fmt = "./data/session_combined_{i}.imu"
 i = 18
-df = pd.read_csv(filename_fmt.format(i=i), header=None)
-data = df.to_numpy()
+combined = open_sensor(filename_fmt, 'combined', i, header=None)
 
-dt = data[:,0]
-a_xyz = data[:,[1,2,3]]
-pqr   = data[:,[4,5,6]]
-m_xyz = data[:,[7,8,9]]
-
-dt -= dt[0]
+dt = combined.time - combined.time[0]
+a_xyz = combined.get_values(0, 3)
+pqr   = combined.get_values(3, 6)
+m_xyz = combined.get_values(6, 9)
 Ts = np.mean(dt[1:]-dt[:-1])
 Ncalibrate = int(np.ceil(1.0/Ts))
 
 a_len = np.linalg.norm(a_xyz, axis=1)
 m_len = np.linalg.norm(m_xyz, axis=1)
 
-pqr -= np.mean(pqr[:Ncalibrate], axis=0)
+# the session file is read only, so the unbiased body rates are a copy
+pqr = pqr - np.mean(pqr[:Ncalibrate], axis=0)
 
 # Find calibration values
 a_xyz_0 = np.mean(a_xyz[:Ncalibrate], axis=0)
@@ -31,39 +30,23 @@ m_xyz_0 = np.mean(m_xyz[:Ncalibrate], axis=0)
 
 # %%
 # Get kalman filter measurements
-ekf = LoggedExtendedKalmanFilter()
+ekf = ExtendedKalmanSmoother()
 ekf.a_xyz_0 = a_xyz_0.reshape((3,1))
 ekf.m_xyz_0 = m_xyz_0.reshape((3,1))
-ekf.last_dt = dt[0]-Ts
+ekf.filter(dt, a_xyz, pqr, m_xyz, Ts0=Ts)
+ekf.smooth(covariance=False)
 
 # Get regular gyro predictions
-gyro_only = LoggedExtendedKalmanFilter()
-gyro_only.a_xyz_0 = a_xyz_0.reshape((3,1))
-gyro_only.m_xyz_0 = m_xyz_0.reshape((3,1))
-gyro_only.last_dt = dt[0]-Ts
-
-N = len(dt)
-for i in range(N):
-    dt_i = dt[i]
-    a_xyz_i = a_xyz[i].reshape((3,1))
-    m_xyz_i = m_xyz[i].reshape((3,1))
-    pqr_i = pqr[i].reshape((3,1))
-    ekf.update(dt_i, a_xyz_i, m_xyz_i, pqr_i)
-    gyro_only.update(dt_i, None, None, pqr_i, measure_step=False)
-
-ekf.quats = np.array(ekf.quats).squeeze()
-gyro_only.quats = np.array(gyro_only.quats).squeeze()
+gyro_only = ExtendedKalmanSmoother()
+gyro_only.filter(dt, None, pqr, None, Ts0=Ts, measure_step=False)
 
 # %%
-ekf_dcm = ekf.find_observation_matrix(ekf.quats.T).transpose([2,0,1])
-gyro_dcm = gyro_only.find_observation_matrix(gyro_only.quats.T).transpose([2,0,1])
-
 # Find the predicted body vectors
-a_xyz_kf = ekf_dcm@a_xyz_0
-m_xyz_kf = ekf_dcm@m_xyz_0
+a_xyz_kf = quats_to_body(ekf.quats, a_xyz_0)
+m_xyz_kf = quats_to_body(ekf.quats, m_xyz_0)
 
-a_xyz_gy = gyro_dcm@a_xyz_0
-m_xyz_gy = gyro_dcm@m_xyz_0
+a_xyz_gy = quats_to_body(gyro_only.quats, a_xyz_0)
+m_xyz_gy = quats_to_body(gyro_only.quats, m_xyz_0)
 
 # %% Plot our data readings
 def plot_data(dt, a_xyz, m_xyz, pqr, a_len, m_len):
@@ -131,8 +114,8 @@ plt.ylabel("Angle between Axyz and Mxyz (rads)")
 plt.show()
 
 # %% Plot the determined quaternions
-def plot_quaternions(dt, ekf_quats, gyro_only_quats):
-    fig, axs = plt.subplots(2, 1, figsize=(20,10))
+def plot_quaternions(dt, ekf_quats, ekf_smooth_quats, gyro_only_quats):
+    fig, axs = plt.subplots(3, 1, figsize=(20,15))
     ax = axs[0]
     ax.plot(dt, ekf_quats[:,0], label="w")
     ax.plot(dt, ekf_quats[:,1], label="i")
@@ -144,6 +127,16 @@ def plot_quaternions(dt, ekf_quats, gyro_only_quats):
     ax.set_title("EKF")
 
     ax = axs[1]
+    ax.plot(dt, ekf_smooth_quats[:,0], label="w")
+    ax.plot(dt, ekf_smooth_quats[:,1], label="i")
+    ax.plot(dt, ekf_smooth_quats[:,2], label="j")
+    ax.plot(dt, ekf_smooth_quats[:,3], label="k")
+    ax.legend()
+    ax.grid(True)
+    ax.set_xlabel("Time (s)")
+    ax.set_title("EKF + RTS Smoother")
+
+    ax = axs[2]
     ax.plot(dt, gyro_only_quats[:,0], label="w")
     ax.plot(dt, gyro_only_quats[:,1], label="i")
     ax.plot(dt, gyro_only_quats[:,2], label="j")
@@ -156,7 +149,7 @@ def plot_quaternions(dt, ekf_quats, gyro_only_quats):
     plt.tight_layout()
 
     return fig, axs
-plot_quaternions(dt, ekf.quats, gyro_only.quats)
+plot_quaternions(dt, ekf.quats, ekf.quats_smooth, gyro_only.quats)
 plt.show()
 
 # %% Plot the predicted body vectors
@@ -1,58 +1,36 @@
 # %%
 import numpy as np
-import pandas as pd
 import matplotlib.pyplot as plt
 
 from ekf_client import EKFClient
+from session_file import open_sensor
+from event_stream import create_event_order
 
 # %% Load the files
-filename_fmt = "./data/data_{sensor}_{i}.csv"
+filename_fmt = "./data/session_{i}.imu"
 i = 18
 
-# load gyro and accel data
-df0 = pd.read_csv(filename_fmt.format(sensor='gyro', i=i))
-data = df0.to_numpy(dtype=np.float32)
-dt0 = data[:,0]
-a_xyz = data[:,[1,2,3]]
-pqr   = data[:,[4,5,6]]
+# open gyro and accel data
+gyro = open_sensor(filename_fmt, 'gyro', i)
+dt0 = gyro.time
+a_xyz = gyro.get_values(0, 3)
+pqr   = gyro.get_values(3, 6)
 
-# load compass data
-df1 = pd.read_csv(filename_fmt.format(sensor='compass', i=i))
-data = df1.to_numpy(dtype=np.float32)
-dt1 = data[:,0]
-m_xyz = data[:,[1,2,3]]
+# open compass data
+compass = open_sensor(filename_fmt, 'compass', i)
+dt1 = compass.time
+m_xyz = compass.get_values(0, 3)
 
 # %% Create the event stream
-def create_event_stream(dt0, dt1, a_xyz, pqr, m_xyz):
-    i0 = 0
-    i1 = 0
+# compass is given first so it goes first on equal timestamps
+COMPASS, GYRO = 0, 1
+events = create_event_order([dt1, dt0])
+kinds = events['kind'].tolist()
+index = events['index'].tolist()
 
-    N0 = dt0.shape[0]
-    N1 = dt1.shape[0]
-
-    events = []
-
-    while i0 < N0 and i1 < N1:
-        # gyro has priority
-        if dt0[i0] < dt1[i1]:
-            events.append(('G', dt0[i0], a_xyz[i0], pqr[i0]))
-            i0 += 1
-        # compass has priority
-        else:
-            events.append(('C', dt1[i1], m_xyz[i1]))
-            i1 += 1
-
-    # ingest remaining events (one of them will be completed)
-    while i0 < N0:
-        events.append(('G', dt0[i0], a_xyz[i0], pqr[i0]))
-        i0 += 1
-
-    while i1 < N1:
-        events.append(('C', dt1[i1], m_xyz[i1]))
-        i1 += 1
-
-    return events
-events = create_event_stream(dt0, dt1, a_xyz, pqr, m_xyz)
+a_xyz = a_xyz.reshape((-1,3,1))
+pqr = pqr.reshape((-1,3,1))
+m_xyz = m_xyz.reshape((-1,3,1))
 
 # %% Begin ingesting the event stream
 # create kalman filter
@@ -68,25 +46,19 @@ Pk_kf    = np.zeros((Nevents,4))
 
 client.set_calibrate(True)
 
-for i, event in enumerate(events):
-    if i == 100:
+for k, (kind, i) in enumerate(zip(kinds, index)):
+    if k == 100:
         client.set_calibrate(False)
 
-    tag, dt, *contents = event
-    
     # update measurements using compass
-    if tag == 'C':
-        m_xyz_i = contents[0].reshape((3,1))
-        client.on_compass(dt, m_xyz_i)
+    if kind == COMPASS:
+        dt = dt1[i]
+        client.on_compass(dt, m_xyz[i])
     # predict orientation using body rates, and update with accelerometer measurements
-    elif tag == 'G':
-        a_xyz_i, pqr_i = contents
-        a_xyz_i = a_xyz_i.reshape((3,1))
-        pqr_i = pqr_i.reshape((3,1))
-        client.on_gyro(dt, a_xyz_i, pqr_i)
     else:
-        raise ValueError(f"Unknown event tag {tag}")
-    
+        dt = dt0[i]
+        client.on_gyro(dt, a_xyz[i], pqr[i])
+
     if not client.is_calibrating:
         dt_kf[Nprocessed] = dt
         quats_kf[Nprocessed,:] = client.ekf.E.T.squeeze()
@@ -0,0 +1,111 @@
+import numpy as np
+from math import sqrt, sin, cos
+
+# quaternion helpers shared by the filters
+# quaternions are stored as [e0,e1,e2,e3] where e0 is the scalar part
+# the scalar functions work on tuples of python floats since they are called per sample
+# the batch functions work on (N,4) arrays so a whole recording can be processed in one pass
+
+# quaternion product a*b
+def quat_multiply(a, b):
+    a0,a1,a2,a3 = a
+    b0,b1,b2,b3 = b
+    return (
+        a0*b0 - a1*b1 - a2*b2 - a3*b3,
+        a0*b1 + a1*b0 + a2*b3 - a3*b2,
+        a0*b2 - a1*b3 + a2*b0 + a3*b1,
+        a0*b3 + a1*b2 - a2*b1 + a3*b0,
+    )
+
+# exact rotation over Ts for a constant body rate pqr
+# this is the exponential map of the rotation vector pqr*Ts
+def quat_from_body_rates(p, q, r, Ts):
+    w = sqrt(p*p + q*q + r*r)
+    half_angle = 0.5*w*Ts
+    # sin(wTs/2)/w -> Ts/2 as w -> 0
+    if half_angle < 1e-6:
+        s = 0.5*Ts
+    else:
+        s = sin(half_angle)/w
+    return (cos(half_angle), s*p, s*q, s*r)
+
+# matrix form of right multiplication so that E*q = quat_right_matrix(q)@E
+# for q = [0,p,q,r] this is the 2*Ak matrix used by the filter's state transition
+def quat_right_matrix(q):
+    q0,q1,q2,q3 = q
+    return np.array([
+        [q0,-q1,-q2,-q3],
+        [q1, q0, q3,-q2],
+        [q2,-q3, q0, q1],
+        [q3, q2,-q1, q0],
+    ])
+
+# rotate an external vector into the body frame, this is find_observation_matrix(e)@v
+def quat_to_body(e, v):
+    e0,e1,e2,e3 = e
+    v1,v2,v3 = v
+    return (
+        (e0*e0+e1*e1-e2*e2-e3*e3)*v1 + 2*(e1*e2+e0*e3)*v2 + 2*(e1*e3-e0*e2)*v3,
+        2*(e1*e2-e0*e3)*v1 + (e0*e0-e1*e1+e2*e2-e3*e3)*v2 + 2*(e2*e3+e0*e1)*v3,
+        2*(e1*e3+e0*e2)*v1 + 2*(e2*e3-e0*e1)*v2 + (e0*e0-e1*e1-e2*e2+e3*e3)*v3,
+    )
+
+# calculate the direction cosine matrices for a batch of quaternions
+# these take external vectors into the body frame, z = C(e)@v
+# E.shape = (N,4) or (4,) or (4,1), returns a contiguous (N,3,3)
+def find_observation_matrices(E):
+    E = np.asarray(E, dtype=float).reshape((-1,4))
+    e0,e1,e2,e3 = E.T
+    C = np.empty((E.shape[0],3,3))
+    C[:,0,0] = e0**2+e1**2-e2**2-e3**2
+    C[:,0,1] = 2*(e1*e2+e0*e3)
+    C[:,0,2] = 2*(e1*e3-e0*e2)
+    C[:,1,0] = 2*(e1*e2-e0*e3)
+    C[:,1,1] = e0**2-e1**2+e2**2-e3**2
+    C[:,1,2] = 2*(e2*e3+e0*e1)
+    C[:,2,0] = 2*(e1*e3+e0*e2)
+    C[:,2,1] = 2*(e2*e3-e0*e1)
+    C[:,2,2] = e0**2-e1**2-e2**2+e3**2
+    return C
+
+# calculate the jacobians dz/de of z = C(e)@v for a batch of quaternions
+# E.shape = (N,4) or (4,), v.shape = (N,3) or (3,)
+# either one can be a single sample which is shared by the whole batch, returns a contiguous (N,3,4)
+def find_observation_jacobians(E, v):
+    E = np.asarray(E, dtype=float).reshape((-1,4))
+    v = np.asarray(v, dtype=float).reshape((-1,3))
+    N = max(E.shape[0], v.shape[0])
+    e1,e2,e3,e4 = E.T
+    v1,v2,v3 = v.T
+
+    H = np.empty((N,3,4))
+    H[:,0,0] = 2*e1*v1 - 2*e3*v3 + 2*e4*v2
+    H[:,0,1] = 2*e2*v1 + 2*e3*v2 + 2*e4*v3
+    H[:,0,2] = 2*e2*v2 - 2*e1*v3 - 2*e3*v1
+    H[:,0,3] = 2*e1*v2 + 2*e2*v3 - 2*e4*v1
+    H[:,1,0] = 2*e1*v2 + 2*e2*v3 - 2*e4*v1
+    H[:,1,1] = 2*e1*v3 - 2*e2*v2 + 2*e3*v1
+    H[:,1,2] = 2*e2*v1 + 2*e3*v2 + 2*e4*v3
+    H[:,1,3] = 2*e3*v3 - 2*e1*v1 - 2*e4*v2
+    H[:,2,0] = 2*e1*v3 - 2*e2*v2 + 2*e3*v1
+    H[:,2,1] = 2*e4*v1 - 2*e2*v3 - 2*e1*v2
+    H[:,2,2] = 2*e1*v1 - 2*e3*v3 + 2*e4*v2
+    H[:,2,3] = 2*e2*v1 + 2*e3*v2 + 2*e4*v3
+    return H
+
+# rotate external vectors into the body frame for a batch of quaternions
+# this is find_observation_matrices(E)@v without building the (N,3,3) matrices
+# E.shape = (N,4), v.shape = (N,3) or (3,), returns (N,3)
+def quats_to_body(E, v):
+    E = np.asarray(E, dtype=float).reshape((-1,4))
+    v = np.asarray(v, dtype=float).reshape((-1,3))
+    N = max(E.shape[0], v.shape[0])
+    e0,e1,e2,e3 = E.T
+    v1,v2,v3 = v.T
+
+    # same terms as quat_to_body applied to whole columns
+    z = np.empty((N,3))
+    z[:,0] = (e0*e0+e1*e1-e2*e2-e3*e3)*v1 + 2*(e1*e2+e0*e3)*v2 + 2*(e1*e3-e0*e2)*v3
+    z[:,1] = 2*(e1*e2-e0*e3)*v1 + (e0*e0-e1*e1+e2*e2-e3*e3)*v2 + 2*(e2*e3+e0*e1)*v3
+    z[:,2] = 2*(e1*e3+e0*e2)*v1 + 2*(e2*e3-e0*e1)*v2 + (e0*e0-e1*e1-e2*e2+e3*e3)*v3
+    return z
@@ -0,0 +1,176 @@
+import asyncio
+import mmap
+import struct
+import time
+import argparse
+import numpy as np
+
+from cobs import cobs_decode_bulk
+
+# capture of the raw bytes received over the serial port so a session can be replayed exactly
+# file layout (little endian)
+# - header: magic (8 bytes), wall clock time of the start of the capture as float64 seconds
+# - records: receive time as float64 seconds since the start of the capture, total bytes as uint32, the bytes
+# each record is one read from the serial transport so a replay delivers the same chunks
+CAPTURE_MAGIC = b"\x93RAWCAP1"
+CAPTURE_HEADER = struct.Struct("<8sd")
+CAPTURE_RECORD = struct.Struct("<dI")
+
+# append received bytes to a capture file
+# writes are buffered so the tap only costs a memory copy on the event loop,
+# the buffer is flushed to the file every flush_interval seconds
+class RawCaptureWriter:
+    def __init__(self, filename, flush_interval=1.0, buffer_size=1 << 16):
+        self.filename = filename
+        self.flush_interval = flush_interval
+        self.fp = open(filename, "wb", buffering=buffer_size)
+        self.t0 = time.monotonic()
+        self.last_flush = self.t0
+        self.fp.write(CAPTURE_HEADER.pack(CAPTURE_MAGIC, time.time()))
+
+        self.total_records = 0
+        self.total_bytes = 0
+
+    def write(self, data):
+        t = time.monotonic()
+        self.fp.write(CAPTURE_RECORD.pack(t - self.t0, len(data)))
+        self.fp.write(data)
+        self.total_records += 1
+        self.total_bytes += len(data)
+        if t - self.last_flush >= self.flush_interval:
+            self.fp.flush()
+            self.last_flush = t
+
+    def close(self):
+        if not self.fp.closed:
+            self.fp.close()
+
+# memory map a capture file and step through its records
+class RawCaptureReader:
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as fp:
+            self.data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.start_time = CAPTURE_HEADER.unpack_from(self.data, 0)
+        if magic != CAPTURE_MAGIC:
+            raise ValueError(f"{filename} is not a raw capture")
+
+    # yields (receive time, memoryview of the bytes)
+    # a record cut short by a crash during the capture is ignored
+    def records(self):
+        data = self.data
+        view = memoryview(data)
+        N = len(data)
+        offset = CAPTURE_HEADER.size
+        while offset + CAPTURE_RECORD.size <= N:
+            t, n = CAPTURE_RECORD.unpack_from(data, offset)
+            offset += CAPTURE_RECORD.size
+            if offset + n > N:
+                break
+            yield t, view[offset:offset+n]
+            offset += n
+
+    # all the received bytes joined into one stream
+    def read_stream(self):
+        return b''.join(x for _, x in self.records())
+
+    def close(self):
+        self.data.close()
+
+# stands in for the serial.Serial given to AsyncSerialClient when replaying a capture
+# commands written to it are kept but never answered
+class ReplaySerial:
+    # speed = multiple of real time, or None to replay as fast as possible
+    def __init__(self, filename, speed=1.0):
+        self.port = filename
+        self.speed = speed
+        self.reader = None
+        self.tx_commands = []
+
+    @property
+    def is_open(self):
+        return self.reader is not None
+
+    def open(self):
+        self.reader = RawCaptureReader(self.port)
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+    def write(self, data):
+        self.tx_commands.append(bytes(data))
+        return len(data)
+
+# transport that delivers the records of a ReplaySerial's capture with their original timing
+# on_error is given an EOFError once the capture has been replayed
+class ReplayTransport:
+    # records delivered between yielding to the event loop when replaying as fast as possible
+    batch_records = 64
+
+    def __init__(self, ser, on_data, on_error):
+        self.ser = ser
+        self.on_data = on_data
+        self.on_error = on_error
+        self.task = None
+
+    def start(self, loop):
+        self.task = loop.create_task(self.run())
+
+    async def run(self):
+        speed = self.ser.speed
+        t_start = time.monotonic()
+        total = 0
+        try:
+            for t, data in self.ser.reader.records():
+                if speed is None:
+                    total += 1
+                    if total % self.batch_records == 0:
+                        await asyncio.sleep(0)
+                else:
+                    delay = t/speed - (time.monotonic() - t_start)
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                self.on_data(bytes(data))
+        except Exception as ex:
+            # nothing awaits this task so the error has to be reported or the client would wait forever
+            self.on_error(ex)
+            return
+        self.on_error(EOFError(f"End of capture {self.ser.port}"))
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+# count the packets of each header in a capture
+# the whole stream is decoded at once, so this is quick even for long captures
+def summarise_capture(filename):
+    reader = RawCaptureReader(filename)
+    total_records = 0
+    duration = 0.0
+    for t, data in reader.records():
+        total_records += 1
+        duration = t
+        data.release()
+    stream = reader.read_stream()
+    offsets, payload = cobs_decode_bulk(stream)
+    starts = offsets[:-1]
+    is_empty = offsets[1:] == starts
+
+    print(f"{filename}: started {time.ctime(reader.start_time)}")
+    print(f"    duration={duration:.1f}s records={total_records} bytes={len(stream)} packets={len(starts)}")
+    headers = payload[starts[~is_empty]]
+    counts = np.bincount(headers, minlength=256)
+    for header in np.flatnonzero(counts):
+        print(f"    header={header:02X} total={counts[header]}")
+    reader.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Summarise raw serial captures from live_async_ekf.py")
+    parser.add_argument("captures", nargs="+")
+    args = parser.parse_args()
+
+    for filename in args.captures:
+        summarise_capture(filename)
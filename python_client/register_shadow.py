@@ -0,0 +1,123 @@
+import asyncio
+import json
+
+# most bytes the arduino can read or write in one i2c request
+MAX_I2C_RW = 32
+
+# local copy of the configuration registers of an i2c device
+# values are filled in by the first read and kept up to date by writing through the shadow
+# so read-modify-write and reading back a setting don't need a round trip over the serial link
+# only registers that the device never changes by itself should be cached (not status or data registers)
+# call invalidate() if the device could have been changed elsewhere, e.g. after it was reset
+class RegisterShadow:
+    def __init__(self, i2c, addr, cached_registers):
+        self.i2c = i2c
+        self.addr = addr
+        self.cached_registers = set(cached_registers)
+        self.blocks = find_register_blocks(self.cached_registers)
+        self.values = {}
+        self.locks = {}
+
+        self.total_hits = 0
+        self.total_misses = 0
+
+    def invalidate(self, reg=None):
+        if reg is None:
+            self.values.clear()
+        else:
+            self.values.pop(reg, None)
+
+    # read a single byte register, returns None if the read failed
+    async def read(self, reg):
+        if reg in self.values:
+            self.total_hits += 1
+            return self.values[reg]
+
+        self.total_misses += 1
+        data = await self.i2c.read(self.addr, reg, 1)
+        if data is None:
+            return None
+        value = data[0]
+        if reg in self.cached_registers:
+            self.values[reg] = value
+        return value
+
+    # read n consecutive registers starting at reg in a single request
+    # this refreshes any cached registers in the block, returns the bytes read or None if the read failed
+    async def read_block(self, reg, n):
+        self.total_misses += 1
+        data = await self.i2c.read(self.addr, reg, n)
+        if data is None:
+            return None
+        for i, value in enumerate(data):
+            if reg+i in self.cached_registers:
+                self.values[reg+i] = value
+        return data
+
+    # read every cached register from the device with one request per block of consecutive registers
+    # returns {reg: value} or None if a read failed
+    async def snapshot(self):
+        blocks = await asyncio.gather(*[self.read_block(reg, n) for reg, n in self.blocks])
+        if any(data is None for data in blocks):
+            return None
+        return {reg: self.values[reg] for reg in sorted(self.cached_registers)}
+
+    # bring the device back to a snapshot by only writing the registers that are different
+    # returns the number of registers written or None if the device couldn't be read or written
+    async def restore(self, snapshot):
+        current = await self.snapshot()
+        if current is None:
+            return None
+        changed = [(reg, value) for reg, value in snapshot.items() if current.get(reg) != value]
+        ns = await asyncio.gather(*[self.write(reg, value) for reg, value in changed])
+        if any(n != 1 for n in ns):
+            return None
+        return len(changed)
+
+    # write a single byte register, returns the number of bytes written
+    async def write(self, reg, value):
+        value = value & 0xFF
+        n = await self.i2c.write(self.addr, reg, [value])
+        if n == 1 and reg in self.cached_registers:
+            self.values[reg] = value
+        else:
+            # we don't know what the register holds after a failed write
+            self.values.pop(reg, None)
+        return n
+
+    # set the bits of a register selected by mask and keep the others
+    # modifications of the same register are done one at a time so they don't overwrite each other
+    # returns True if the write succeeded
+    async def modify(self, reg, mask, bits):
+        lock = self.locks.setdefault(reg, asyncio.Lock())
+        async with lock:
+            value = await self.read(reg)
+            if value is None:
+                return False
+            value = (value & ~mask) | (bits & mask)
+            n = await self.write(reg, value)
+            return n == 1
+
+# split registers into runs of consecutive registers that fit in a single request
+# returns a list of (start register, total registers)
+def find_register_blocks(registers):
+    blocks = []
+    for reg in sorted(registers):
+        if len(blocks) > 0:
+            start, n = blocks[-1]
+            if reg == start+n and n < MAX_I2C_RW:
+                blocks[-1] = (start, n+1)
+                continue
+        blocks.append((reg, 1))
+    return blocks
+
+# snapshots of several devices are stored as {device name: {reg: value}}
+def save_register_snapshots(filename, snapshots):
+    data = {name: {f"{reg:02X}": value for reg, value in snapshot.items()} for name, snapshot in snapshots.items()}
+    with open(filename, "w") as fp:
+        json.dump(data, fp, indent=4)
+
+def load_register_snapshots(filename):
+    with open(filename, "r") as fp:
+        data = json.load(fp)
+    return {name: {int(reg, 16): value for reg, value in snapshot.items()} for name, snapshot in data.items()}
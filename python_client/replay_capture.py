@@ -0,0 +1,113 @@
+import asyncio
+import argparse
+import time
+import numpy as np
+
+from async_serial_client import AsyncSerialClient
+from raw_capture import ReplaySerial, ReplayTransport
+from measurement_packets import MeasurementPacketListener, GYRO_COLUMNS, COMPASS_COLUMNS
+from session_recorder import SessionRecorder
+from async_mpu6050 import MPU6050
+from async_gy271 import GY271
+from ekf import MultiRateExtendedKalmanFilter
+from ekf_client import EKFClient, FILTER_BACKENDS
+from convert_readings import MeasurementConverter
+
+# replay a raw capture from live_async_ekf.py --capture through the same packet listeners and filter
+# in real time, at a multiple of real time, or as fast as possible (--speed 0) as a throughput benchmark
+# the chunks of bytes are delivered as they were received so the filter output is the same at any speed
+
+# the sensor gains are set by the device setup at the start of a session
+# so they are picked up from the i2c read acks in the capture instead of being read from a device
+class ReplayGainTracker:
+    def __init__(self, ekf_converter):
+        self.ekf_converter = ekf_converter
+        self.mpu6050 = MPU6050(None)
+        self.gy271 = GY271(None)
+
+    # contains (addr, register, total_bytes_read, data[total_bytes_read])
+    def on_read_ack(self, packet):
+        addr, reg, n = packet[:3]
+        registers = {reg+i: value for i, value in enumerate(packet[3:3+n])}
+        converter = self.ekf_converter
+
+        if addr == self.mpu6050.addr:
+            if 0x1B in registers:
+                converter.gain_gyroscope = self.mpu6050.gyro_sensitivity[(registers[0x1B] >> 3) & 0b11]
+            if 0x1C in registers:
+                converter.gain_accelerometer = self.mpu6050.accel_sensitivity[(registers[0x1C] >> 3) & 0b11]
+        elif addr == self.gy271.addr:
+            if 0x01 in registers:
+                converter.gain_magnetometer = self.gy271.decode_config_B(registers[0x01]).gain
+
+async def main(args):
+    speed = args.speed if args.speed > 0 else None
+    ser = ReplaySerial(args.capture, speed=speed)
+    async_serial = AsyncSerialClient(ser, transport=ReplayTransport)
+
+    # same filter settings as live_async_ekf.py
+    ekf_client = EKFClient(backend=args.filter)
+    if isinstance(ekf_client.ekf, MultiRateExtendedKalmanFilter):
+        ekf_client.ekf.Q = 1e-3*np.eye(4)
+    ekf_client.Ra = 1e-1*np.eye(3)
+    ekf_client.Rm = 1e-1*np.eye(3)
+    ekf_client.use_paired_measurements = False
+    ekf_client.preintegrate_samples = args.preintegrate
+    ekf_client.history_length = args.history
+    ekf_client.is_calibrating = False
+    ekf_converter = MeasurementConverter()
+    ekf_converter.bias_magnetometer = np.array([-0.1, 0.05, 0]).reshape((3,1))
+
+    recorder = None
+    if args.output is not None:
+        recorder = SessionRecorder(args.output, {"gyro": GYRO_COLUMNS, "compass": COMPASS_COLUMNS}, i=0)
+        recorder.start()
+    measurement_packet_listener = MeasurementPacketListener(ekf_client, ekf_converter, recorder)
+    gain_tracker = ReplayGainTracker(ekf_converter)
+
+    total_packets = {}
+    def count_packets(header):
+        total_packets[header] = 0
+        def on_packets(packets):
+            total_packets[header] += len(packets)
+        return on_packets
+
+    async_serial.listen_header_batch(0x01, measurement_packet_listener.on_compass_packets)
+    async_serial.listen_header_batch(0x03, measurement_packet_listener.on_gyro_packets)
+    async_serial.listen_header(0x07, gain_tracker.on_read_ack)
+    for header in (0x01, 0x03, 0x07, 0x08, 0xFF):
+        async_serial.listen_header_batch(header, count_packets(header))
+
+    await async_serial.open()
+    total_bytes = len(ser.reader.data)
+    dt0 = time.perf_counter()
+    try:
+        await async_serial.run()
+    finally:
+        dt1 = time.perf_counter()
+        async_serial.close()
+        if recorder is not None:
+            recorder.close()
+
+    elapsed = dt1 - dt0
+    total_samples = total_packets[0x01] + total_packets[0x03]
+    print(f"Replayed {total_bytes} bytes in {elapsed:.3f}s: "+\
+          f"{total_bytes/elapsed:.0f} bytes/s, {total_samples/elapsed:.0f} samples/s")
+    print(f"Packets: gyro={total_packets[0x03]} compass={total_packets[0x01]} "+\
+          f"i2c read={total_packets[0x07]} i2c write={total_packets[0x08]} alive={total_packets[0xFF]} "+\
+          f"empty frames={async_serial.rx_decoder.total_empty_frames}")
+    print(f"Gains: accelerometer={ekf_converter.gain_accelerometer} gyroscope={ekf_converter.gain_gyroscope} "+\
+          f"magnetometer={ekf_converter.gain_magnetometer}")
+    print("Final orientation: " + " ".join(f"{x:.6f}" for x in np.asarray(ekf_client.ekf.E).flatten()))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("capture")
+    parser.add_argument("--speed", default=0, type=float, help="Multiple of real time, 0 replays as fast as possible")
+    parser.add_argument("--output", default=None, help="Record the converted measurements, e.g. ./data/replay_{sensor}_{i}.csv")
+    parser.add_argument("--filter", default="fast-ekf", choices=list(FILTER_BACKENDS.keys()))
+    parser.add_argument("--history", default=0, type=int, help="Number of measurements kept to reorder late packets")
+    parser.add_argument("--preintegrate", default=1, type=int, help="Number of gyro samples per predict and measure step")
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
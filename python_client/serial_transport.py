@@ -0,0 +1,85 @@
+import threading
+
+# transports that hand received serial bytes to the event loop
+# they are woken up when data arrives instead of polling the port
+# on_data(bytes) and on_error(exception) are always called on the event loop's thread
+
+# read on a dedicated thread with a blocking read
+# this works on every platform pyserial supports
+class ThreadedSerialTransport:
+    # seconds a blocking read waits before checking if the transport was stopped
+    read_timeout = 0.1
+
+    def __init__(self, ser, on_data, on_error):
+        self.ser = ser
+        self.on_data = on_data
+        self.on_error = on_error
+        self.thread = None
+        self.is_running = False
+
+    def start(self, loop):
+        self.ser.timeout = self.read_timeout
+        self.is_running = True
+        self.thread = threading.Thread(target=self.run, args=(loop,), daemon=True)
+        self.thread.start()
+
+    def run(self, loop):
+        ser = self.ser
+        while self.is_running:
+            try:
+                # block until the first byte arrives then take everything else that is buffered
+                x = ser.read(1)
+                if len(x) == 0:
+                    continue
+                n = ser.in_waiting
+                if n > 0:
+                    x += ser.read(n)
+                loop.call_soon_threadsafe(self.on_data, x)
+            except Exception as ex:
+                if self.is_running:
+                    self.is_running = False
+                    try:
+                        loop.call_soon_threadsafe(self.on_error, ex)
+                    except RuntimeError:
+                        # the event loop is already closed
+                        pass
+                break
+
+    def stop(self):
+        self.is_running = False
+
+# read from the event loop when the serial file descriptor becomes readable
+# only available for posix ports on a selector event loop
+class FdSerialTransport:
+    def __init__(self, ser, on_data, on_error):
+        self.ser = ser
+        self.on_data = on_data
+        self.on_error = on_error
+        self.loop = None
+        self.fd = None
+
+    def start(self, loop):
+        self.ser.timeout = 0
+        self.loop = loop
+        self.fd = self.ser.fileno()
+        loop.add_reader(self.fd, self.on_readable)
+
+    def on_readable(self):
+        try:
+            x = self.ser.read(max(1, self.ser.in_waiting))
+        except Exception as ex:
+            self.stop()
+            self.on_error(ex)
+            return
+        if len(x) > 0:
+            self.on_data(x)
+
+    def stop(self):
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+            self.fd = None
+
+SERIAL_TRANSPORTS = {
+    "thread": ThreadedSerialTransport,
+    "fd": FdSerialTransport,
+}
@@ -0,0 +1,272 @@
+import os
+import argparse
+from collections import namedtuple
+import numpy as np
+
+from measurement_packets import GYRO_COLUMNS, COMPASS_COLUMNS, MicrosUnwrapper
+
+# binary session file that holds every sensor stream of a recording
+# each stream is stored as contiguous columns so it can be memory mapped instead of parsed
+#
+# layout (little endian)
+# - session header (64 bytes)
+# - stream headers (256 bytes each)
+# - for each stream, starting on a 64 byte boundary
+#   - device timestamps in microseconds as uint32, shape (N,)
+#   - values as float32 (SI units) or int16 (raw readings), shape (total columns, N)
+SESSION_MAGIC = b"\x93IMUSESS"
+SESSION_VERSION = 1
+SESSION_ALIGNMENT = 64
+
+SESSION_HEADER_DTYPE = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u4'),
+    ('total_streams', '<u4'),
+    ('reserved', 'V48'),
+])
+
+STREAM_HEADER_DTYPE = np.dtype([
+    ('name', 'S16'),
+    ('value_dtype', 'S8'),
+    ('total_rows', '<u8'),
+    ('total_columns', '<u4'),
+    ('reserved', 'V4'),
+    ('time_offset', '<u8'),
+    ('value_offset', '<u8'),
+    ('columns', 'S200'),   # comma separated column names
+])
+
+VALUE_DTYPES = {np.dtype('<f4'), np.dtype('<i2')}
+
+# uS.shape: (N,)
+# values.shape: (total columns, N)
+SessionStream = namedtuple("SessionStream", ["columns", "uS", "values"])
+
+# create a session file and memory map it for writing, so long streams can be filled in pieces
+# layouts = {name: (columns, total rows, value dtype)}
+# returns {name: SessionStream} where uS and values are writable views of the file
+def create_session(filename, layouts):
+    headers = np.zeros(len(layouts), dtype=STREAM_HEADER_DTYPE)
+    offset = SESSION_HEADER_DTYPE.itemsize + STREAM_HEADER_DTYPE.itemsize*len(layouts)
+
+    def align(offset):
+        return -(-offset // SESSION_ALIGNMENT) * SESSION_ALIGNMENT
+
+    for header, (name, (columns, N, value_dtype)) in zip(headers, layouts.items()):
+        value_dtype = np.dtype(value_dtype).newbyteorder('<')
+        if value_dtype not in VALUE_DTYPES:
+            raise ValueError(f"Stream '{name}' has unsupported values of type {value_dtype}")
+
+        header['name'] = name.encode("ascii")
+        header['value_dtype'] = value_dtype.str.encode("ascii")
+        header['total_rows'] = N
+        header['total_columns'] = len(columns)
+        header['columns'] = ",".join(columns).encode("ascii")
+
+        offset = align(offset)
+        header['time_offset'] = offset
+        offset = align(offset + 4*N)
+        header['value_offset'] = offset
+        offset = offset + value_dtype.itemsize*len(columns)*N
+
+    session_header = np.zeros(1, dtype=SESSION_HEADER_DTYPE)
+    session_header['magic'] = SESSION_MAGIC
+    session_header['version'] = SESSION_VERSION
+    session_header['total_streams'] = len(layouts)
+
+    with open(filename, "wb") as fp:
+        fp.write(session_header.tobytes())
+        fp.write(headers.tobytes())
+        fp.truncate(max(offset, fp.tell()))
+    return load_session(filename, mode='r+')
+
+# streams = {name: SessionStream}
+def save_session(filename, streams):
+    layouts = {}
+    for name, stream in streams.items():
+        values = np.asarray(stream.values)
+        value_dtype = values.dtype.newbyteorder('<')
+        if value_dtype not in VALUE_DTYPES:
+            value_dtype = np.dtype('<f4')
+        if values.shape != (len(stream.columns), len(stream.uS)):
+            raise ValueError(f"Stream '{name}' has values of shape {values.shape} instead of {(len(stream.columns), len(stream.uS))}")
+        layouts[name] = (stream.columns, len(stream.uS), value_dtype)
+
+    outputs = create_session(filename, layouts)
+    for name, stream in streams.items():
+        outputs[name].uS[:] = stream.uS
+        outputs[name].values[:] = stream.values
+    for output in outputs.values():
+        output.uS.flush()
+        output.values.flush()
+
+# memory map a session file, nothing is read until the returned arrays are used
+# returns {name: SessionStream} where uS and values are read only views of the file (unless mode='r+')
+def load_session(filename, mode='r'):
+    data = np.memmap(filename, dtype=np.uint8, mode=mode)
+    session_header = data[:SESSION_HEADER_DTYPE.itemsize].view(SESSION_HEADER_DTYPE)[0]
+    if session_header['magic'] != SESSION_MAGIC:
+        raise ValueError(f"{filename} is not a session file")
+    if session_header['version'] != SESSION_VERSION:
+        raise ValueError(f"{filename} has unsupported version {session_header['version']}")
+
+    start = SESSION_HEADER_DTYPE.itemsize
+    end = start + STREAM_HEADER_DTYPE.itemsize*int(session_header['total_streams'])
+    headers = data[start:end].view(STREAM_HEADER_DTYPE)
+
+    streams = {}
+    for header in headers:
+        N = int(header['total_rows'])
+        C = int(header['total_columns'])
+        value_dtype = np.dtype(header['value_dtype'].decode("ascii"))
+        time_offset = int(header['time_offset'])
+        value_offset = int(header['value_offset'])
+
+        uS = data[time_offset:time_offset+4*N].view('<u4')
+        values = data[value_offset:value_offset+value_dtype.itemsize*C*N].view(value_dtype).reshape((C,N))
+        columns = header['columns'].decode("ascii").split(",") if C > 0 else []
+        streams[header['name'].decode("ascii")] = SessionStream(columns, uS, values)
+    return streams
+
+# convert the device's micros() timestamps into seconds
+def micros_to_seconds(uS):
+    return MicrosUnwrapper().unwrap(np.asarray(uS) * 1e-6)
+
+# rows of (time in seconds, values...), the same layout as a csv recording
+def stream_to_rows(stream, dtype=np.float32):
+    rows = np.empty((len(stream.uS), 1+len(stream.columns)), dtype=dtype)
+    rows[:,0] = micros_to_seconds(stream.uS)
+    rows[:,1:] = stream.values.T
+    return rows
+
+# read the rows of a sensor a chunk at a time so long recordings use a bounded amount of memory
+# takes the same files as load_sensor_rows(), yields rows of (time in seconds, values...) as float64
+def iter_sensor_rows(filename_fmt, sensor, i, chunk_rows=1 << 16, header='infer'):
+    filename = filename_fmt.format(sensor=sensor, i=i)
+    _, ext = os.path.splitext(filename)
+    ext = ext.lower()
+    if ext == ".imu":
+        stream = load_session(filename)[sensor]
+        chunks = (
+            np.column_stack([stream.uS[start:start+chunk_rows] * 1e-6, stream.values[:,start:start+chunk_rows].T])
+            for start in range(0, len(stream.uS), chunk_rows))
+    elif ext == ".npy":
+        data = np.load(filename, mmap_mode='r')
+        chunks = (np.array(data[start:start+chunk_rows], dtype=np.float64) for start in range(0, len(data), chunk_rows))
+    else:
+        import pandas as pd
+        chunks = (df.to_numpy(dtype=np.float64) for df in pd.read_csv(filename, header=header, chunksize=chunk_rows))
+
+    unwrapper = MicrosUnwrapper()
+    for rows in chunks:
+        rows[:,0] = unwrapper.unwrap(rows[:,0])
+        yield rows
+
+# total rows of a sensor without loading it, csv files are scanned for their line count
+def count_sensor_rows(filename_fmt, sensor, i, header='infer'):
+    filename = filename_fmt.format(sensor=sensor, i=i)
+    _, ext = os.path.splitext(filename)
+    ext = ext.lower()
+    if ext == ".imu":
+        return len(load_session(filename)[sensor].uS)
+    if ext == ".npy":
+        return len(np.load(filename, mmap_mode='r'))
+    total_lines = 0
+    with open(filename, "rb") as fp:
+        for block in iter(lambda: fp.read(1 << 20), b''):
+            total_lines += block.count(b'\n')
+    return total_lines - (0 if header is None else 1)
+
+# shared loader for the analysis scripts
+# filename_fmt can have formatting keys for 'sensor' and 'i', the format is picked from its extension
+# - .imu = session file, the sensor is the name of the stream
+# - .npy = recording from live_async_ekf.py
+# - .csv = recording from live_async_ekf.py, header is passed to pd.read_csv
+# returns rows of (time in seconds, values...), the wrap around of the device timestamps is undone
+# the rows are a copy in memory, open_sensor() reads the file in place
+def load_sensor_rows(filename_fmt, sensor, i, dtype=np.float32, header='infer'):
+    filename = filename_fmt.format(sensor=sensor, i=i)
+    _, ext = os.path.splitext(filename)
+    ext = ext.lower()
+    if ext == ".imu":
+        return stream_to_rows(load_session(filename)[sensor], dtype=dtype)
+    if ext == ".npy":
+        rows = np.load(filename)
+    else:
+        import pandas as pd
+        rows = pd.read_csv(filename, header=header).to_numpy(dtype=np.float64)
+    rows[:,0] = MicrosUnwrapper().unwrap(rows[:,0])
+    return rows.astype(dtype, copy=False)
+
+# a sensor of a recording that is read in place instead of being copied into rows
+# values.shape: (total columns, N), a view of the session file or .npy file (csv files are parsed)
+# columns = names of the values, None if the file doesn't name them
+class SensorView:
+    # t = device timestamps, seconds = t*time_scale before the wrap around is undone
+    def __init__(self, columns, t, values, time_scale=1.0):
+        self.columns = columns
+        self.t = t
+        self.values = values
+        self.time_scale = time_scale
+        self._time = None
+
+    def __len__(self):
+        return len(self.t)
+
+    # time in seconds with the wrap around undone, worked out on first use
+    @property
+    def time(self):
+        if self._time is None:
+            self._time = MicrosUnwrapper().unwrap(self.t * self.time_scale)
+        return self._time
+
+    # values start:end as columns, shape (N, end-start)
+    # this is a view so the values are only read as they are used
+    def get_values(self, start, end):
+        return self.values[start:end].T
+
+# open a sensor of a recording without reading it
+# takes the same files as load_sensor_rows()
+def open_sensor(filename_fmt, sensor, i, header='infer'):
+    filename = filename_fmt.format(sensor=sensor, i=i)
+    _, ext = os.path.splitext(filename)
+    ext = ext.lower()
+    if ext == ".imu":
+        stream = load_session(filename)[sensor]
+        return SensorView(stream.columns, stream.uS, stream.values, time_scale=1e-6)
+    if ext == ".npy":
+        rows = np.load(filename, mmap_mode='r')
+        return SensorView(None, rows[:,0], rows[:,1:].T)
+
+    import pandas as pd
+    df = pd.read_csv(filename, header=header)
+    rows = df.to_numpy(dtype=np.float64)
+    columns = [str(c) for c in df.columns[1:]] if header is not None else None
+    return SensorView(columns, rows[:,0], rows[:,1:].T)
+
+# create a session stream from rows of (time in seconds, values...)
+def rows_to_stream(rows, columns):
+    rows = np.asarray(rows)
+    uS = np.round(rows[:,0] * 1e6).astype(np.int64) & 0xFFFFFFFF
+    return SessionStream(list(columns), uS, rows[:,1:].T.astype(np.float32))
+
+# convert a recording of gyro and compass files into a session file
+def convert_recording(input_fmt, output_fmt, i):
+    streams = {}
+    for sensor, columns in (("gyro", GYRO_COLUMNS), ("compass", COMPASS_COLUMNS)):
+        rows = load_sensor_rows(input_fmt, sensor, i, dtype=np.float64)
+        streams[sensor] = rows_to_stream(rows, columns[1:])
+    filename = output_fmt.format(i=i)
+    save_session(filename, streams)
+    return filename
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert recordings from live_async_ekf.py into session files")
+    parser.add_argument("i", nargs="+")
+    parser.add_argument("--input", default="./data/data_{sensor}_{i}.csv")
+    parser.add_argument("--output", default="./data/session_{i}.imu")
+    args = parser.parse_args()
+
+    for i in args.i:
+        filename = convert_recording(args.input, args.output, i)
+        print(f"Saved {filename}")
@@ -0,0 +1,200 @@
+import os
+import queue
+import struct
+import threading
+import time
+import numpy as np
+import pandas as pd
+
+# append rows of float64 to an .npy file that can be read while it is still being written
+# the header has a fixed size so the row count can be rewritten in place after every chunk
+# a crash leaves a valid file with every chunk that was written before it
+class NpyChunkWriter:
+    MAGIC = b'\x93NUMPY\x01\x00'
+    HEADER_LEN = 118   # magic + length + header is 128 bytes, a multiple of 64 like numpy's own files
+
+    def __init__(self, filename, columns):
+        self.total_columns = len(columns)
+        self.total_rows = 0
+        self.fp = open(filename, "wb")
+        self.write_header()
+
+    def write_header(self):
+        header = f"{{'descr': '<f8', 'fortran_order': False, 'shape': ({self.total_rows}, {self.total_columns}), }}"
+        header = header.ljust(self.HEADER_LEN-1) + "\n"
+        self.fp.write(self.MAGIC + struct.pack("<H", self.HEADER_LEN) + header.encode("latin1"))
+
+    def write(self, rows):
+        self.fp.write(np.ascontiguousarray(rows, dtype='<f8').tobytes())
+        self.total_rows += len(rows)
+        self.fp.seek(0)
+        self.write_header()
+        self.fp.seek(0, os.SEEK_END)
+        self.fp.flush()
+
+    def tell(self):
+        return self.fp.tell()
+
+    def close(self):
+        self.fp.close()
+
+# append rows to a csv file with the same layout that pandas' to_csv gives for the whole recording
+class CsvChunkWriter:
+    def __init__(self, filename, columns):
+        self.columns = columns
+        self.fp = open(filename, "w", newline='')
+        self.fp.write(",".join(columns) + "\n")
+
+    def write(self, rows):
+        pd.DataFrame(rows, columns=self.columns).to_csv(self.fp, header=False, index=None)
+        self.fp.flush()
+
+    def tell(self):
+        return self.fp.tell()
+
+    def close(self):
+        self.fp.close()
+
+# the file format is picked from the extension of the output filename
+CHUNK_WRITERS = {
+    ".npy": NpyChunkWriter,
+    ".csv": CsvChunkWriter,
+}
+
+# find the first index where the files of every sensor are free
+def find_free_index(output, sensors, i=0):
+    while any(os.path.exists(output.format(sensor=sensor, i=i)) for sensor in sensors):
+        i += 1
+    return i
+
+# record measurements to disk during the session instead of keeping them in memory
+# record() is called on the event loop and only buffers rows, whole chunks are written by a background thread
+# output = filename with formatting keys for 'sensor' and 'i'
+# sensors = {sensor name: column names}, the first column of each sensor is its timestamp in seconds
+# i = index of the first set of files
+# Every rotation closes the files of all sensors and continues at the next free index
+# so each set of files is a complete recording that can be loaded on its own
+# NOTE: files are only rotated between chunks, so the sensors of a set can start and end up to flush_interval apart
+class SessionRecorder:
+    # chunk_rows = rows of a sensor that are written together
+    # flush_interval = seconds before a partial chunk is written anyway, so a slow sensor isn't held in memory
+    # max_queue = chunks waiting to be written before new ones are dropped
+    # rotate_bytes, rotate_seconds = start the next set of files when a file gets this big or old (None to disable)
+    def __init__(self, output, sensors, i=0, chunk_rows=4096, flush_interval=1.0, max_queue=64, rotate_bytes=None, rotate_seconds=None):
+        _, ext = os.path.splitext(output)
+        self.writer_type = CHUNK_WRITERS[ext.lower()]
+        self.output = output
+        self.sensors = sensors
+        self.i = i
+        self.chunk_rows = chunk_rows
+        self.flush_interval = flush_interval
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+
+        self.queue = queue.Queue(max_queue)
+        self.thread = None
+
+        # event loop side
+        self.pending = {sensor: [] for sensor in sensors}
+        self.total_pending = {sensor: 0 for sensor in sensors}
+        self.last_flush = time.monotonic()
+
+        # writer thread side
+        self.writers = {}
+        self.segment_start = 0.0
+        self.filenames = []
+
+        self.total_rows = {sensor: 0 for sensor in sensors}
+        self.total_dropped_rows = {sensor: 0 for sensor in sensors}
+        self.first_time = {sensor: None for sensor in sensors}
+        self.last_time = {sensor: None for sensor in sensors}
+        self.write_error = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # rows.shape: (N, total columns of the sensor)
+    def record(self, sensor, rows):
+        if len(rows) == 0:
+            return
+        self.pending[sensor].append(rows)
+        self.total_pending[sensor] += len(rows)
+        if self.first_time[sensor] is None:
+            self.first_time[sensor] = rows[0,0]
+        self.last_time[sensor] = rows[-1,0]
+
+        if self.total_pending[sensor] >= self.chunk_rows:
+            self.flush_sensor(sensor)
+        if time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush_sensor(self, sensor):
+        blocks = self.pending[sensor]
+        if len(blocks) == 0:
+            return
+        rows = np.concatenate(blocks)
+        self.pending[sensor] = []
+        self.total_pending[sensor] = 0
+        try:
+            self.queue.put_nowait((sensor, rows))
+            self.total_rows[sensor] += len(rows)
+        except queue.Full:
+            self.total_dropped_rows[sensor] += len(rows)
+
+    # hand every buffered row to the writer thread
+    def flush(self):
+        for sensor in self.sensors:
+            self.flush_sensor(sensor)
+        self.last_flush = time.monotonic()
+
+    # write the remaining rows and wait for the writer thread to finish
+    def close(self):
+        self.flush()
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            sensor, rows = item
+            try:
+                self.write(sensor, rows)
+            except Exception as ex:
+                # keep draining the queue so the event loop never blocks on it
+                if self.write_error is None:
+                    self.write_error = ex
+                    print(f"Encountered error when recording: {str(ex)}")
+        self.close_files()
+
+    def write(self, sensor, rows):
+        if len(self.writers) > 0 and self.is_rotation_due():
+            self.close_files()
+            self.i = find_free_index(self.output, self.sensors, self.i+1)
+
+        writer = self.writers.get(sensor)
+        if writer is None:
+            if len(self.writers) == 0:
+                self.segment_start = time.monotonic()
+            filename = self.output.format(sensor=sensor, i=self.i)
+            writer = self.writer_type(filename, self.sensors[sensor])
+            self.writers[sensor] = writer
+            self.filenames.append(filename)
+        writer.write(rows)
+
+    def is_rotation_due(self):
+        if self.rotate_seconds is not None and time.monotonic() - self.segment_start >= self.rotate_seconds:
+            return True
+        if self.rotate_bytes is not None and any(writer.tell() >= self.rotate_bytes for writer in self.writers.values()):
+            return True
+        return False
+
+    def close_files(self):
+        for writer in self.writers.values():
+            writer.close()
+        self.writers.clear()
@@ -0,0 +1,177 @@
+import numpy as np
+import pandas as pd
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from timeit import default_timer
+
+from ekf import FastMultiRateExtendedKalmanFilter
+from ekf_client import EKFClient
+from session_file import open_sensor
+from event_stream import create_event_order, iter_event_runs
+
+# Sweep the ekf process noise (Q) and measurement noise (Ra, Rm) over recorded sessions
+# The recordings are parsed once and placed in shared memory so every worker process can read them
+# Each trial is scored by how consistent the filter is with its own covariance
+# For a consistent filter the normalised innovation squared (NIS) averages to the size of the measurement
+
+# fast ekf which keeps a running total of the normalised innovation squared of each measurement
+class ScoredExtendedKalmanFilter(FastMultiRateExtendedKalmanFilter):
+    def __init__(self):
+        super().__init__()
+        self.total_nis = 0.0
+        self.total_dof = 0
+
+    def measure(self, Vb, Ve, Ek, Pk, R):
+        Ek, Pk = super().measure(Vb, Ve, Ek, Pk, R)
+        # the innovation and its covariance are left in the workspace by measure
+        Hk, Hk_flat, y, PHt, Sk, Kf, KHP, dE = self.measure_bufs[3*len(Vb)]
+        self.total_nis += (y.T @ np.linalg.solve(Sk, y)).item()
+        self.total_dof += y.shape[0]
+        return Ek, Pk
+
+# load the recordings into a single shared memory block
+# the session files are copied straight into the block as rows of (time, values...)
+# returns the block and the (offset, shape) of each array so the workers can find them
+def load_recordings(filename_fmt, indices):
+    sensors = []
+    for i in indices:
+        gyro = open_sensor(filename_fmt, 'gyro', i)
+        compass = open_sensor(filename_fmt, 'compass', i)
+        sensors.append((gyro, compass))
+
+    def get_shape(sensor):
+        return (len(sensor), 1+sensor.values.shape[0])
+
+    itemsize = np.dtype(np.float64).itemsize
+    total_bytes = sum(itemsize*np.prod(get_shape(x)) for pair in sensors for x in pair)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, int(total_bytes)))
+
+    layouts = []
+    offset = 0
+    for pair in sensors:
+        layout = []
+        for x in pair:
+            shape = get_shape(x)
+            view = np.ndarray(shape, dtype=np.float64, buffer=shm.buf, offset=offset)
+            view[:,0] = x.time
+            view[:,1:] = x.values.T
+            layout.append((offset, shape))
+            offset += view.nbytes
+        layouts.append(tuple(layout))
+
+    return shm, layouts
+
+# kinds of the events in each recording
+COMPASS, GYRO = 0, 1
+
+# worker process state, attached once per process by init_worker
+worker_shm = None
+worker_recordings = None
+
+def init_worker(shm_name, layouts):
+    global worker_shm, worker_recordings
+    worker_shm = shared_memory.SharedMemory(name=shm_name)
+    worker_recordings = []
+    for (gyro_offset, gyro_shape), (compass_offset, compass_shape) in layouts:
+        gyro = np.ndarray(gyro_shape, dtype=np.float64, buffer=worker_shm.buf, offset=gyro_offset)
+        compass = np.ndarray(compass_shape, dtype=np.float64, buffer=worker_shm.buf, offset=compass_offset)
+        # merge the gyro and compass streams by timestamp, compass goes first on a tie
+        # which is the same order as plot_multirate_ekf.py
+        events = create_event_order([compass[:,0], gyro[:,0]])
+        worker_recordings.append((gyro, compass, events))
+
+# each run of events from one sensor is given to the client as a single batch
+def apply_events(client, gyro, compass, events):
+    for kind, start, end in iter_event_runs(events):
+        if kind == COMPASS:
+            client.on_compass_batch(compass[start:end,0], compass[start:end,1:4])
+        else:
+            client.on_gyro_batch(gyro[start:end,0], gyro[start:end,1:4], gyro[start:end,4:7])
+
+def run_trial(params):
+    Q, Ra, Rm, calibrate_events, use_paired_measurements = params
+
+    total_nis = 0.0
+    total_dof = 0
+    for gyro, compass, events in worker_recordings:
+        ekf = ScoredExtendedKalmanFilter()
+        client = EKFClient(use_paired_measurements=use_paired_measurements, ekf=ekf)
+        ekf.Q = Q*np.eye(4)
+        client.Ra = Ra*np.eye(3)
+        client.Rm = Rm*np.eye(3)
+
+        client.set_calibrate(True)
+        apply_events(client, gyro, compass, events[:calibrate_events])
+        if len(events) > calibrate_events:
+            client.set_calibrate(False)
+            apply_events(client, gyro, compass, events[calibrate_events:])
+
+        total_nis += ekf.total_nis
+        total_dof += ekf.total_dof
+
+    if total_dof == 0:
+        return params, np.nan, np.inf
+
+    # a consistent filter has an average nis per degree of freedom of 1
+    mean_nis = total_nis / total_dof
+    score = abs(np.log(mean_nis))
+    return params, mean_nis, score
+
+def create_trials(args):
+    calib = args.calibrate_events
+    paired = args.paired
+    if args.search == 'grid':
+        for Q, Ra, Rm in itertools.product(args.Q, args.Ra, args.Rm):
+            yield (Q, Ra, Rm, calib, paired)
+        return
+
+    # log uniform search over the range of each parameter
+    rng = np.random.default_rng(args.seed)
+    def sample(values):
+        lo, hi = np.log10(min(values)), np.log10(max(values))
+        return float(10**rng.uniform(lo, hi))
+
+    for _ in range(args.trials):
+        yield (sample(args.Q), sample(args.Ra), sample(args.Rm), calib, paired)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("i", nargs="+", help="Indices of the recordings to use")
+    parser.add_argument("--input", default="./data/session_{i}.imu", help="Session files, or csv/npy recordings with a 'sensor' formatting key")
+    parser.add_argument("--output", default="./data/sweep.csv")
+    parser.add_argument("--search", default="grid", choices=["grid", "random"])
+    parser.add_argument("--trials", default=100, type=int, help="Number of trials for random search")
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("--Q",  default=[1e-4,1e-3,1e-2,1e-1], nargs="+", type=float, help="Process noise values (grid) or range (random)")
+    parser.add_argument("--Ra", default=[1e-2,1e-1,1], nargs="+", type=float, help="Accelerometer noise values (grid) or range (random)")
+    parser.add_argument("--Rm", default=[1e-3,1e-2,1e-1], nargs="+", type=float, help="Compass noise values (grid) or range (random)")
+    parser.add_argument("--calibrate-events", default=100, type=int, help="Number of events used to calibrate each recording")
+    parser.add_argument("--paired", action="store_true", help="Use paired measurements")
+    parser.add_argument("--workers", default=None, type=int)
+
+    args = parser.parse_args()
+
+    dt0 = default_timer()
+    shm, layouts = load_recordings(args.input, args.i)
+    dt1 = default_timer()
+    print(f"Loaded {len(args.i)} recordings in {dt1-dt0:.2f} seconds")
+
+    results = []
+    try:
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker, initargs=(shm.name, layouts)) as pool:
+            for params, mean_nis, score in pool.map(run_trial, create_trials(args)):
+                Q, Ra, Rm, _, _ = params
+                results.append((Q, Ra, Rm, mean_nis, score))
+    finally:
+        shm.close()
+        shm.unlink()
+
+    dt2 = default_timer()
+    print(f"Ran {len(results)} trials in {dt2-dt1:.2f} seconds")
+
+    df = pd.DataFrame(results, columns=['Q', 'Ra', 'Rm', 'NIS/dof', 'score'])
+    df = df.sort_values('score').reset_index(drop=True)
+    df.to_csv(args.output, index=None)
+    print(df.head(10).to_string())
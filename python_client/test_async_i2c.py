@@ -0,0 +1,98 @@
+import asyncio
+
+from async_i2c import AsyncI2C
+
+# records the commands instead of sending them, acks are given to AsyncI2C by the test
+class FakeSerialClient:
+    def __init__(self):
+        self.commands = []
+
+    def send_command(self, command):
+        self.commands.append(list(command))
+
+# start a request and wait until its first ack times out so the command is resent
+async def start_resent_request(i2c, client, request):
+    task = asyncio.create_task(request)
+    await asyncio.sleep(i2c.timeout*1.5)
+    assert len(client.commands) == 2
+    return task
+
+def test_duplicate_write_ack_is_not_given_to_next_request():
+    async def run():
+        client = FakeSerialClient()
+        i2c = AsyncI2C(client, timeout=0.05)
+        first = await start_resent_request(i2c, client, i2c.write(0x68, 0x1B, [0x08]))
+        # the late ack of the first copy completes the write
+        i2c.on_write_ack(bytes([0x68, 0x1B, 1]))
+        assert await first == 1
+
+        second = asyncio.create_task(i2c.write(0x68, 0x1B, [0x10, 0x00]))
+        await asyncio.sleep(0)
+        # the ack of the resent copy arrives before the second write has run
+        i2c.on_write_ack(bytes([0x68, 0x1B, 1]))
+        await asyncio.sleep(0)
+        assert not second.done()
+
+        i2c.on_write_ack(bytes([0x68, 0x1B, 2]))
+        assert await second == 2
+        assert i2c.total_stale_acks == 1
+        assert i2c.unknown_write_acks == []
+    asyncio.run(run())
+
+def test_duplicate_read_ack_does_not_return_old_data():
+    async def run():
+        client = FakeSerialClient()
+        i2c = AsyncI2C(client, timeout=0.05)
+        first = await start_resent_request(i2c, client, i2c.read(0x68, 0x1C, 1))
+        i2c.on_read_ack(bytes([0x68, 0x1C, 1, 0x00]))
+        assert await first == bytes([0x00])
+
+        second = asyncio.create_task(i2c.read(0x68, 0x1C, 1))
+        await asyncio.sleep(0)
+        i2c.on_read_ack(bytes([0x68, 0x1C, 1, 0x00]))
+        i2c.on_read_ack(bytes([0x68, 0x1C, 1, 0x18]))
+        assert await second == bytes([0x18])
+        assert i2c.total_stale_acks == 1
+    asyncio.run(run())
+
+def test_lost_duplicate_ack_expires():
+    async def run():
+        client = FakeSerialClient()
+        i2c = AsyncI2C(client, timeout=0.05, max_ack_age=0.1)
+        first = await start_resent_request(i2c, client, i2c.write(0x1E, 0x01, [0x20]))
+        i2c.on_write_ack(bytes([0x1E, 0x01, 1]))
+        assert await first == 1
+
+        # the ack of the resent copy was lost, so the next ack belongs to the second write
+        await asyncio.sleep(0.15)
+        second = asyncio.create_task(i2c.write(0x1E, 0x01, [0x40]))
+        await asyncio.sleep(0)
+        i2c.on_write_ack(bytes([0x1E, 0x01, 1]))
+        assert await second == 1
+        assert i2c.total_stale_acks == 0
+        assert len(client.commands) == 3
+    asyncio.run(run())
+
+def test_ack_just_after_timeout_is_not_resent(monkeypatch):
+    async def run():
+        client = FakeSerialClient()
+        i2c = AsyncI2C(client, timeout=0.05)
+        wait_for = asyncio.wait_for
+
+        # the ack arrives once the first wait has timed out but before the request runs again
+        async def late_ack_wait_for(future, timeout):
+            monkeypatch.setattr(asyncio, "wait_for", wait_for)
+            i2c.on_write_ack(bytes([0x68, 0x1B, 1]))
+            raise asyncio.TimeoutError()
+        monkeypatch.setattr(asyncio, "wait_for", late_ack_wait_for)
+
+        assert await i2c.write(0x68, 0x1B, [0x08]) == 1
+        assert len(client.commands) == 1
+        assert i2c.total_retries == 0
+
+        second = asyncio.create_task(i2c.write(0x68, 0x1B, [0x10, 0x00]))
+        await asyncio.sleep(0)
+        i2c.on_write_ack(bytes([0x68, 0x1B, 2]))
+        assert await second == 2
+        assert i2c.total_stale_acks == 0
+    asyncio.run(run())